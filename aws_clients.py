@@ -0,0 +1,53 @@
+import os
+import threading
+
+# Shared boto3 client factory for the Lambda handlers.
+# boto3/botocore are imported on first use rather than at module import, and clients are
+# cached per (service, region) at module level so warm containers reuse their connection pools.
+
+# Connection pooling, keep-alive, retry and timeout tuning applied to every client
+CLIENT_CONFIG_OPTIONS = {
+    'retries': {'mode': 'adaptive', 'max_attempts': 8},
+    'connect_timeout': 3,
+    'read_timeout': 20,
+    'max_pool_connections': 16,
+    'tcp_keepalive': True
+}
+
+_lock = threading.Lock()
+_session = None
+_config = None
+_clients = {}
+
+
+def _get_session():
+    global _session, _config
+    if _session is None:
+        import boto3.session
+        from botocore.config import Config
+        _session = boto3.session.Session()
+        _config = Config(**CLIENT_CONFIG_OPTIONS)
+    return _session
+
+
+def get_client(service, region=None):
+    # Return the cached client for this service/region, creating it on first use
+    region = region or os.environ.get('REGION') or os.environ.get('AWS_REGION')
+    key = (service, region)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _get_session().client(service, region_name=region, config=_config)
+                _clients[key] = client
+    return client
+
+
+def reset_clients():
+    # Drop cached clients, e.g. to measure a cold start again in the same process
+    global _session, _config
+    with _lock:
+        _clients.clear()
+        _session = None
+        _config = None
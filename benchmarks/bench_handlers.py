@@ -0,0 +1,349 @@
+"""End-to-end benchmark for the Lambda handlers against simulated AWS.
+
+Runs the setup, key rotation and config update handlers against the in-process EC2/SSM/
+Step Functions stand-ins in fake_aws.py, on a virtual clock. For each scenario it reports
+the wall time of the run, the simulated end-to-end time, Lambda invocations and simulated
+billed duration, Step Functions state transitions, API calls, command polls and throttled
+retries, so changes to polling, backoff or retry behaviour can be compared before they ship.
+
+Scenarios:
+    setup-blocking        one instance, direct invocation that waits in-process
+    setup-step-functions  one instance, driven step by step by the setup state machine
+    burst-step-functions  --burst instances launched at once, one state machine run each
+    burst-fleet           --burst instances launched at once, one fleet-mode run
+    large-fleet           --fleet-burst instances, more than FLEET_MAX_CONCURRENCY, so SSM runs the
+                          fleet command in several waves
+    rotation              key rotation, the seafile.conf update, then a repeated change event; each
+                          command is reported from its status-change event
+    setup-benchmark       one instance through the state machine with the post-setup benchmark
+                          and its S3 request metrics
+    duplicate-events      --burst instances whose launch events arrive twice, plus an overlapping
+                          event from another source; every instance must get exactly one command
+
+Usage:
+    python benchmarks/bench_handlers.py [--scenario NAME ...] [--burst 20] [--fleet-burst 50] [--throttle-rate 0.05] [--json]
+"""
+import argparse
+import contextlib
+import heapq
+import io
+import json
+import logging
+import math
+import os
+import sys
+import time
+import uuid
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [REPO_ROOT, BENCH_DIR]
+
+REGION = 'ap-southeast-1'
+
+os.environ.update({
+    'REGION': REGION,
+    'EIP_PUBLIC_IP': '203.0.113.10',
+    'COMMIT_BUCKET': 'bench-commit',
+    'FS_BUCKET': 'bench-fs',
+    'BLOCK_BUCKET': 'bench-block',
+    'COMMAND_LOG_GROUP': '/seafile/ssm-commands',
+    'EVENT_LEDGER_TABLE': 'SeafileEventLedger',
+    'REMOTE_TASKS_BUCKET': 'bench-remote-tasks',
+    'SETUP_STATE_MACHINE_ARN': f"arn:aws:states:{REGION}:123456789012:stateMachine:SeafileSetupStateMachine"
+})
+
+import aws_clients  # noqa: E402
+import event_ledger  # noqa: E402
+import lambda_function  # noqa: E402
+import metrics  # noqa: E402
+import remote_tasks  # noqa: E402
+import rotate_keys_lambda  # noqa: E402
+import setup_benchmark  # noqa: E402
+import ssm_readiness  # noqa: E402
+import update_config_lambda  # noqa: E402
+from fake_aws import FakeAWS, FakeContext, Scenario, install_clock  # noqa: E402
+
+CLOCK_MODULES = [lambda_function, setup_benchmark, rotate_keys_lambda, update_config_lambda, ssm_readiness, metrics, event_ledger]
+
+# Functions the SeafileCommandStatus rule invokes with every finished command on the instance
+COMMAND_STATUS_TARGETS = [rotate_keys_lambda.lambda_handler, update_config_lambda.lambda_handler]
+
+# SetupStep's States.TaskFailed retrier
+TASK_FAILED_INTERVAL = 5
+TASK_FAILED_MAX_ATTEMPTS = 3
+TASK_FAILED_BACKOFF_RATE = 2
+
+POLL_OPERATIONS = ['GetCommandInvocation', 'ListCommandInvocations', 'DescribeInstanceInformation']
+
+
+class Run:
+    # Totals for one scenario
+    def __init__(self, world):
+        self.world = world
+        self.invocations = 0
+        self.billed_ms = 0
+        self.transitions = 0
+        self.metric_documents = 0
+        self.outcomes = {}
+
+    def invoke(self, handler, event, timeout_seconds=600):
+        # One Lambda invocation; billed duration is the simulated time it took, rounded up to 1 ms
+        clock = self.world.clock
+        started = clock.time()
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                return handler(json.loads(json.dumps(event)), FakeContext(clock, timeout_seconds))
+        finally:
+            self.invocations += 1
+            self.billed_ms += math.ceil((clock.time() - started) * 1000)
+            self.metric_documents += output.getvalue().count('"_aws"')
+
+    def state_machine(self, state):
+        # Mirrors SeafileSetupStateMachine: SetupStep -> CheckStatus -> WaitBeforeNextStep, with
+        # SetupStep's States.TaskFailed retries and its catch through ReleaseLeases to SetupFailed.
+        # Yields the simulated time to resume at after each Wait state and retry interval.
+        while True:
+            self.transitions += 2
+            for attempt in range(TASK_FAILED_MAX_ATTEMPTS + 1):
+                try:
+                    result = self.invoke(lambda_function.lambda_handler, state)
+                    break
+                except Exception as e:
+                    if attempt == TASK_FAILED_MAX_ATTEMPTS:
+                        self.transitions += 3
+                        failure = {'Error': type(e).__name__, 'Cause': json.dumps({'errorMessage': str(e)})}
+                        self.invoke(lambda_function.lambda_handler, {**state, 'failure': failure, 'action': 'release'})
+                        return 'Failed'
+                    self.transitions += 1
+                    yield self.world.clock.time() + TASK_FAILED_INTERVAL * TASK_FAILED_BACKOFF_RATE ** attempt
+            state = result
+            if state['status'] in ('Success', 'Skipped'):
+                return state['status']
+            if state['action'] == 'done':
+                return 'Failed'
+            self.transitions += 1
+            yield self.world.clock.time() + state['wait_seconds']
+
+    def run(self, executions):
+        # Interleave the executions in simulated time order
+        queue = [(self.world.clock.time(), i, execution) for i, execution in enumerate(executions)]
+        heapq.heapify(queue)
+        while queue:
+            wake, i, execution = heapq.heappop(queue)
+            self.world.clock.advance_to(wake)
+            try:
+                heapq.heappush(queue, (next(execution), i, execution))
+            except StopIteration as stop:
+                self._record(stop.value)
+            except Exception as e:
+                self._record(type(e).__name__)
+
+    def _record(self, outcome):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+
+def running_event(world, instance_id):
+    # EventBridge "EC2 Instance State-change Notification" for the running state
+    return {
+        'id': world._next_id('event'),
+        'detail': {'instance-id': instance_id, 'state': 'running'},
+        'time': world.clock.isoformat()[:19] + 'Z'
+    }
+
+
+def setup_blocking(run, args):
+    instance_id = run.world.launch()[0]
+    event = running_event(run.world, instance_id)
+
+    def execution():
+        result = run.invoke(lambda_function.lambda_handler, event)
+        if result['statusCode'] == 202:
+            # Handed off: the state machine picks up from the state the handler passed on
+            return (yield from run.state_machine(json.loads(run.world.executions[-1])))
+        return 'Success'
+        yield
+
+    return [execution()]
+
+
+def prepare_setup(event):
+    # The PrepareSetup Pass state
+    return {
+        'action': 'start',
+        'attempt': 0,
+        'instance_id': event['detail']['instance-id'],
+        'running_at': event['time'],
+        'event_id': event['id'],
+        'run_id': f"execution-{uuid.uuid4()}"
+    }
+
+
+def setup_step_functions(run, args):
+    instance_id = run.world.launch()[0]
+    return [run.state_machine(prepare_setup(running_event(run.world, instance_id)))]
+
+
+def burst_step_functions(run, args):
+    return [
+        run.state_machine(prepare_setup(running_event(run.world, instance_id)))
+        for instance_id in run.world.launch(args.burst)
+    ]
+
+
+def burst_fleet(run, args, count=None):
+    run.world.launch(count or args.burst)
+
+    def execution():
+        # Started once the slowest agent is expected to have registered
+        yield run.world.clock.time() + run.world.scenario.agent_delay * 1.5
+        return (yield from run.state_machine({'mode': 'fleet', 'action': 'fleet_start', 'run_id': 'execution-fleet'}))
+
+    return [execution()]
+
+
+def large_fleet(run, args):
+    return burst_fleet(run, args, args.fleet_burst)
+
+
+def rotation(run, args):
+    instance_id = run.world.launch()[0]
+    os.environ['INSTANCE_ID'] = instance_id
+    run.world.scenario.command_duration = args.rotation_duration
+
+    def execution():
+        # Rotation runs against an instance that is already serving
+        yield run.world.instances[instance_id]['agent_online_at']
+        # The second update sees an unchanged value and must not touch the instance
+        for handler in (rotate_keys_lambda.lambda_handler, update_config_lambda.lambda_handler, update_config_lambda.lambda_handler):
+            result = run.invoke(handler, {})
+            if result['statusCode'] == 202:
+                # The handler returns once the command is sent; its status-change event, which the
+                # command status rule delivers to both functions, reports the outcome
+                command_id = list(run.world.commands)[-1]
+                yield run.world.finished_at(command_id, instance_id)
+                event = run.world.status_change_event(command_id, instance_id)
+                for target in COMMAND_STATUS_TARGETS:
+                    response = run.invoke(target, event)
+                    if target is handler:
+                        result = response
+            if result['statusCode'] != 200:
+                return f"HTTP {result['statusCode']}"
+            if handler is rotate_keys_lambda.lambda_handler:
+                run.world.rotate_credentials()
+        body = json.loads(result['body'])
+        return 'Unchanged' if isinstance(body, dict) and body.get('status') == 'unchanged' else 'Updated twice'
+
+    return [execution()]
+
+
+def setup_benchmark(run, args):
+    os.environ['POST_SETUP_BENCHMARK'] = 'true'
+    instance_id = run.world.launch()[0]
+
+    def execution():
+        state = prepare_setup(running_event(run.world, instance_id))
+        outcome = yield from run.state_machine(state)
+        # A benchmark error is logged but never fails the setup, so check that it completed
+        return outcome if run.world.calls.get('GetMetricData') else 'Not benchmarked'
+
+    return [execution()]
+
+
+def duplicate_events(run, args):
+    executions = []
+    for instance_id in run.world.launch(args.burst):
+        event = running_event(run.world, instance_id)
+        # At-least-once delivery repeats the event; another rule fires for the same launch later
+        executions.append(run.state_machine(prepare_setup(event)))
+        executions.append(delayed(run, 5, run.state_machine(prepare_setup(event))))
+        executions.append(delayed(run, 90, run.state_machine(prepare_setup(running_event(run.world, instance_id)))))
+    return executions
+
+
+def delayed(run, seconds, execution):
+    yield run.world.clock.time() + seconds
+    return (yield from execution)
+
+
+SCENARIOS = {
+    'setup-blocking': setup_blocking,
+    'setup-step-functions': setup_step_functions,
+    'burst-step-functions': burst_step_functions,
+    'burst-fleet': burst_fleet,
+    'large-fleet': large_fleet,
+    'rotation': rotation,
+    'setup-benchmark': setup_benchmark,
+    'duplicate-events': duplicate_events
+}
+
+
+def run_scenario(name, args):
+    world = FakeAWS(Scenario(
+        agent_delay=args.agent_delay,
+        command_duration=args.command_duration,
+        api_latency=args.api_latency / 1000,
+        throttle_rate=args.throttle_rate,
+        failure_rate=args.failure_rate
+    ), seed=args.seed)
+    install_clock(world.clock, CLOCK_MODULES)
+    event_ledger._ledgers.clear()
+    os.environ.pop('POST_SETUP_BENCHMARK', None)
+    aws_clients.reset_clients()
+    aws_clients._clients.update({(service, REGION): client for service, client in world.clients().items()})
+    remote_tasks._published.clear()
+
+    run = Run(world)
+    wall_started = time.perf_counter()
+    simulated_started = world.clock.time()
+    run.run(SCENARIOS[name](run, args))
+    return {
+        'scenario': name,
+        'wall_ms': (time.perf_counter() - wall_started) * 1000,
+        'simulated_s': world.clock.time() - simulated_started,
+        'invocations': run.invocations,
+        'billed_ms': run.billed_ms,
+        'transitions': run.transitions,
+        'api_calls': sum(world.calls.values()),
+        'polls': sum(world.calls.get(operation, 0) for operation in POLL_OPERATIONS),
+        'throttled': world.throttled,
+        'metric_documents': run.metric_documents,
+        'calls': dict(sorted(world.calls.items())),
+        'outcomes': run.outcomes
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), help='scenario to run (repeatable; default all)')
+    parser.add_argument('--burst', type=int, default=20, help='instances launched at once in the burst scenarios')
+    parser.add_argument('--fleet-burst', type=int, default=50, help='instances launched at once in the large-fleet scenario')
+    parser.add_argument('--agent-delay', type=float, default=60, help='mean seconds until an SSM agent registers')
+    parser.add_argument('--command-duration', type=float, default=240, help='mean seconds a setup command runs')
+    parser.add_argument('--rotation-duration', type=float, default=30, help='mean seconds a rotation or update command runs')
+    parser.add_argument('--api-latency', type=float, default=30, help='milliseconds per API request')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of API requests throttled')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of command invocations that fail')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print one JSON result per scenario')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    results = [run_scenario(name, args) for name in args.scenario or SCENARIOS]
+
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+        return
+
+    print(f"{'scenario':<22}{'wall ms':>9}{'sim s':>9}{'invokes':>9}{'billed s':>10}"
+          f"{'transitions':>13}{'api calls':>11}{'polls':>7}{'throttled':>11}  outcomes")
+    for r in results:
+        print(f"{r['scenario']:<22}{r['wall_ms']:>9.0f}{r['simulated_s']:>9.1f}{r['invocations']:>9}"
+              f"{r['billed_ms'] / 1000:>10.1f}{r['transitions']:>13}{r['api_calls']:>11}{r['polls']:>7}"
+              f"{r['throttled']:>11}  {r['outcomes']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Benchmark for bucket_inventory.py against the versioned S3 listing stand-in in fake_aws.py.
+
+Builds commit, fs and block buckets shaped like a Seafile deployment's, with <repo_id>/<object_id>
+keys, noncurrent versions and delete markers. The block bucket is dominated by one large
+repository. The script then scans the buckets three times:
+    serial     one worker and one shard per bucket, the equivalent of a single listing pass
+    parallel   --workers workers over hex prefix shards, splitting shards as workers go idle
+    resumed    the parallel scan interrupted after half its list calls, then resumed from its checkpoint
+Every scan's totals are checked against the generated buckets. The script reports wall time,
+list calls and shard splits.
+
+Usage:
+    python benchmarks/bench_inventory.py [--objects 200000] [--workers 16] [--latency 20] [--json]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(BENCH_DIR), BENCH_DIR]
+
+REGION = 'ap-southeast-1'
+
+import aws_clients  # noqa: E402
+import bucket_inventory  # noqa: E402
+from fake_aws import FakeS3  # noqa: E402
+
+BUCKETS = {'commit': 'bench-commit', 'fs': 'bench-fs', 'block': 'bench-block'}
+
+
+def generate(objects, seed=0):
+    # {bucket name: entries} and the expected totals per role
+    rng = random.Random(seed)
+    repos = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(200)]
+    shares = {'commit': 0.1, 'fs': 0.2, 'block': 0.7}
+    buckets, expected = {}, {}
+    for role, share in shares.items():
+        entries = []
+        totals = {'objects': 0, 'bytes': 0, 'noncurrent_versions': 0, 'noncurrent_bytes': 0, 'delete_markers': 0}
+        for index in range(int(objects * share)):
+            # Block storage is skewed towards one large repository
+            repo = repos[0] if role == 'block' and rng.random() < 0.6 else rng.choice(repos)
+            key = f"{repo}/{rng.getrandbits(160):040x}"
+            size = int(rng.lognormvariate(15 if role == 'block' else 8, 1.5))
+            if rng.random() < 0.02:
+                # A deleted object: a delete marker over a noncurrent version
+                entries.append({'Key': key, 'VersionId': f"v{index}d", 'IsLatest': True, 'DeleteMarker': True})
+                entries.append({'Key': key, 'VersionId': f"v{index}a", 'IsLatest': False, 'Size': size, 'StorageClass': 'STANDARD'})
+                totals['delete_markers'] += 1
+                totals['noncurrent_versions'] += 1
+                totals['noncurrent_bytes'] += size
+                continue
+            entries.append({'Key': key, 'VersionId': f"v{index}b", 'IsLatest': True, 'Size': size, 'StorageClass': 'STANDARD'})
+            totals['objects'] += 1
+            totals['bytes'] += size
+            if rng.random() < 0.2:
+                old = int(size * rng.uniform(0.5, 1.5))
+                entries.append({'Key': key, 'VersionId': f"v{index}a", 'IsLatest': False, 'Size': old, 'StorageClass': 'STANDARD'})
+                totals['noncurrent_versions'] += 1
+                totals['noncurrent_bytes'] += old
+        buckets[BUCKETS[role]] = entries
+        expected[role] = totals
+    return buckets, expected
+
+
+def scan(s3, workers, shard_depth, checkpoint=None):
+    aws_clients.reset_clients()
+    aws_clients._clients[('s3', REGION)] = s3
+    calls = s3.calls
+    started = time.perf_counter()
+    inventory = bucket_inventory.Inventory(BUCKETS, REGION, workers, shard_depth, checkpoint)
+    try:
+        inventory.run()
+    except FakeS3.Interrupted:
+        pass
+    return inventory.report(), time.perf_counter() - started, s3.calls - calls
+
+
+def check(report, expected):
+    mismatches = []
+    for role, totals in expected.items():
+        for key, value in totals.items():
+            if report['buckets'][role][key] != value:
+                mismatches.append(f"{role} {key}: {report['buckets'][role][key]} != {value}")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--objects', type=int, default=200000, help='objects across the three buckets')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--shard-depth', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=20, help='milliseconds per ListObjectVersions page')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print one JSON result per scan')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    buckets, expected = generate(args.objects, args.seed)
+    results = []
+
+    report, wall, calls = scan(FakeS3(buckets, args.latency / 1000), 1, 0)
+    results.append({'scan': 'serial', 'wall_s': wall, 'list_calls': calls, 'splits': report['splits'],
+                    'mismatches': check(report, expected)})
+    serial_calls = calls
+
+    report, wall, calls = scan(FakeS3(buckets, args.latency / 1000), args.workers, args.shard_depth)
+    results.append({'scan': 'parallel', 'wall_s': wall, 'list_calls': calls, 'splits': report['splits'],
+                    'mismatches': check(report, expected)})
+
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoint = os.path.join(directory, 'inventory.json')
+        s3 = FakeS3(buckets, args.latency / 1000, fail_after=serial_calls // 2)
+        interrupted, first_wall, _ = scan(s3, args.workers, args.shard_depth, checkpoint)
+        s3.fail_after = None
+        report, wall, calls = scan(s3, args.workers, args.shard_depth, checkpoint)
+    results.append({'scan': 'resumed', 'wall_s': first_wall + wall, 'list_calls': s3.calls, 'splits': report['splits'],
+                    'mismatches': check(report, expected) + ([] if not all(b['complete'] for b in interrupted['buckets'].values())
+                                                             else ['scan was not interrupted'])})
+
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+    else:
+        print(f"{'scan':<10}{'wall s':>9}{'list calls':>12}{'splits':>8}  totals")
+        for r in results:
+            print(f"{r['scan']:<10}{r['wall_s']:>9.2f}{r['list_calls']:>12}{r['splits']:>8}  "
+                  f"{'; '.join(r['mismatches']) or 'match'}")
+    if any(r['mismatches'] for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
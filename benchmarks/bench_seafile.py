@@ -0,0 +1,54 @@
+"""Runs seafile_benchmark.py against the local Seafile stand-in in fake_seafile.py.
+
+Uses the same client, file mix and reporting that run on a Seafile instance after setup, and
+adds the S3 requests the stand-in counts per backend bucket. Use it to check changes to the
+benchmark itself, or to see how the S3 request count of a file mix grows with file size.
+Throughput and latency here measure the local machine. They do not predict an instance's
+numbers.
+
+Usage:
+    python benchmarks/bench_seafile.py [--mix 4KiB:50,4MiB:5] [--concurrency 8] [--s3-latency 10] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(BENCH_DIR), BENCH_DIR]
+
+import seafile_benchmark  # noqa: E402
+from fake_seafile import FakeSeafile  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mix', default='4KiB:100,256KiB:40,4MiB:10,16MiB:2', help='size:count pairs')
+    parser.add_argument('--concurrency', type=int, default=seafile_benchmark.DEFAULT_CONCURRENCY)
+    parser.add_argument('--s3-latency', type=float, default=0, help='milliseconds per simulated S3 request')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    with FakeSeafile(s3_latency=args.s3_latency / 1000) as seafile:
+        client = seafile_benchmark.SeafileClient(seafile.url)
+        client.login(seafile.username, seafile.password)
+        report = seafile_benchmark.run(client, seafile_benchmark.parse_mix(args.mix), args.concurrency)
+        report['s3_requests'] = seafile.s3_requests
+        leftover = len(seafile.libraries)
+
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print(f"{'op':<10}{'size':>8}{'files':>7}{'MB/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}")
+        for r in report['results']:
+            print(f"{r['op']:<10}{r['size']:>8}{r['files']:>7}{r['mb_per_s']:>9}{r['p50_ms']!s:>9}{r['p99_ms']!s:>9}{r['errors']:>8}")
+        for bucket, counts in report['s3_requests'].items():
+            print(f"S3 {bucket:<7} {counts}")
+    for error in report['errors']:
+        print(error, file=sys.stderr)
+    if report['errors'] or leftover:
+        sys.exit(f"Benchmark reported {len(report['errors'])} errors and left {leftover} libraries behind")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""Startup benchmark for the Lambda handlers.
+
+Measures, for each handler, the module import time, the latency of the first (cold)
+invocation in a fresh interpreter and the median latency of subsequent (warm) invocations.
+AWS calls go to a local stub endpoint, so the numbers reflect client construction,
+connection reuse and handler overhead rather than network latency.
+
+Usage:
+    python benchmarks/bench_startup.py [--repeat 5] [--warm-calls 20]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HANDLERS = {
+    'lambda_function': {
+        'env': {
+            'EIP_PUBLIC_IP': '203.0.113.10',
+            'COMMIT_BUCKET': 'bench-commit',
+            'FS_BUCKET': 'bench-fs',
+            'BLOCK_BUCKET': 'bench-block'
+        },
+        # A poll step makes one GetCommandInvocation call and tags the instance
+        'event': {'action': 'poll', 'instance_id': 'i-0bench', 'command_id': '00000000-0000-4000-8000-000000000000', 'deadline': 4102444800}
+    },
+    'rotate_keys_lambda': {
+        'env': {'INSTANCE_ID': 'i-0bench'},
+        'event': {}
+    },
+    'update_config_lambda': {
+        'env': {
+            'INSTANCE_ID': 'i-0bench',
+            'COMMIT_BUCKET': 'bench-commit',
+            'FS_BUCKET': 'bench-fs',
+            'BLOCK_BUCKET': 'bench-block'
+        },
+        'event': {}
+    }
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Minimal SSM (JSON protocol) and EC2 (query protocol) responses
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        target = self.headers.get('X-Amz-Target', '')
+        if target.endswith('.SendCommand'):
+            self._reply('application/x-amz-json-1.1', json.dumps({'Command': {'CommandId': '00000000-0000-4000-8000-000000000000'}}))
+        elif target.endswith('.GetParameters'):
+            credentials = json.dumps({'access_key_id': 'AKIABENCH', 'secret_access_key': 'bench'})
+            self._reply('application/x-amz-json-1.1', json.dumps({
+                'Parameters': [{'Name': '/seafile/iam_user/credentials', 'Value': credentials}],
+                'InvalidParameters': []
+            }))
+        elif target.endswith('.GetCommandInvocation'):
+            self._reply('application/x-amz-json-1.1', json.dumps({'Status': 'Success'}))
+        elif b'Action=CreateTags' in body or b'Action=DescribeTags' in body:
+            self._reply('text/xml', '<Response><return>true</return><tagSet/></Response>')
+        else:
+            self._reply('application/x-amz-json-1.1', '{}')
+
+    def _reply(self, content_type, payload):
+        data = payload.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_child(module_name, warm_calls):
+    # Runs inside a fresh interpreter so the first call is a genuine cold start
+    sys.path.insert(0, REPO_ROOT)
+    spec = HANDLERS[module_name]
+
+    started = time.perf_counter()
+    module = __import__(module_name)
+    import_ms = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    result = module.lambda_handler(dict(spec['event']), None)
+    cold_ms = (time.perf_counter() - started) * 1000
+    # 202: the rotation and update handlers return once their command is sent
+    if isinstance(result, dict) and result.get('statusCode', 200) not in (200, 202):
+        raise RuntimeError(f"{module_name} returned {result}")
+
+    warm = []
+    for _ in range(warm_calls):
+        started = time.perf_counter()
+        module.lambda_handler(dict(spec['event']), None)
+        warm.append((time.perf_counter() - started) * 1000)
+
+    print(json.dumps({'import_ms': import_ms, 'cold_ms': cold_ms, 'warm_ms': statistics.median(warm)}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per handler')
+    parser.add_argument('--warm-calls', type=int, default=20, help='warm invocations per interpreter')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.warm_calls)
+        return
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+
+    print(f"{'handler':<24}{'import ms':>12}{'cold ms':>12}{'warm ms':>12}")
+    for module_name, spec in HANDLERS.items():
+        env = {
+            **os.environ,
+            **spec['env'],
+            'REGION': 'ap-southeast-1',
+            'AWS_ENDPOINT_URL': endpoint,
+            'AWS_ACCESS_KEY_ID': 'bench',
+            'AWS_SECRET_ACCESS_KEY': 'bench',
+            'AWS_EC2_METADATA_DISABLED': 'true'
+        }
+        samples = []
+        for _ in range(args.repeat):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--child', module_name, '--warm-calls', str(args.warm_calls)],
+                env=env, check=True, capture_output=True, text=True
+            ).stdout
+            samples.append(json.loads(output.strip().splitlines()[-1]))
+        print(f"{module_name:<24}"
+              f"{statistics.median(s['import_ms'] for s in samples):>12.1f}"
+              f"{statistics.median(s['cold_ms'] for s in samples):>12.1f}"
+              f"{statistics.median(s['warm_ms'] for s in samples):>12.1f}")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,610 @@
+"""In-process EC2, SSM, CloudWatch Logs and metrics, Step Functions, DynamoDB and S3 object stand-ins for benchmarking the
+Lambda handlers, and an S3 version listing stand-in for the bucket inventory.
+
+A FakeAWS world models instances whose SSM agents register after a configurable delay and
+Run Command invocations that queue, execute and finish on a virtual clock. Every API call
+costs simulated latency, can be throttled (retried the way the adaptive botocore retry mode
+would, up to its max_attempts) and is counted per operation. The handlers' own sleeps
+advance the virtual clock instead of blocking, so a scenario that spans minutes of
+provisioning runs in well under a second of wall time.
+"""
+import base64
+import bisect
+import io
+import json
+import random
+import re
+import tarfile
+import time
+import types
+import uuid
+from datetime import datetime, timezone
+
+INVOCATION_PAGE_SIZE = 50  # ListCommandInvocations default MaxResults
+
+
+class VirtualClock:
+    # Real elapsed time plus every second skipped by sleep()/advance_to(), so handler compute
+    # still counts towards simulated durations while waits cost nothing
+    def __init__(self, start=None):
+        self._origin = time.perf_counter()
+        self._start = time.time() if start is None else start
+        self.skipped = 0.0
+
+    def time(self):
+        return self._start + (time.perf_counter() - self._origin) + self.skipped
+
+    monotonic = time
+    perf_counter = time
+
+    def sleep(self, seconds):
+        self.skipped += max(0.0, seconds)
+
+    def advance_to(self, timestamp):
+        self.sleep(timestamp - self.time())
+
+    def isoformat(self, timestamp=None):
+        value = datetime.fromtimestamp(self.time() if timestamp is None else timestamp, timezone.utc)
+        return value.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class FakeContext:
+    # The part of the Lambda context object the handlers use
+    def __init__(self, clock, timeout_seconds=600):
+        self._clock = clock
+        self._deadline = clock.time() + timeout_seconds
+        self.aws_request_id = str(uuid.uuid4())
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - self._clock.time()) * 1000))
+
+
+def install_clock(clock, modules):
+    # Point each module's `time` (and ssm_readiness' `datetime`) at the virtual clock
+    class VirtualDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.fromtimestamp(clock.time(), tz)
+
+    shim = types.SimpleNamespace(time=clock.time, monotonic=clock.monotonic,
+                                 perf_counter=clock.perf_counter, sleep=clock.sleep)
+    for module in modules:
+        if hasattr(module, 'time'):
+            module.time = shim
+        if hasattr(module, 'seconds_since'):
+            module.datetime = VirtualDatetime
+
+
+class Scenario:
+    # Knobs for the simulated world; durations are in seconds
+    def __init__(self, agent_delay=60, queue_delay=1.5, command_duration=240, api_latency=0.03,
+                 throttle_rate=0.0, failure_rate=0.0, visibility_delay=0.5, max_attempts=8, metrics_delay=180):
+        self.agent_delay = agent_delay
+        self.queue_delay = queue_delay
+        self.command_duration = command_duration
+        self.api_latency = api_latency
+        self.throttle_rate = throttle_rate
+        self.failure_rate = failure_rate
+        self.visibility_delay = visibility_delay
+        self.max_attempts = max_attempts
+        # Until S3 request metrics for a minute can be read
+        self.metrics_delay = metrics_delay
+
+
+class FakeAWS:
+    def __init__(self, scenario, clock=None, seed=0):
+        self.scenario = scenario
+        self.clock = clock or VirtualClock()
+        self.random = random.Random(seed)
+        self.instances = {}
+        self.commands = {}
+        self.executions = []
+        self.parameters = {}
+        self.items = {}
+        self.objects = {}
+        self.calls = {}
+        self.throttled = 0
+        self._ids = 0
+
+    def _next_id(self, prefix):
+        self._ids += 1
+        if prefix == 'command':
+            return f"00000000-0000-4000-8000-{self._ids:012d}"
+        return f"{prefix}-{self._ids:017x}"
+
+    def launch(self, count=1, pending=True):
+        # Start instances now; each agent registers after a jittered agent_delay
+        now = self.clock.time()
+        launched = []
+        for _ in range(count):
+            instance_id = self._next_id('i')
+            self.instances[instance_id] = {
+                'launched_at': now,
+                'agent_online_at': now + self.scenario.agent_delay * self.random.uniform(0.5, 1.5),
+                'tags': {'SetupPending': 'true' if pending else 'false'}
+            }
+            launched.append(instance_id)
+        return launched
+
+    def rotate_credentials(self):
+        # What the key rotation script leaves in Parameter Store
+        self.parameters['/seafile/iam_user/credentials'] = json.dumps({
+            'access_key_id': 'AKIA' + self._next_id('key')[4:].upper(),
+            'secret_access_key': self._next_id('secret')
+        })
+
+    def agent_online(self, instance_id):
+        instance = self.instances.get(instance_id)
+        return instance is not None and self.clock.time() >= instance['agent_online_at']
+
+    def call(self, operation):
+        # Account for one API request: latency, throttling with client-side retries, counting
+        from botocore.exceptions import ClientError
+
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+        for attempt in range(self.scenario.max_attempts):
+            self.clock.sleep(self.scenario.api_latency)
+            if self.random.random() >= self.scenario.throttle_rate:
+                return
+            self.throttled += 1
+            # Exponential backoff with full jitter, capped at 20 seconds, as botocore retries do
+            self.clock.sleep(self.random.uniform(0, min(20, 2 ** attempt)))
+        raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, operation)
+
+    def task_script(self, command):
+        # The script a remote task command runs, read from the task bundle the command fetches
+        # from S3 or carries inline; any other command is its own script
+        reference = re.search(r's3://([^/\s]+)/(\S+)', command)
+        inline = re.search(r"echo '([A-Za-z0-9+/=]+)' \| base64 -d", command)
+        if reference:
+            bundle = self.objects[(reference.group(1), reference.group(2))]
+        elif inline:
+            bundle = base64.b64decode(inline.group(1))
+        else:
+            return command
+        with tarfile.open(fileobj=io.BytesIO(bundle)) as tar:
+            return '\n'.join(tar.extractfile(member).read().decode() for member in tar.getmembers()
+                             if member.name.startswith('opt/seafile/tasks/'))
+
+    def run_command(self, command, instance_ids, max_concurrency='50', timeout=3600):
+        # Schedule the command on each reachable instance, in waves of max_concurrency. An
+        # invocation that cannot start within timeout seconds is never run, as in SSM.
+        script = self.task_script(command)
+        if max_concurrency.endswith('%'):
+            concurrency = max(1, len(instance_ids) * int(max_concurrency[:-1]) // 100)
+        else:
+            concurrency = max(1, int(max_concurrency))
+        # Phases run by provisioner.py (--step) or inline (begin_phase), simulated one after another
+        phases = re.findall(r'--step (\w+)', script) or re.findall(r'^\s*begin_phase (\w+)\s*$', script, re.MULTILINE)
+        now = self.clock.time()
+        command_id = self._next_id('command')
+        invocations = {}
+        for index, instance_id in enumerate(instance_ids):
+            start = now + self.scenario.queue_delay + (index // concurrency) * self.scenario.command_duration
+            duration = self.scenario.command_duration * self.random.uniform(0.8, 1.2)
+            failed = self.random.random() < self.scenario.failure_rate
+            invocations[instance_id] = {
+                'sent_at': now,
+                'delivery_deadline': now + timeout,
+                'start': start,
+                'end': start + duration,
+                'failed_phase': self.random.choice(phases) if failed and phases else ('script' if failed else None),
+                'phases': phases,
+                'provisioned': '--step ' in script,
+                'benchmark': 'seafile_benchmark.py' in script,
+                'unavailable_ms': self.random.randint(3000, 9000) if '::rollover' in script else None
+            }
+        self.commands[command_id] = invocations
+        return command_id
+
+    def invocation(self, command_id, instance_id):
+        invocation = self.commands[command_id][instance_id]
+        now = self.clock.time()
+        if now < invocation['sent_at'] + self.scenario.visibility_delay:
+            return None
+        result = {'CommandId': command_id, 'InstanceId': instance_id}
+        if invocation['start'] > invocation['delivery_deadline'] and now >= invocation['delivery_deadline']:
+            return {**result, 'Status': 'DeliveryTimedOut'}
+        if now < invocation['start']:
+            return {**result, 'Status': 'Pending'}
+        if now < invocation['end']:
+            return {**result, 'Status': 'InProgress', 'ExecutionStartDateTime': self.clock.isoformat(invocation['start'])}
+
+        output = self.output(command_id, instance_id)
+        return {
+            **result,
+            'Status': 'Failed' if invocation['failed_phase'] else 'Success',
+            'StandardOutputContent': '\n'.join(output['stdout']) + '\n',
+            'StandardErrorContent': '\n'.join(output['stderr']),
+            'ExecutionStartDateTime': self.clock.isoformat(invocation['start']),
+            'ExecutionEndDateTime': self.clock.isoformat(invocation['end'])
+        }
+
+    def finished_at(self, command_id, instance_id):
+        # When the invocation reaches its final status
+        invocation = self.commands[command_id][instance_id]
+        if invocation['start'] > invocation['delivery_deadline']:
+            return invocation['delivery_deadline']
+        return invocation['end']
+
+    def status_change_event(self, command_id, instance_id):
+        # EventBridge "EC2 Command Invocation Status-change Notification" for the invocation's current status
+        invocation = self.commands[command_id][instance_id]
+        return {
+            'id': self._next_id('event'),
+            'source': 'aws.ssm',
+            'detail-type': 'EC2 Command Invocation Status-change Notification',
+            'time': self.clock.isoformat()[:19] + 'Z',
+            'detail': {
+                'command-id': command_id,
+                'document-name': 'AWS-RunShellScript',
+                'instance-id': instance_id,
+                'requested-date-time': self.clock.isoformat(invocation['sent_at']),
+                'status': self.invocation(command_id, instance_id)['Status']
+            }
+        }
+
+    def output(self, command_id, instance_id):
+        # {stream: lines} written so far; the execution time is spread evenly over the phases
+        # the script declares and each phase marker appears when its phase ends
+        invocation = self.commands[command_id][instance_id]
+        now = self.clock.time()
+        phases = invocation['phases'] or ['script']
+        share = (invocation['end'] - invocation['start']) / len(phases)
+        output = {'stdout': [], 'stderr': []}
+        for index, name in enumerate(phases):
+            if now < invocation['start'] + share * (index + 1):
+                return output
+            if name == invocation['failed_phase']:
+                output['stdout'].append(f"::phase name={name} status=failed duration_ms={int(share * 1000)}")
+                output['stderr'].append(f"simulated failure in {name}")
+                return output
+            output['stdout'].append(f"::phase name={name} status=completed duration_ms={int(share * 1000)}")
+        if invocation['provisioned']:
+            duration_ms = int((invocation['end'] - invocation['start']) * 1000)
+            output['stdout'].append(f"::critical_path duration_ms={duration_ms} wall_ms={duration_ms} "
+                                    f"serial_ms={duration_ms} phases={'>'.join(phases)}")
+        if invocation['benchmark'] and not invocation['failed_phase']:
+            for operation, mb_per_s in (('upload', 42.0), ('download', 97.5)):
+                output['stdout'].append(f"::benchmark op={operation} size=4MiB files=10 bytes=41943040 seconds=1.0 "
+                                        f"mb_per_s={mb_per_s} p50_ms=310.2 p99_ms=402.7 errors=0")
+            output['stdout'].append(f"::benchmark_window start={int(invocation['start'])} end={int(invocation['end']) + 1}")
+        if invocation['unavailable_ms'] is not None:
+            output['stdout'].append(
+                f"::rollover mode=rolling verify_ms={int(share * 1000)} unavailable_ms={invocation['unavailable_ms']}")
+        return output
+
+    def clients(self):
+        return {
+            'ssm': FakeSSM(self),
+            'ec2': FakeEC2(self),
+            'stepfunctions': FakeStepFunctions(self),
+            'logs': FakeLogs(self),
+            'cloudwatch': FakeCloudWatch(self),
+            'dynamodb': FakeDynamoDB(self),
+            's3': FakeObjectStore(self)
+        }
+
+
+class FakePaginator:
+    def __init__(self, fetch_page):
+        self._fetch_page = fetch_page
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            page, token = self._fetch_page(token, **kwargs)
+            yield page
+            if token is None:
+                return
+
+
+class FakeSSM:
+    class exceptions:
+        class InvocationDoesNotExist(Exception):
+            pass
+
+        class InvalidInstanceId(Exception):
+            pass
+
+    def __init__(self, world):
+        self.world = world
+
+    def describe_instance_information(self, Filters):
+        self.world.call('DescribeInstanceInformation')
+        instance_ids = next(f['Values'] for f in Filters if f['Key'] == 'InstanceIds')
+        return {'InstanceInformationList': [
+            {'InstanceId': instance_id, 'PingStatus': 'Online'}
+            for instance_id in instance_ids if self.world.agent_online(instance_id)
+        ]}
+
+    def send_command(self, DocumentName, Parameters, InstanceIds=None, Targets=None,
+                     MaxConcurrency='50', TimeoutSeconds=3600, **kwargs):
+        self.world.call('SendCommand')
+        if InstanceIds:
+            for instance_id in InstanceIds:
+                if not self.world.agent_online(instance_id):
+                    raise self.exceptions.InvalidInstanceId(instance_id)
+            targets = InstanceIds
+        else:
+            # Tag targets only reach instances whose agent is already registered
+            key = Targets[0]['Key'].split(':', 1)[1]
+            values = Targets[0]['Values']
+            targets = [
+                instance_id for instance_id, instance in self.world.instances.items()
+                if instance['tags'].get(key) in values and self.world.agent_online(instance_id)
+            ]
+        command_id = self.world.run_command(Parameters['commands'][0], targets, MaxConcurrency, TimeoutSeconds)
+        return {'Command': {'CommandId': command_id}}
+
+    def get_parameters(self, Names, WithDecryption=False):
+        self.world.call('GetParameters')
+        return {
+            'Parameters': [{'Name': name, 'Value': self.world.parameters[name]} for name in Names if name in self.world.parameters],
+            'InvalidParameters': [name for name in Names if name not in self.world.parameters]
+        }
+
+    def put_parameter(self, Name, Value, Type='String', Overwrite=False):
+        self.world.call('PutParameter')
+        self.world.parameters[Name] = Value
+        return {'Version': 1}
+
+    def get_command_invocation(self, CommandId, InstanceId):
+        self.world.call('GetCommandInvocation')
+        result = self.world.invocation(CommandId, InstanceId)
+        if result is None:
+            raise self.exceptions.InvocationDoesNotExist(CommandId)
+        return result
+
+    def _list_command_invocations(self, token, CommandId, Details=False):
+        self.world.call('ListCommandInvocations')
+        instance_ids = sorted(self.world.commands[CommandId])
+        start = token or 0
+        invocations = []
+        for instance_id in instance_ids[start:start + INVOCATION_PAGE_SIZE]:
+            result = self.world.invocation(CommandId, instance_id)
+            if result is None:
+                continue
+            invocation = {'CommandId': CommandId, 'InstanceId': instance_id, 'Status': result['Status']}
+            if Details:
+                invocation['CommandPlugins'] = [{
+                    'Output': result.get('StandardOutputContent', ''),
+                    'ResponseStartDateTime': result.get('ExecutionStartDateTime'),
+                    'ResponseFinishDateTime': result.get('ExecutionEndDateTime')
+                }]
+            invocations.append(invocation)
+        end = start + INVOCATION_PAGE_SIZE
+        return {'CommandInvocations': invocations}, (end if end < len(instance_ids) else None)
+
+    def get_paginator(self, operation):
+        if operation != 'list_command_invocations':
+            raise NotImplementedError(operation)
+        return FakePaginator(self._list_command_invocations)
+
+
+class FakeEC2:
+    def __init__(self, world):
+        self.world = world
+
+    def describe_tags(self, Filters):
+        self.world.call('DescribeTags')
+        values = {f['Name']: f['Values'] for f in Filters}
+        tags = []
+        for instance_id in values.get('resource-id', []):
+            instance = self.world.instances.get(instance_id)
+            for key in values.get('key', []):
+                value = instance['tags'].get(key) if instance else None
+                if value is not None and value in values.get('value', [value]):
+                    tags.append({'ResourceId': instance_id, 'Key': key, 'Value': value})
+        return {'Tags': tags}
+
+    def create_tags(self, Resources, Tags):
+        self.world.call('CreateTags')
+        for instance_id in Resources:
+            self.world.instances[instance_id]['tags'].update({tag['Key']: tag['Value'] for tag in Tags})
+
+    def _describe_instances(self, token, Filters):
+        self.world.call('DescribeInstances')
+        tag_filters = {f['Name'][4:]: f['Values'] for f in Filters if f['Name'].startswith('tag:')}
+        instances = [
+            {'InstanceId': instance_id}
+            for instance_id, instance in self.world.instances.items()
+            if all(instance['tags'].get(key) in values for key, values in tag_filters.items())
+        ]
+        return {'Reservations': [{'Instances': instances}]}, None
+
+    def get_paginator(self, operation):
+        if operation != 'describe_instances':
+            raise NotImplementedError(operation)
+        return FakePaginator(self._describe_instances)
+
+
+class FakeStepFunctions:
+    def __init__(self, world):
+        self.world = world
+
+    def start_execution(self, stateMachineArn, input):
+        self.world.call('StartExecution')
+        self.world.executions.append(input)
+        return {'executionArn': f"{stateMachineArn}:execution-{len(self.world.executions)}"}
+
+
+class FakeLogs:
+    # CloudWatch Logs output streams named <command-id>/<instance-id>/<plugin>/<stdout|stderr>,
+    # one event per line; forward tokens are event offsets
+    class exceptions:
+        class ResourceNotFoundException(Exception):
+            pass
+
+    def __init__(self, world):
+        self.world = world
+
+    def get_log_events(self, logGroupName, logStreamName, startFromHead=False, nextToken=None, limit=10000):
+        self.world.call('GetLogEvents')
+        command_id, instance_id, _, stream = logStreamName.split('/')
+        invocations = self.world.commands.get(command_id, {})
+        if instance_id not in invocations or self.world.clock.time() < invocations[instance_id]['start']:
+            raise self.exceptions.ResourceNotFoundException(logStreamName)
+        lines = self.world.output(command_id, instance_id)[stream]
+        if not startFromHead:
+            lines = lines[-limit:]
+            return {'events': [{'message': line} for line in lines], 'nextForwardToken': f"f/{len(lines)}"}
+        start = int(nextToken.split('/')[1]) if nextToken else 0
+        events = lines[start:start + limit]
+        return {'events': [{'message': line} for line in events], 'nextForwardToken': f"f/{start + len(events)}"}
+
+
+class FakeCloudWatch:
+    # S3 request metrics for the minutes benchmark commands ran in, readable metrics_delay
+    # seconds after each minute; every bucket sees the same per-minute counts
+    REQUESTS_PER_MINUTE = {'AllRequests': 120, 'GetRequests': 50, 'PutRequests': 70}
+
+    def __init__(self, world):
+        self.world = world
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, NextToken=None):
+        self.world.call('GetMetricData')
+        readable = self.world.clock.time() - self.world.scenario.metrics_delay
+        minutes = set()
+        for invocations in self.world.commands.values():
+            for invocation in invocations.values():
+                if invocation['benchmark']:
+                    minutes.update(range(int(invocation['start']) // 60 * 60, int(invocation['end']) + 1, 60))
+        minutes = sorted(minute for minute in minutes if StartTime <= minute < EndTime and minute <= readable)
+        return {'MetricDataResults': [
+            {
+                'Id': query['Id'],
+                'Timestamps': [datetime.fromtimestamp(minute, timezone.utc) for minute in minutes],
+                'Values': [float(self.REQUESTS_PER_MINUTE[query['MetricStat']['Metric']['MetricName']])] * len(minutes)
+            }
+            for query in MetricDataQueries
+        ]}
+
+
+class FakeDynamoDB:
+    # Low-level DynamoDB item API for single-table, hash-key-only access. Condition expressions
+    # support the forms the event ledger uses: OR-ed attribute_not_exists(a), a < :v and a = :v
+    # terms, with #names resolved from ExpressionAttributeNames.
+    class exceptions:
+        class ConditionalCheckFailedException(Exception):
+            pass
+
+    def __init__(self, world):
+        self.world = world
+
+    @staticmethod
+    def _value(attribute):
+        (kind, value), = attribute.items()
+        return float(value) if kind == 'N' else value
+
+    def _check(self, item, condition, names, values):
+        if not condition:
+            return
+        for term in condition.split(' OR '):
+            match = re.fullmatch(r'attribute_not_exists\((\S+)\)|(\S+) ([<=]) (:\w+)', term.strip())
+            if match.group(1):
+                if item is None or names.get(match.group(1), match.group(1)) not in item:
+                    return
+                continue
+            name = names.get(match.group(2), match.group(2))
+            if item is None or name not in item:
+                continue
+            current, expected = self._value(item[name]), self._value(values[match.group(4)])
+            if (current < expected) if match.group(3) == '<' else (current == expected):
+                return
+        raise self.exceptions.ConditionalCheckFailedException(condition)
+
+    def _key(self, TableName, Key):
+        (name, attribute), = Key.items()
+        return TableName, name, self._value(attribute)
+
+    def get_item(self, TableName, Key, ConsistentRead=False):
+        self.world.call('GetItem')
+        item = self.world.items.get(self._key(TableName, Key))
+        return {'Item': dict(item)} if item else {}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None):
+        self.world.call('PutItem')
+        key = self._key(TableName, {'target': Item['target']})
+        self._check(self.world.items.get(key), ConditionExpression, ExpressionAttributeNames or {}, ExpressionAttributeValues or {})
+        self.world.items[key] = dict(Item)
+        return {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None):
+        self.world.call('UpdateItem')
+        key = self._key(TableName, Key)
+        item = self.world.items.get(key)
+        names, values = ExpressionAttributeNames or {}, ExpressionAttributeValues or {}
+        self._check(item, ConditionExpression, names, values)
+        item = dict(item or Key)
+        for assignment in UpdateExpression[len('SET '):].split(','):
+            name, value = (part.strip() for part in assignment.split('='))
+            item[names.get(name, name)] = values[value]
+        self.world.items[key] = item
+        return {}
+
+    def delete_item(self, TableName, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None):
+        self.world.call('DeleteItem')
+        key = self._key(TableName, Key)
+        self._check(self.world.items.get(key), ConditionExpression, ExpressionAttributeNames or {}, ExpressionAttributeValues or {})
+        self.world.items.pop(key, None)
+        return {}
+
+
+class FakeObjectStore:
+    # PutObject into the world's objects, where remote task commands fetch their bundles from
+    def __init__(self, world):
+        self.world = world
+
+    def put_object(self, Bucket, Key, Body):
+        self.world.call('PutObject')
+        self.world.objects[(Bucket, Key)] = Body
+        return {}
+
+
+class FakeS3:
+    # ListObjectVersions over in-memory versioned buckets: {bucket: [version entries]}, each entry
+    # {'Key', 'VersionId', 'IsLatest', 'Size', 'StorageClass'} or a delete marker ('DeleteMarker': True).
+    # Unlike the handler stand-ins it sleeps for real, so parallel listings overlap the way they
+    # would against S3. fail_after raises after that many list calls, to interrupt a scan.
+    class Interrupted(Exception):
+        pass
+
+    def __init__(self, buckets, latency=0.02, fail_after=None):
+        self.buckets = {name: sorted(entries, key=lambda entry: (entry['Key'], not entry['IsLatest'], entry['VersionId']))
+                        for name, entries in buckets.items()}
+        self._keys = {name: [entry['Key'] for entry in entries] for name, entries in self.buckets.items()}
+        self.latency = latency
+        self.fail_after = fail_after
+        self.calls = 0
+
+    def list_object_versions(self, Bucket, MaxKeys=1000, KeyMarker=None, VersionIdMarker=None):
+        self.calls += 1
+        if self.fail_after is not None and self.calls > self.fail_after:
+            raise self.Interrupted(f"interrupted after {self.fail_after} list calls")
+        time.sleep(self.latency)
+        entries, keys = self.buckets[Bucket], self._keys[Bucket]
+        if KeyMarker is None:
+            start = 0
+        elif VersionIdMarker is None:
+            start = bisect.bisect_right(keys, KeyMarker)
+        else:
+            start = bisect.bisect_left(keys, KeyMarker)
+            while start < len(entries) and entries[start]['Key'] == KeyMarker and entries[start]['VersionId'] != VersionIdMarker:
+                start += 1
+            start += 1
+        page = entries[start:start + MaxKeys]
+        response = {
+            'Versions': [{key: value for key, value in entry.items() if key != 'DeleteMarker'}
+                         for entry in page if not entry.get('DeleteMarker')],
+            'DeleteMarkers': [{'Key': entry['Key'], 'VersionId': entry['VersionId'], 'IsLatest': entry['IsLatest']}
+                              for entry in page if entry.get('DeleteMarker')],
+            'IsTruncated': start + MaxKeys < len(entries)
+        }
+        if response['IsTruncated']:
+            response['NextKeyMarker'] = page[-1]['Key']
+            response['NextVersionIdMarker'] = page[-1]['VersionId']
+        return response
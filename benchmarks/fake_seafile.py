@@ -0,0 +1,195 @@
+"""Local stand-in for the part of the Seafile web API that seafile_benchmark.py uses.
+
+FakeSeafile serves token login, library creation and deletion, upload links with multipart
+uploads, and download links from memory on a local port. It also models the S3 requests a
+Seafile server with S3 storage backends would make, counted per backend bucket. An upload
+writes one block object per 8 MiB chunk, two fs objects (the file and the new root directory)
+and one commit. A download reads the head commit, the same two fs objects and every block.
+Each simulated S3 request can add a fixed latency. Upload and download links advertise a
+public address the way a real server's FILE_SERVER_ROOT does, so the client's rewrite back to
+the local address is exercised too.
+"""
+import json
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BLOCK_SIZE = 8 * 1024 * 1024  # Seafile's default block size for web uploads
+ADVERTISED_HOST = '203.0.113.10'
+
+
+class FakeSeafile:
+    def __init__(self, username='admin@example.com', password='benchmark', s3_latency=0.0):
+        self.username = username
+        self.password = password
+        self.s3_latency = s3_latency
+        self.libraries = {}
+        self.links = {}
+        self.tokens = set()
+        self.s3_requests = {bucket: {'GetRequests': 0, 'PutRequests': 0, 'AllRequests': 0} for bucket in ('commit', 'fs', 'block')}
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def __enter__(self):
+        world = self
+
+        class Handler(SeafileHandler):
+            seafile = world
+
+        self._server = SeafileServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def s3(self, bucket, operation, count=1):
+        # Account for count simulated requests against one backend bucket
+        with self._lock:
+            self.s3_requests[bucket][operation] += count
+            self.s3_requests[bucket]['AllRequests'] += count
+        time.sleep(self.s3_latency * count)
+
+    def link(self, kind, repo_id, name=None):
+        token = uuid.uuid4().hex
+        with self._lock:
+            self.links[token] = (repo_id, name)
+        path = f"/seafhttp/{kind}/{token}" + (f"/{urllib.parse.quote(name)}" if name else '')
+        return f"http://{ADVERTISED_HOST}{path}"
+
+
+class SeafileServer(ThreadingHTTPServer):
+    # A deeper accept backlog than the default 5, so concurrent clients are not left retrying connects
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class SeafileHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    seafile = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, body, status=200, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _authorized(self):
+        if self.headers.get('Authorization', '')[len('Token '):] in self.seafile.tokens:
+            return True
+        self._reply({'detail': 'Invalid token'}, 401)
+        return False
+
+    def _repo(self, parts):
+        repo_id = parts[2] if len(parts) > 2 else None
+        if repo_id not in self.seafile.libraries:
+            self._reply({'error_msg': 'Library not found.'}, 404)
+            return None
+        return repo_id
+
+    def _link_target(self, token):
+        target = self.seafile.links.get(token)
+        if target is None or target[0] not in self.seafile.libraries:
+            self._reply({'error_msg': 'Link not found.'}, 404)
+        return target
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        body = self._body()
+        if url.path == '/api2/auth-token/':
+            form = urllib.parse.parse_qs(body.decode())
+            if form.get('username') != [self.seafile.username] or form.get('password') != [self.seafile.password]:
+                return self._reply({'non_field_errors': ['Unable to login with provided credentials.']}, 400)
+            token = uuid.uuid4().hex
+            self.seafile.tokens.add(token)
+            return self._reply({'token': token})
+        if url.path == '/api2/repos/':
+            if not self._authorized():
+                return
+            repo_id = str(uuid.uuid4())
+            self.seafile.libraries[repo_id] = {}
+            # The initial commit and its empty root directory
+            self.seafile.s3('commit', 'PutRequests')
+            self.seafile.s3('fs', 'PutRequests')
+            return self._reply({'repo_id': repo_id, 'repo_name': urllib.parse.parse_qs(body.decode()).get('name', [''])[0]})
+        if parts[:2] == ['seafhttp', 'upload-api']:
+            target = self._link_target(parts[2])
+            if target is None:
+                return
+            name, content = parse_upload(self.headers['Content-Type'], body)
+            self.seafile.s3('block', 'PutRequests', max(1, -(-len(content) // BLOCK_SIZE)))
+            self.seafile.s3('fs', 'PutRequests', 2)
+            self.seafile.s3('commit', 'PutRequests')
+            self.seafile.libraries[target[0]][name] = content
+            return self._reply([{'name': name, 'id': uuid.uuid4().hex, 'size': len(content)}])
+        self._reply({'error_msg': 'Not found.'}, 404)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        query = urllib.parse.parse_qs(url.query)
+        if parts[:2] == ['seafhttp', 'files']:
+            target = self._link_target(parts[2])
+            if target is None:
+                return
+            content = self.seafile.libraries[target[0]].get(target[1])
+            if content is None:
+                return self._reply({'error_msg': 'File not found.'}, 404)
+            self.seafile.s3('commit', 'GetRequests')
+            self.seafile.s3('fs', 'GetRequests', 2)
+            self.seafile.s3('block', 'GetRequests', max(1, -(-len(content) // BLOCK_SIZE)))
+            return self._reply(content, content_type='application/octet-stream')
+        if parts[:2] != ['api2', 'repos']:
+            return self._reply({'error_msg': 'Not found.'}, 404)
+        if not self._authorized():
+            return
+        repo_id = self._repo(parts)
+        if repo_id is None:
+            return
+        if parts[3:] == ['upload-link']:
+            return self._reply(self.seafile.link('upload-api', repo_id))
+        if parts[3:] == ['file']:
+            name = query.get('p', ['/'])[0].lstrip('/')
+            if name not in self.seafile.libraries[repo_id]:
+                return self._reply({'error_msg': 'File not found.'}, 404)
+            return self._reply(self.seafile.link('files', repo_id, name))
+        self._reply({'error_msg': 'Not found.'}, 404)
+
+    def do_DELETE(self):
+        parts = [part for part in urllib.parse.urlsplit(self.path).path.split('/') if part]
+        if parts[:2] != ['api2', 'repos']:
+            return self._reply({'error_msg': 'Not found.'}, 404)
+        if not self._authorized():
+            return
+        repo_id = self._repo(parts)
+        if repo_id is not None:
+            del self.seafile.libraries[repo_id]
+            self._reply('success')
+
+
+def parse_upload(content_type, body):
+    # (filename, content) of the `file` field of a multipart/form-data body
+    boundary = content_type.split('boundary=', 1)[1].encode()
+    for part in body.split(b'--' + boundary):
+        headers, _, content = part.partition(b'\r\n\r\n')
+        if b'name="file"' in headers:
+            filename = headers.split(b'filename="', 1)[1].split(b'"', 1)[0].decode()
+            return filename, content[:-2] if content.endswith(b'\r\n') else content
+    raise ValueError('Upload without a file field')
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from aws_clients import CLIENT_CONFIG_OPTIONS, get_client
+
+# Inventory and storage analytics for the Seafile commit, fs and block buckets.
+# Each bucket's keyspace is cut into shards at key prefixes (Seafile stores objects as
+# <repo_id>/<object_id>, so hex prefixes of the repo id spread the keys) and the shards are
+# listed in parallel with ListObjectVersions, which also returns the noncurrent versions and
+# delete markers that versioning keeps. A shard covers the keys after its lower bound up to and
+# including its upper bound, so the shards cover the whole keyspace whatever the keys look like.
+# When workers run out of shards, the busiest running shard is split at the midpoint of its
+# remaining range. A shard whose last page stayed inside one repository is split inside that
+# repository instead, so a single large repository does not leave the scan running on one thread.
+#
+# Pages are folded into per-shard totals as they arrive (and optionally streamed to a JSON
+# lines file), so memory use depends on the number of shards and repositories, not objects.
+# The shards' list positions and totals are checkpointed to a JSON file; rerunning with the same
+# checkpoint resumes the scan where it stopped.
+
+HEX_DIGITS = '0123456789abcdef'
+LIST_PAGE_SIZE = 1000  # ListObjectVersions maximum
+MIN_PAGES_TO_SPLIT = 2  # Pages a shard lists before it is split, and again between splits
+CHECKPOINT_INTERVAL = 30  # Seconds between checkpoint writes
+SPLIT_RETRY_INTERVAL = 0.2  # Seconds between split attempts while workers are idle
+UNITS = ['B', 'KiB', 'MiB', 'GiB', 'TiB', 'PiB']
+
+# Alphabets split points are drawn from, in order of preference: the characters of Seafile's
+# <repo uuid>/<hex object id> keys, where an even split of the alphabet is an even split of the
+# keys, then printable ASCII, which S3 markers accept as-is
+SPLIT_ALPHABETS = ['-/0123456789abcdef', ''.join(chr(code) for code in range(0x20, 0x7f))]
+
+
+def format_size(size):
+    for unit in UNITS:
+        if size < 1024 or unit == UNITS[-1]:
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def prefix_bounds(depth):
+    # Shard boundaries for hex prefixes of the given length: ['00', '01', ..., 'ff'] for depth 2
+    bounds = ['']
+    for _ in range(depth):
+        bounds = [bound + digit for bound in bounds for digit in HEX_DIGITS]
+    return [bound for bound in bounds if bound]
+
+
+def midpoint(lo, hi):
+    # A key strictly between lo and hi (None for no upper bound), or None when there is none or
+    # no split alphabet covers both keys
+    lo = lo or ''
+    for alphabet in SPLIT_ALPHABETS:
+        upper = hi if hi is not None else alphabet[-1] * (len(lo) + 1)
+        if all(char in alphabet for char in lo + upper):
+            break
+    else:
+        return None
+    base, width = len(alphabet), max(len(lo), len(upper)) + 1
+
+    def number(key):
+        value = 0
+        for char in key.ljust(width, alphabet[0]):
+            value = value * base + alphabet.index(char)
+        return value
+
+    middle = (number(lo) + number(upper)) // 2
+    chars = []
+    for _ in range(width):
+        middle, digit = divmod(middle, base)
+        chars.append(alphabet[digit])
+    key = ''.join(reversed(chars)).rstrip(alphabet[0])
+    return key if lo < key and (hi is None or key < hi) else None
+
+
+def repo_of(key):
+    return key.split('/', 1)[0] if '/' in key else ''
+
+
+def new_stats():
+    return {
+        'objects': 0,
+        'bytes': 0,
+        'noncurrent_versions': 0,
+        'noncurrent_bytes': 0,
+        'delete_markers': 0,
+        'histogram': {},  # size.bit_length() -> current objects: bucket n holds sizes in [2**(n-1), 2**n)
+        'storage_classes': {},  # storage class -> bytes of all versions
+        'repos': {}  # repo id -> [current objects, current bytes, noncurrent bytes]
+    }
+
+
+def add_page(stats, versions, delete_markers):
+    for version in versions:
+        size = version.get('Size', 0)
+        repo = stats['repos'].setdefault(repo_of(version['Key']), [0, 0, 0])
+        storage_class = version.get('StorageClass', 'STANDARD')
+        stats['storage_classes'][storage_class] = stats['storage_classes'].get(storage_class, 0) + size
+        if version.get('IsLatest', True):
+            stats['objects'] += 1
+            stats['bytes'] += size
+            bucket = str(size.bit_length())
+            stats['histogram'][bucket] = stats['histogram'].get(bucket, 0) + 1
+            repo[0] += 1
+            repo[1] += size
+        else:
+            stats['noncurrent_versions'] += 1
+            stats['noncurrent_bytes'] += size
+            repo[2] += size
+    stats['delete_markers'] += len(delete_markers)
+
+
+def merge_stats(total, stats):
+    for key in ('objects', 'bytes', 'noncurrent_versions', 'noncurrent_bytes', 'delete_markers'):
+        total[key] += stats[key]
+    for key in ('histogram', 'storage_classes'):
+        for name, value in stats[key].items():
+            total[key][name] = total[key].get(name, 0) + value
+    for repo, values in stats['repos'].items():
+        total['repos'][repo] = [a + b for a, b in zip(total['repos'].get(repo, [0, 0, 0]), values)]
+    return total
+
+
+class Inventory:
+    def __init__(self, buckets, region=None, workers=CLIENT_CONFIG_OPTIONS['max_pool_connections'], shard_depth=1,
+                 checkpoint=None, objects_path=None, page_size=LIST_PAGE_SIZE, checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.buckets = buckets
+        self.region = region
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.objects_path = objects_path
+        self.page_size = page_size
+        self.checkpoint_interval = checkpoint_interval
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._objects = None
+        self.state = self._load() or self._initial_state(shard_depth)
+
+    def _initial_state(self, shard_depth):
+        bounds = [None] + prefix_bounds(shard_depth) + [None]
+        shards = []
+        for role in self.buckets:
+            for lo, hi in zip(bounds, bounds[1:]):
+                shards.append({'role': role, 'lo': lo, 'hi': hi, 'key_marker': None, 'version_marker': None,
+                               'done': False, 'pages': 0, 'split_at': 0, 'page_repo': None, 'stats': new_stats()})
+        return {'buckets': self.buckets, 'shards': shards, 'splits': 0, 'elapsed': 0.0}
+
+    def _load(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return None
+        with open(self.checkpoint) as f:
+            state = json.load(f)
+        if state['buckets'] != self.buckets:
+            raise ValueError(f"Checkpoint {self.checkpoint} is for buckets {state['buckets']}, not {self.buckets}")
+        return state
+
+    def save(self):
+        # Written to a temporary file and renamed, so an interrupted write leaves the previous checkpoint
+        if not self.checkpoint:
+            return
+        with self._lock:
+            content = json.dumps(self.state)
+        with open(self.checkpoint + '.tmp', 'w') as f:
+            f.write(content)
+        os.replace(self.checkpoint + '.tmp', self.checkpoint)
+
+    def _stream(self, shard, versions, delete_markers):
+        for version in versions:
+            self._objects.write(json.dumps({
+                'bucket': shard['role'], 'key': version['Key'], 'version_id': version.get('VersionId'),
+                'size': version.get('Size', 0), 'latest': version.get('IsLatest', True),
+                'storage_class': version.get('StorageClass', 'STANDARD'), 'last_modified': str(version.get('LastModified'))
+            }) + '\n')
+        for marker in delete_markers:
+            self._objects.write(json.dumps({
+                'bucket': shard['role'], 'key': marker['Key'], 'version_id': marker.get('VersionId'),
+                'latest': marker.get('IsLatest', True), 'delete_marker': True
+            }) + '\n')
+
+    def scan(self, shard):
+        # List one shard page by page until its upper bound or the end of the bucket
+        s3 = get_client('s3', self.region)
+        while not self._stopping.is_set():
+            with self._lock:
+                markers = {}
+                if shard['key_marker'] or shard['lo']:
+                    markers['KeyMarker'] = shard['key_marker'] or shard['lo']
+                if shard['version_marker']:
+                    markers['VersionIdMarker'] = shard['version_marker']
+            response = s3.list_object_versions(Bucket=self.buckets[shard['role']], MaxKeys=self.page_size, **markers)
+            with self._lock:
+                # Read the bound again: the shard may have been split while the page was in flight
+                hi = shard['hi']
+                versions = [v for v in response.get('Versions', []) if hi is None or v['Key'] <= hi]
+                delete_markers = [m for m in response.get('DeleteMarkers', []) if hi is None or m['Key'] <= hi]
+                add_page(shard['stats'], versions, delete_markers)
+                if self._objects:
+                    self._stream(shard, versions, delete_markers)
+                shard['pages'] += 1
+                # Set when the whole page belonged to one repository, which may be a large one
+                keys = [entry['Key'] for entry in versions + delete_markers]
+                shard['page_repo'] = repo_of(keys[0]) if keys and '/' in keys[-1] and repo_of(keys[0]) == repo_of(keys[-1]) else None
+                past_bound = len(versions) + len(delete_markers) < len(response.get('Versions', [])) + len(response.get('DeleteMarkers', []))
+                if past_bound or not response.get('IsTruncated'):
+                    shard['done'] = True
+                    return
+                shard['key_marker'] = response.get('NextKeyMarker')
+                shard['version_marker'] = response.get('NextVersionIdMarker')
+
+    def split(self, running):
+        # Hand the upper half of the busiest running shard's remaining range to a new shard
+        with self._lock:
+            for shard in sorted(running, key=lambda shard: shard['pages'], reverse=True):
+                if shard['done'] or shard['pages'] - shard['split_at'] < MIN_PAGES_TO_SPLIT:
+                    continue
+                position, upper = shard['key_marker'] or shard['lo'], shard['hi']
+                if shard['page_repo'] is not None:
+                    # Just past the repository's last key: '0' sorts right after the '/' separator
+                    inner = shard['page_repo'] + '0'
+                    upper = inner if upper is None or inner < upper else upper
+                middle = midpoint(position, upper)
+                if middle is None:
+                    continue
+                new = {'role': shard['role'], 'lo': middle, 'hi': shard['hi'], 'key_marker': None, 'version_marker': None,
+                       'done': False, 'pages': 0, 'split_at': 0, 'page_repo': None, 'stats': new_stats()}
+                shard['hi'] = middle
+                shard['split_at'] = shard['pages']
+                self.state['shards'].append(new)
+                self.state['splits'] += 1
+                return new
+        return None
+
+    def run(self):
+        started = time.monotonic()
+        elapsed_before = self.state['elapsed']
+        last_saved = started
+        pending = deque(shard for shard in self.state['shards'] if not shard['done'])
+        running = {}
+        if self.objects_path:
+            # Appended to, so a resumed scan continues the same file; a page listed just before an
+            # interruption can appear twice
+            self._objects = open(self.objects_path, 'a')
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                try:
+                    while pending or running:
+                        while pending and len(running) < self.workers:
+                            shard = pending.popleft()
+                            running[pool.submit(self.scan, shard)] = shard
+                        if len(running) < self.workers:
+                            new = self.split(list(running.values()))
+                            if new:
+                                pending.append(new)
+                                continue
+                        finished, _ = wait(running, timeout=SPLIT_RETRY_INTERVAL, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            running.pop(future)
+                            future.result()
+                        if time.monotonic() - last_saved >= self.checkpoint_interval:
+                            self.state['elapsed'] = elapsed_before + time.monotonic() - started
+                            self.save()
+                            last_saved = time.monotonic()
+                except BaseException:
+                    # Running shards stop after their current page, before the pool is shut down
+                    self._stopping.set()
+                    raise
+        finally:
+            self.state['elapsed'] = elapsed_before + time.monotonic() - started
+            self.save()
+            if self._objects:
+                self._objects.close()
+        return self.report()
+
+    def report(self, top=10):
+        # {role: totals with the top repositories by current bytes}, plus the scan's progress
+        buckets = {}
+        for role, name in self.buckets.items():
+            shards = [shard for shard in self.state['shards'] if shard['role'] == role]
+            total = new_stats()
+            for shard in shards:
+                merge_stats(total, shard['stats'])
+            repos = sorted(total.pop('repos').items(), key=lambda item: item[1][1] + item[1][2], reverse=True)
+            buckets[role] = {
+                'bucket': name,
+                **total,
+                'repos': len(repos),
+                'top_repos': [{'repo': repo, 'objects': values[0], 'bytes': values[1], 'noncurrent_bytes': values[2]}
+                              for repo, values in repos[:top]],
+                'shards': len(shards),
+                'pages': sum(shard['pages'] for shard in shards),
+                'complete': all(shard['done'] for shard in shards)
+            }
+        return {'buckets': buckets, 'splits': self.state['splits'], 'elapsed_seconds': round(self.state['elapsed'], 1)}
+
+
+def format_report(report):
+    lines = []
+    for role, bucket in report['buckets'].items():
+        lines.append(f"{role} bucket {bucket['bucket']}{'' if bucket['complete'] else ' (incomplete)'}: "
+                     f"{bucket['objects']} objects, {format_size(bucket['bytes'])} current; "
+                     f"{bucket['noncurrent_versions']} noncurrent versions, {format_size(bucket['noncurrent_bytes'])}; "
+                     f"{bucket['delete_markers']} delete markers; {bucket['repos']} repos; "
+                     f"{bucket['pages']} pages in {bucket['shards']} shards")
+        for exponent, count in sorted(bucket['histogram'].items(), key=lambda item: int(item[0])):
+            exponent = int(exponent)
+            label = '0 B' if exponent == 0 else f"{format_size(2 ** (exponent - 1))} - {format_size(2 ** exponent)}"
+            lines.append(f"    {label:>22} {count:>12}")
+        for storage_class, size in sorted(bucket['storage_classes'].items()):
+            lines.append(f"    {storage_class}: {format_size(size)}")
+        for repo in bucket['top_repos']:
+            lines.append(f"    repo {repo['repo'] or '(no prefix)'}: {repo['objects']} objects, {format_size(repo['bytes'])} current, "
+                         f"{format_size(repo['noncurrent_bytes'])} noncurrent")
+    lines.append(f"Scanned in {report['elapsed_seconds']} s with {report['splits']} shard splits")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inventory the Seafile S3 buckets with parallel, resumable listings')
+    parser.add_argument('--bucket', action='append', default=[],
+                        help='role=name (repeatable); defaults to COMMIT_BUCKET, FS_BUCKET and BLOCK_BUCKET')
+    parser.add_argument('--region', default=os.environ.get('REGION') or os.environ.get('AWS_REGION'))
+    parser.add_argument('--workers', type=int, default=CLIENT_CONFIG_OPTIONS['max_pool_connections'],
+                        help='concurrent listings (at most the client connection pool size is useful)')
+    parser.add_argument('--shard-depth', type=int, default=1, help='hex characters per initial shard prefix (16**depth shards per bucket)')
+    parser.add_argument('--checkpoint', help='JSON file to save progress to and resume from; delete it to start over')
+    parser.add_argument('--objects', help='append one JSON line per object version to this file')
+    parser.add_argument('--top', type=int, default=10, help='repositories listed per bucket')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    if args.bucket:
+        buckets = dict(spec.split('=', 1) for spec in args.bucket)
+    else:
+        buckets = {role: os.environ.get(f"{role.upper()}_BUCKET") for role in ('commit', 'fs', 'block')}
+        buckets = {role: name for role, name in buckets.items() if name}
+    if not buckets:
+        parser.error('no buckets given; pass --bucket role=name or set COMMIT_BUCKET, FS_BUCKET and BLOCK_BUCKET')
+
+    inventory = Inventory(buckets, args.region, args.workers, args.shard_depth, args.checkpoint, args.objects)
+    try:
+        inventory.run()
+    except KeyboardInterrupt:
+        print(f"Interrupted; {'resume with --checkpoint ' + args.checkpoint if args.checkpoint else 'progress was not saved'}",
+              file=sys.stderr)
+        sys.exit(130)
+    report = inventory.report(args.top)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+
+if __name__ == '__main__':
+    main()
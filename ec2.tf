@@ -1,3 +1,25 @@
+# Complete stdout/stderr of the SSM commands the Lambda functions run on the instance
+resource "aws_cloudwatch_log_group" "ssm_command_output" {
+  name              = "/seafile/ssm-commands"
+  retention_in_days = 30
+}
+
+# Finished SSM commands on the instance. RotateKeysLambda and UpdateConfigLambda return as soon
+# as they have sent their command; this event then reports its outcome and timings, so no
+# invocation is billed while the command runs. Each function ignores commands it did not send.
+resource "aws_cloudwatch_event_rule" "seafile_command_status" {
+  name        = "SeafileCommandStatusRule"
+  description = "Report finished SSM commands on the Seafile instance to the functions that sent them"
+  event_pattern = jsonencode({
+    source      = ["aws.ssm"]
+    detail-type = ["EC2 Command Invocation Status-change Notification"]
+    detail = {
+      instance-id = [aws_instance.seafile_instance.id]
+      status      = [{ anything-but = ["Pending", "InProgress", "Delayed"] }]
+    }
+  })
+}
+
 # IAM Policy for EC2 (S3 and SSM access)
 resource "aws_iam_policy" "seafile_s3_and_ssm_access_policy" {
   name        = "SeafileS3AndSSMAccessPolicy"
@@ -10,6 +32,12 @@ resource "aws_iam_policy" "seafile_s3_and_ssm_access_policy" {
         Action   = ["s3:*"]
         Resource = ["arn:aws:s3:::seafile-storage-bucket-*", "arn:aws:s3:::seafile-storage-bucket-*/*"]
       },
+      {
+        # Remote task bundles the SSM commands download by reference
+        Effect   = "Allow"
+        Action   = ["s3:GetObject"]
+        Resource = "${aws_s3_bucket.seafile_remote_tasks.arn}/remote-tasks/*"
+      },
       {
         Effect   = "Allow"
         Action   = ["ssm:*"]
@@ -19,9 +47,21 @@ resource "aws_iam_policy" "seafile_s3_and_ssm_access_policy" {
         Effect   = "Allow"
         Action   = [
           "iam:CreateAccessKey",
-          "iam:DeleteAccessKey"
+          "iam:DeleteAccessKey",
+          "iam:ListAccessKeys"
         ]
         Resource = "arn:aws:iam::${data.aws_caller_identity.current.account_id}:user/seafile-service-account"
+      },
+      {
+        # The SSM agent streams command output to CloudWatch Logs
+        Effect   = "Allow"
+        Action   = [
+          "logs:CreateLogStream",
+          "logs:PutLogEvents",
+          "logs:DescribeLogGroups",
+          "logs:DescribeLogStreams"
+        ]
+        Resource = "*"
       }
     ]
   })
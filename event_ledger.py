@@ -0,0 +1,205 @@
+import fcntl
+import json
+import os
+import time
+import uuid
+
+from aws_clients import get_client
+
+# Deduplication and coalescing of the events that trigger remote commands.
+# EventBridge delivers at least once and several rules can fire for the same instance, so each
+# run claims a lease on its target (e.g. "setup#i-0abc") before sending an SSM command, noting
+# the event that started it, and records the command it sent. A redelivered or overlapping
+# event for the same target finds the lease and attaches to the recorded command instead of
+# starting a second one. The lease owner is the run (a Step Functions execution or a Lambda
+# request id, both stable across retries), so a retried step re-enters its own lease. Leases
+# expire so a crashed run cannot block its target forever.
+#
+# Backends: DynamoDB (EVENT_LEDGER_TABLE) for the deployed functions, a local JSON file
+# (EVENT_LEDGER_PATH) for tests and benchmarks, and a no-op ledger when neither is set.
+
+_ledgers = {}
+
+
+class NullLedger:
+    # Every claim succeeds; nothing is recorded
+    def claim(self, target, owner, lease_seconds, event=None):
+        return True, {}
+
+    def get(self, target):
+        return {}
+
+    def record_run(self, target, owner, run):
+        pass
+
+    def release(self, target, owner):
+        pass
+
+
+class FileLedger:
+    # {target: {'owner', 'event', 'expires_at', 'run'}} in a JSON file, serialised with an exclusive flock
+    def __init__(self, path):
+        self.path = path
+
+    def _locked(self, update):
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                records = json.loads(content) if content else {}
+                result = update(records)
+                f.seek(0)
+                f.truncate()
+                json.dump(records, f)
+                return result
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def claim(self, target, owner, lease_seconds, event=None):
+        def update(records):
+            record = records.get(target)
+            if record and record['expires_at'] > time.time() and record['owner'] != owner:
+                return False, record
+            if not record or record['owner'] != owner or record['expires_at'] <= time.time():
+                record = {'target': target, 'owner': owner, 'event': event}
+            record['expires_at'] = time.time() + lease_seconds
+            records[target] = record
+            return True, record
+        return self._locked(update)
+
+    def get(self, target):
+        record = self._locked(lambda records: records.get(target))
+        return record if record and record['expires_at'] > time.time() else {}
+
+    def record_run(self, target, owner, run):
+        def update(records):
+            if records.get(target, {}).get('owner') == owner:
+                records[target]['run'] = run
+        self._locked(update)
+
+    def release(self, target, owner):
+        def update(records):
+            if records.get(target, {}).get('owner') == owner:
+                del records[target]
+        self._locked(update)
+
+
+class DynamoDBLedger:
+    # One item per target: target (hash key), owner, event, expires_at (also the table's TTL
+    # attribute) and run (JSON). Claims are conditional writes, so concurrent events cannot both win.
+    def __init__(self, table, region=None):
+        self.table = table
+        self.region = region
+
+    @property
+    def client(self):
+        return get_client('dynamodb', self.region)
+
+    @staticmethod
+    def _record(item):
+        record = {
+            'target': item['target']['S'],
+            'owner': item['owner']['S'],
+            'event': item['event']['S'] if 'event' in item else None,
+            'expires_at': float(item['expires_at']['N'])
+        }
+        if 'run' in item:
+            record['run'] = json.loads(item['run']['S'])
+        return record
+
+    def _item(self, target, consistent=True):
+        response = self.client.get_item(TableName=self.table, Key={'target': {'S': target}}, ConsistentRead=consistent)
+        return self._record(response['Item']) if 'Item' in response else None
+
+    def claim(self, target, owner, lease_seconds, event=None):
+        now = time.time()
+        item = {'target': {'S': target}, 'owner': {'S': owner}, 'expires_at': {'N': str(int(now + lease_seconds))}}
+        if event:
+            item['event'] = {'S': event}
+        try:
+            self.client.put_item(
+                TableName=self.table,
+                Item=item,
+                ConditionExpression='attribute_not_exists(target) OR expires_at < :now',
+                ExpressionAttributeValues={':now': {'N': str(int(now))}}
+            )
+            return True, {'target': target, 'owner': owner, 'event': event, 'expires_at': now + lease_seconds}
+        except self.client.exceptions.ConditionalCheckFailedException:
+            pass
+        # Held by a live lease: ours again (a retried step) or another run's
+        record = self._item(target) or {}
+        return record.get('owner') == owner, record
+
+    def get(self, target):
+        record = self._item(target)
+        return record if record and record['expires_at'] > time.time() else {}
+
+    def record_run(self, target, owner, run):
+        try:
+            self.client.update_item(
+                TableName=self.table,
+                Key={'target': {'S': target}},
+                UpdateExpression='SET run = :run',
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={'#owner': 'owner'},
+                ExpressionAttributeValues={':run': {'S': json.dumps(run)}, ':owner': {'S': owner}}
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+    def release(self, target, owner):
+        try:
+            self.client.delete_item(
+                TableName=self.table,
+                Key={'target': {'S': target}},
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={'#owner': 'owner'},
+                ExpressionAttributeValues={':owner': {'S': owner}}
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+
+def get_ledger(region=None):
+    # The ledger configured for this environment, created once per container
+    table = os.environ.get('EVENT_LEDGER_TABLE')
+    path = os.environ.get('EVENT_LEDGER_PATH')
+    key = (table, path, region)
+    if key not in _ledgers:
+        if table:
+            _ledgers[key] = DynamoDBLedger(table, region)
+        elif path:
+            _ledgers[key] = FileLedger(path)
+        else:
+            _ledgers[key] = NullLedger()
+    return _ledgers[key]
+
+
+class TargetBusy(Exception):
+    # Another run holds the target and cannot be joined
+    pass
+
+
+def request_owner(context):
+    # Lambda keeps the request id across retries of an asynchronous invocation
+    return getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
+
+
+def send_once(target, owner, lease_seconds, send, region=None, event=None, joinable=lambda run: True):
+    # Call send() to start a command for target unless a joinable run already holds it. Returns
+    # (run, attached): the run recorded for the target and whether another run started it.
+    ledger = get_ledger(region)
+    acquired, record = ledger.claim(target, owner, lease_seconds, event)
+    run = record.get('run')
+    if run and joinable(run):
+        return run, record['owner'] != owner
+    if not acquired or run:
+        raise TargetBusy(f"{target} is held by {record['owner']} (event {record.get('event')}) until {int(record['expires_at'])}")
+    try:
+        run = send()
+    except Exception:
+        ledger.release(target, owner)
+        raise
+    ledger.record_run(target, owner, run)
+    return run, False
@@ -1,244 +1,501 @@
-import boto3
 import json
+import math
 import time
 import os
 import logging
+import uuid
+
+from aws_clients import get_client
+from event_ledger import get_ledger, request_owner
+from metrics import publish_command_metrics
+from parameters import ADMIN_UI_PASSWORD, ADMIN_UI_USERNAME, IAM_CREDENTIALS
+from provisioner import PARAMETERS_PHASE
+from remote_tasks import REMOTE_BIN_DIR, RemoteTask, failed_phase, parse_markers, parse_phase_markers
+from seafile_benchmark import DEFAULT_CONCURRENCY as BENCHMARK_CONCURRENCY, DEFAULT_MIX as BENCHMARK_FILE_MIX
+from seafile_config import SEAFILE_CONF_PATH
+from setup_benchmark import collect_benchmark_s3, poll_benchmark, start_benchmark
+from ssm_commands import (IN_PROGRESS_STATUSES, STDERR_TAIL_LINES, command_log_group, command_timings, get_invocation,
+                          last_output_lines, output_config, output_stream_name, tail_output)
+from ssm_readiness import BUDGET_RESERVE_MS, backoff_delay, probe_agent, remaining_ms, seconds_since
 
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def lambda_handler(event, context):
-    # Retrieve environment variables with validation
-    region = os.environ.get('REGION')
-    eip_public_ip = os.environ.get('EIP_PUBLIC_IP')
-    commit_bucket = os.environ.get('COMMIT_BUCKET')
-    fs_bucket = os.environ.get('FS_BUCKET')
-    block_bucket = os.environ.get('BLOCK_BUCKET')
-
-    if not all([region, eip_public_ip, commit_bucket, fs_bucket, block_bucket]):
-        missing = [k for k, v in {
-            'REGION': region,
-            'EIP_PUBLIC_IP': eip_public_ip,
-            'COMMIT_BUCKET': commit_bucket,
-            'FS_BUCKET': fs_bucket,
-            'BLOCK_BUCKET': block_bucket
-        }.items() if not v]
-        raise ValueError(f"Missing required environment variables: {missing}")
+# SSM retry/poll settings shared by the blocking and resumable setup flows
+AGENT_READY_TIMEOUT = 450  # Seconds to wait for the SSM agent to register after the first attempt
+POLL_INTERVAL = 10  # Seconds between get_command_invocation checks
+COMMAND_TIMEOUT = 600  # 10 minutes to account for Docker pull and setup
+
+# Fleet mode tags the pending instances it claims with its run id and reaches them all through a
+# single command targeting that tag
+SETUP_RUN_TAG = 'SetupRun'
+CREATE_TAGS_BATCH_SIZE = 1000  # EC2 CreateTags resource limit per call
+
+# Event ledger targets; a run holds its target from its first step until its command finishes
+FLEET_LEDGER_TARGET = 'setup#fleet'
+LEDGER_LEASE_SECONDS = AGENT_READY_TIMEOUT + COMMAND_TIMEOUT + 300
+
+# Shell variable -> Parameter Store name resolved by the setup script
+SETUP_PARAMETERS = {
+    'IAM_CREDENTIALS': IAM_CREDENTIALS,
+    'DOCKER_USERNAME': '/seafile/docker/username',
+    'DOCKER_PASSWORD': '/seafile/docker/password',
+    'MYSQL_PASSWORD': '/seafile/mysql/password',
+    'DB_PASSWORD': '/seafile/db/password',
+    'ADMIN_EMAIL': ADMIN_UI_USERNAME,
+    'ADMIN_PASSWORD': ADMIN_UI_PASSWORD
+}
+
+# Setup phases and the phases each needs to finish first. provisioner.py on the instance starts
+# every phase as soon as its dependencies are done, so package installs, the docker-compose
+# download, the Parameter Store read and the image pulls overlap.
+SETUP_PHASES = {
+    'packages': [],
+    PARAMETERS_PHASE: [],
+    'docker_compose': [],
+    'sysctl': [],
+    'boto3': ['packages'],
+    'docker_login': ['packages', PARAMETERS_PHASE],
+    'compose_file': ['docker_compose', PARAMETERS_PHASE],
+    'resource_limits': ['compose_file'],
+    'pull_images': ['compose_file', 'docker_login'],
+    'deploy': ['pull_images', 'resource_limits', 'sysctl'],
+    'seafile_conf': ['deploy'],
+    'restart': ['seafile_conf'],
+    'verify': ['restart', 'boto3']
+}
+SETUP_FUNCTIONS_PATH = f"{REMOTE_BIN_DIR}/setup_phases.sh"
+# Left by a phase that changed the containers' configuration; the restart phase runs while it exists
+RESTART_FLAG_PATH = '/opt/seafile/.restart-pending'
+
+TUNING = f"python3 {REMOTE_BIN_DIR}/tuning.py"
+
+# Provisioning is split into checkpointed phases: a rerun skips every phase whose completion
+# marker exists and whose check still passes. Each phase is a phase_<name> function with a
+# check_<name> idempotency probe, run by provisioner.py in the order SETUP_PHASES allows.
+SETUP_FUNCTIONS = f"""
+    # Runs a command that prints `<file> updated|unchanged` lines and flags a restart if it updated anything
+    flag_restart_if_updated() {{
+        local output
+        output=$("$@")
+        echo "$output"
+        if echo "$output" | grep -q ' updated$'; then sudo touch {RESTART_FLAG_PATH}; fi
+    }}
 
-    ssm = boto3.client('ssm', region_name=region)
-    ec2 = boto3.client('ec2', region_name=region)
-    instance_id = event['detail']['instance-id']
+    # Install dependencies
+    check_packages() {{ command -v docker && command -v jq && command -v pip3 && sudo systemctl is-enabled docker; }}
+    phase_packages() {{
+        sudo yum update -y
+        sudo yum install -y docker jq openssl python3-pip
+        sudo systemctl start docker
+        sudo systemctl enable docker
+        sudo usermod -aG docker ec2-user
+    }}
 
-    # Check if the instance has the SetupPending=true tag
-    logger.info(f"Checking tags for instance {instance_id} in region {region}")
-    tags = ec2.describe_tags(
-        Filters=[
-            {"Name": "resource-id", "Values": [instance_id]},
-            {"Name": "key", "Values": ["SetupPending"]},
-            {"Name": "value", "Values": ["true"]}
-        ]
-    )['Tags']
-    
-    if not tags:
-        logger.info(f"Instance {instance_id} does not have SetupPending=true tag. Skipping.")
-        return {
-            'statusCode': 200,
-            'body': json.dumps('Instance not targeted for setup')
-        }
+    # Install Docker Compose
+    check_docker_compose() {{ /usr/bin/docker-compose version; }}
+    phase_docker_compose() {{
+        sudo curl -L "https://github.com/docker/compose/releases/download/v2.20.0/docker-compose-$(uname -s)-$(uname -m)" -o /usr/local/bin/docker-compose
+        sudo chmod +x /usr/local/bin/docker-compose
+        # Remove existing docker-compose link if it exists, then create a new one
+        sudo rm -f /usr/bin/docker-compose
+        sudo ln -s /usr/local/bin/docker-compose /usr/bin/docker-compose
+    }}
+
+    # System configuration: kernel limits sized for this instance by the tuning profile
+    check_sysctl() {{ sudo {TUNING} sysctl --check; }}
+    phase_sysctl() {{
+        # Drop the fixed limit earlier setups appended; /etc/sysctl.conf is loaded after sysctl.d
+        sudo sed -i '/^fs.file-max=100000$/d' /etc/sysctl.conf
+        sudo {TUNING} sysctl
+    }}
 
-    logger.info(f"Starting setup for instance {instance_id}")
+    # Install boto3 as ec2-user
+    check_boto3() {{ sudo -u ec2-user python3 -c 'import boto3'; }}
+    phase_boto3() {{
+        sudo -u ec2-user pip3 install boto3 --user
+    }}
 
-    # SSM command with retry logic
-    script = f"""
-    #!/bin/bash
-    set -e  # Exit on any error
+    # Log in to the correct Docker registry (docker.seadrive.org)
+    check_docker_login() {{ sudo grep -q 'docker.seadrive.org' /root/.docker/config.json; }}
+    phase_docker_login() {{
+        echo "Attempting login to docker.seadrive.org..."
+        if echo "$DOCKER_PASSWORD" | sudo docker login docker.seadrive.org --username "$DOCKER_USERNAME" --password-stdin; then
+            echo "Login to docker.seadrive.org successful"
+        else
+            echo "Login to docker.seadrive.org failed"
+            exit 1
+        fi
+    }}
+
+    # Download and customize docker-compose.yml
+    check_compose_file() {{ sudo docker-compose -f docker-compose.yml config -q; }}
+    phase_compose_file() {{
+        sudo wget -O "docker-compose.yml" "https://manual.seafile.com/11.0/docker/docker-compose/pro/11.0/docker-compose.yml"
+
+        # Update environment variables in docker-compose.yml with actual values
+        sudo sed -i "s/MYSQL_ROOT_PASSWORD=db_dev/MYSQL_ROOT_PASSWORD=$MYSQL_PASSWORD/g" docker-compose.yml
+        sudo sed -i "s/DB_ROOT_PASSWD=db_dev/DB_ROOT_PASSWD=$DB_PASSWORD/g" docker-compose.yml
+        sudo sed -i "s/SEAFILE_ADMIN_EMAIL=me@example.com/SEAFILE_ADMIN_EMAIL=$ADMIN_EMAIL/g" docker-compose.yml
+        sudo sed -i "s/SEAFILE_ADMIN_PASSWORD=asecret/SEAFILE_ADMIN_PASSWORD=$ADMIN_PASSWORD/g" docker-compose.yml
+        sudo sed -i "s/SEAFILE_SERVER_HOSTNAME=example.seafile.com/SEAFILE_SERVER_HOSTNAME=$EIP_PUBLIC_IP/g" docker-compose.yml
+
+        # Add NON_ROOT=true to the seafile service's environment
+        if ! grep -A 10 'seafile:' docker-compose.yml | grep -q 'NON_ROOT=true'; then
+            sudo sed -i '/environment:/a \      - NON_ROOT=true' docker-compose.yml
+        fi
+
+        # Check if redis service already exists; if not, add it before the top-level networks: section
+        if ! grep -q 'redis:' docker-compose.yml; then
+            sudo sed -i '/^networks:/i \  redis:\\n    image: redis:6\\n    container_name: seafile-redis\\n    networks:\\n      - seafile-net' docker-compose.yml
+        fi
+
+        # Add redis to seafile service's depends_on if not already present
+        if ! grep -A 5 'depends_on:' docker-compose.yml | grep -q 'redis'; then
+            sudo sed -i '/depends_on:/a \      - redis' docker-compose.yml
+        fi
+
+        # Verify the updated docker-compose.yml syntax
+        sudo docker-compose -f docker-compose.yml config || (echo "Invalid docker-compose.yml syntax" && exit 1)
+
+        # Set permissions for /opt/seafile-data/seafile/ as per documentation (Seafile 11.0.7+)
+        sudo chmod -R a+rwx /opt/seafile-data/seafile/
+    }}
+
+    # Container memory limits, ulimits and Redis/memcached/Elasticsearch memory for this instance
+    # size, written to docker-compose.override.yml for the services the base file defines
+    compose_services() {{ sudo docker-compose -f docker-compose.yml config --services | paste -sd, -; }}
+    check_resource_limits() {{ sudo {TUNING} compose-override --check --services "$(compose_services)"; }}
+    phase_resource_limits() {{
+        flag_restart_if_updated sudo {TUNING} compose-override --services "$(compose_services)"
+        sudo docker-compose config -q
+    }}
+
+    # Pull the MySQL, memcached, Redis and Seafile images (timed separately from starting them)
+    check_pull_images() {{ for image in $(sudo docker-compose config --images); do sudo docker image inspect "$image" || return 1; done; }}
+    phase_pull_images() {{
+        sudo docker-compose pull
+    }}
 
-    # Install dependencies
-    sudo yum update -y
-    sudo yum install -y docker jq openssl python3-pip
-    sudo systemctl start docker
-    sudo systemctl enable docker
-    sudo usermod -aG docker ec2-user
+    # Deploy Seafile
+    check_deploy() {{ sudo docker-compose ps --status running --services | grep -qx seafile; }}
+    phase_deploy() {{
+        sudo docker-compose up -d
+    }}
+
+    # Configure Seafile for S3 and Redis: merge all backend sections into seafile.conf
+    # (host side of the container's /opt/seafile/conf) and write it atomically in one pass
+    check_seafile_conf() {{ sudo grep -q '^\[block_backend\]' {SEAFILE_CONF_PATH} && sudo {TUNING} seafile-conf --check; }}
+    phase_seafile_conf() {{
+        # The container generates its conf directory on first start; wait for it instead of racing it
+        for i in $(seq 1 60); do [ -f {SEAFILE_CONF_PATH} ] && break; sleep 5; done
+        # IAM user credentials for S3 access
+        export SEAFILE_S3_KEY_ID="$(echo "$IAM_CREDENTIALS" | jq -r .access_key_id)"
+        export SEAFILE_S3_KEY="$(echo "$IAM_CREDENTIALS" | jq -r .secret_access_key)"
+        flag_restart_if_updated sudo -E python3 {REMOTE_BIN_DIR}/seafile_config.py set-backends --region "$REGION" --commit-bucket "$COMMIT_BUCKET" --fs-bucket "$FS_BUCKET" --block-bucket "$BLOCK_BUCKET" --redis-max-connections "$({TUNING} get redis_max_connections)"
+        # Fileserver worker/indexing threads and seahub workers from the tuning profile
+        flag_restart_if_updated sudo {TUNING} seafile-conf
+
+        # Configure boto for S3
+        sudo echo '[s3]' > ~/.boto
+        sudo echo 'use-sigv4 = True' >> ~/.boto
+        sudo echo "host = s3.$REGION.amazonaws.com" >> ~/.boto
+    }}
+
+    # Recreate the containers when resource_limits or seafile_conf changed their configuration
+    # (NON_ROOT=true and the S3 backends on the first run, new limits after a resize)
+    check_restart() {{ [ ! -f {RESTART_FLAG_PATH} ]; }}
+    phase_restart() {{
+        sudo docker-compose up -d --force-recreate
+        sudo rm -f {RESTART_FLAG_PATH}
+    }}
+
+    # Verify Seafile is running (never skipped)
+    check_verify() {{ false; }}
+    phase_verify() {{
+        sudo docker-compose ps | grep seafile | grep Up || (echo "Seafile failed to start" && exit 1)
+        # Kernel limits, container limits, Redis memory and Seafile settings match the profile
+        sudo {TUNING} validate
+    }}
+"""
+
+SETUP_STEPS_ARGS = ' '.join(f"--step {name}:{','.join(deps)}" for name, deps in SETUP_PHASES.items())
+SETUP_PARAMETER_ARGS = ' '.join(f"--parameter {variable}={name}" for variable, name in SETUP_PARAMETERS.items())
+
+# Rendered once per container. REGION, EIP_PUBLIC_IP, the bucket names and FAILED_LOG_LINES
+# arrive as environment variables exported by the command that runs it.
+SETUP_SCRIPT = f"""#!/bin/bash
+set -e  # Exit on any error
+
+# Create directories
+sudo mkdir -p /opt/seafile /opt/seafile-data/seafile
+cd /opt/seafile
+
+# Parameter Store values, including the IAM user credentials for S3 access, are resolved in
+# one batched call by the parameters phase and passed to the phases in their environment
+sudo -E python3 {REMOTE_BIN_DIR}/provisioner.py --functions {SETUP_FUNCTIONS_PATH} --region "$REGION" \\
+    --failed-log-lines "$FAILED_LOG_LINES" {SETUP_PARAMETER_ARGS} {SETUP_STEPS_ARGS}
+"""
+
+# The helpers used by the phases, the phase definitions and the provisioner that runs them
+SETUP_TASK = RemoteTask('setup', SETUP_SCRIPT, files={SETUP_FUNCTIONS_PATH: (SETUP_FUNCTIONS, '600')},
+                        modules=['seafile_config.py', 'tuning.py', 'provisioner.py'])
+
+
+def get_config():
+    # Retrieve environment variables with validation
+    config = {
+        'REGION': os.environ.get('REGION'),
+        'EIP_PUBLIC_IP': os.environ.get('EIP_PUBLIC_IP'),
+        'COMMIT_BUCKET': os.environ.get('COMMIT_BUCKET'),
+        'FS_BUCKET': os.environ.get('FS_BUCKET'),
+        'BLOCK_BUCKET': os.environ.get('BLOCK_BUCKET')
+    }
+    missing = [k for k, v in config.items() if not v]
+    if missing:
+        raise ValueError(f"Missing required environment variables: {missing}")
+    config['FLEET_MAX_CONCURRENCY'] = os.environ.get('FLEET_MAX_CONCURRENCY', '10')
+    config['FLEET_MAX_ERRORS'] = os.environ.get('FLEET_MAX_ERRORS', '10%')
+    # Blocking invocations hand off to the state machine when their time budget runs low
+    config['SETUP_STATE_MACHINE_ARN'] = os.environ.get('SETUP_STATE_MACHINE_ARN')
+    config['COMMAND_LOG_GROUP'] = command_log_group()
+    # Benchmark a freshly set up instance through the Seafile web API before finishing
+    config['POST_SETUP_BENCHMARK'] = os.environ.get('POST_SETUP_BENCHMARK', 'false').lower() == 'true'
+    config['BENCHMARK_FILE_MIX'] = os.environ.get('BENCHMARK_FILE_MIX') or BENCHMARK_FILE_MIX
+    config['BENCHMARK_CONCURRENCY'] = os.environ.get('BENCHMARK_CONCURRENCY') or str(BENCHMARK_CONCURRENCY)
+    # Bucket the remote task bundles are sent through; unset sends them inline with each command
+    config['REMOTE_TASKS_BUCKET'] = os.environ.get('REMOTE_TASKS_BUCKET')
+    return config
 
-    # Install Docker Compose
-    sudo curl -L "https://github.com/docker/compose/releases/download/v2.20.0/docker-compose-$(uname -s)-$(uname -m)" -o /usr/local/bin/docker-compose
-    sudo chmod +x /usr/local/bin/docker-compose
-    # Remove existing docker-compose link if it exists, then create a new one
-    [ -e /usr/bin/docker-compose ] && sudo rm -f /usr/bin/docker-compose
-    sudo ln -s /usr/local/bin/docker-compose /usr/bin/docker-compose
 
-    # System configuration
-    sudo echo "fs.file-max=100000" >> /etc/sysctl.conf
-    sudo sysctl -p
+def build_setup_script(config):
+    return SETUP_TASK.command({
+        'REGION': config['REGION'],
+        'EIP_PUBLIC_IP': config['EIP_PUBLIC_IP'],
+        'COMMIT_BUCKET': config['COMMIT_BUCKET'],
+        'FS_BUCKET': config['FS_BUCKET'],
+        'BLOCK_BUCKET': config['BLOCK_BUCKET'],
+        # Output streamed to CloudWatch Logs is not truncated, so a failed phase can report its whole log
+        'FAILED_LOG_LINES': 0 if config.get('COMMAND_LOG_GROUP') else 40
+    }, config['REGION'], config['REMOTE_TASKS_BUCKET'])
 
-    # Set up AWS metadata token
-    TOKEN=$(curl -X PUT "http://169.254.169.254/latest/api/token" -H "X-aws-ec2-metadata-token-ttl-seconds: 21600")
-    export AWS_METADATA_SERVICE_TOKEN=$TOKEN
 
-    # Install boto3 as ec2-user
-    sudo -u ec2-user pip3 install boto3 --user
+def format_phases(phases):
+    return ', '.join(f"{phase['name']}={phase['status']} ({phase['duration_ms']} ms)" for phase in phases)
 
-    # Create directories
-    sudo mkdir -p /opt/seafile /opt/seafile-data/seafile
-    cd /opt/seafile
 
-    # Retrieve IAM user credentials for S3 access
-    sudo aws ssm get-parameter --name "/seafile/iam_user/credentials" --with-decryption --region {region} --query Parameter.Value --output text > creds.json
-    AWS_ACCESS_KEY_ID=$(sudo jq -r .access_key_id creds.json)
-    AWS_SECRET_ACCESS_KEY=$(sudo jq -r .secret_access_key creds.json)
+def critical_path_marker(output):
+    # The provisioner's `::critical_path` summary, if the output has reached it
+    markers = parse_markers(output, 'critical_path')
+    return markers[0] if markers else None
 
-    # Fetch all SSM parameters upfront
-    DOCKER_USERNAME=$(aws ssm get-parameter --name /seafile/docker/username --with-decryption --region {region} --query Parameter.Value --output text)
-    DOCKER_PASSWORD=$(aws ssm get-parameter --name /seafile/docker/password --with-decryption --region {region} --query Parameter.Value --output text)
-    MYSQL_PASSWORD=$(aws ssm get-parameter --name /seafile/mysql/password --with-decryption --region {region} --query Parameter.Value --output text)
-    DB_PASSWORD=$(aws ssm get-parameter --name /seafile/db/password --with-decryption --region {region} --query Parameter.Value --output text)
-    ADMIN_EMAIL=$(aws ssm get-parameter --name /seafile/admin_ui_login/username --with-decryption --region {region} --query Parameter.Value --output text)
-    ADMIN_PASSWORD=$(aws ssm get-parameter --name /seafile/admin_ui_login/password --with-decryption --region {region} --query Parameter.Value --output text)
 
-    # Log in to the correct Docker registry (docker.seadrive.org)
-    echo "Attempting login to docker.seadrive.org..."
-    if echo "$DOCKER_PASSWORD" | sudo docker login docker.seadrive.org --username "$DOCKER_USERNAME" --password-stdin; then
-        echo "Login to docker.seadrive.org successful"
-    else
-        echo "Login to docker.seadrive.org failed"
-        exit 1
-    fi
-
-    # Download docker-compose.yml
-    sudo wget -O "docker-compose.yml" "https://manual.seafile.com/11.0/docker/docker-compose/pro/11.0/docker-compose.yml"
-
-    # Update environment variables in docker-compose.yml with actual values
-    sudo sed -i "s/MYSQL_ROOT_PASSWORD=db_dev/MYSQL_ROOT_PASSWORD=$MYSQL_PASSWORD/g" docker-compose.yml
-    sudo sed -i "s/DB_ROOT_PASSWD=db_dev/DB_ROOT_PASSWD=$DB_PASSWORD/g" docker-compose.yml
-    sudo sed -i "s/SEAFILE_ADMIN_EMAIL=me@example.com/SEAFILE_ADMIN_EMAIL=$ADMIN_EMAIL/g" docker-compose.yml
-    sudo sed -i "s/SEAFILE_ADMIN_PASSWORD=asecret/SEAFILE_ADMIN_PASSWORD=$ADMIN_PASSWORD/g" docker-compose.yml
-    sudo sed -i "s/SEAFILE_SERVER_HOSTNAME=example.seafile.com/SEAFILE_SERVER_HOSTNAME={eip_public_ip}/g" docker-compose.yml
-
-    # Add NON_ROOT=true to the seafile service's environment
-    if ! grep -A 10 'seafile:' docker-compose.yml | grep -q 'NON_ROOT=true'; then
-        sudo sed -i '/environment:/a \      - NON_ROOT=true' docker-compose.yml
-    fi
-
-    # Check if redis service already exists; if not, add it before the top-level networks: section
-    if ! grep -q 'redis:' docker-compose.yml; then
-        sudo sed -i '/^networks:/i \  redis:\\n    image: redis:6\\n    container_name: seafile-redis\\n    networks:\\n      - seafile-net' docker-compose.yml
-    fi
-
-    # Add redis to seafile service's depends_on if not already present
-    if ! grep -A 5 'depends_on:' docker-compose.yml | grep -q 'redis'; then
-        sudo sed -i '/depends_on:/a \      - redis' docker-compose.yml
-    fi
-
-    # Verify the updated docker-compose.yml syntax
-    sudo docker-compose -f docker-compose.yml config || (echo "Invalid docker-compose.yml syntax" && exit 1)
-
-    # Set permissions for /opt/seafile-data/seafile/ as per documentation (Seafile 11.0.7+)
-    sudo chmod -R a+rwx /opt/seafile-data/seafile/
+def log_critical_path(instance_id, critical):
+    if critical:
+        logger.info(f"Setup critical path for instance {instance_id}: {critical.get('phases')} ({critical.get('duration_ms')} ms); "
+                    f"wall time {critical.get('wall_ms')} ms for {critical.get('serial_ms')} ms of phase work")
 
-    # Deploy Seafile
-    sudo docker-compose up -d
-
-    # Ensure seafile.conf exists before appending configurations
-    sudo docker exec seafile sh -c "[ -f /opt/seafile/conf/seafile.conf ] || touch /opt/seafile/conf/seafile.conf"
-
-    # Configure Seafile for S3 and Redis using sed to ensure proper section formatting
-    # [commit_object_backend]
-    if ! sudo docker exec seafile grep -q '\[commit_object_backend\]' /opt/seafile/conf/seafile.conf; then
-        sudo docker exec seafile sh -c "echo '[commit_object_backend]' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'name = s3' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'bucket = {commit_bucket}' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'key_id = $AWS_ACCESS_KEY_ID' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'key = $AWS_SECRET_ACCESS_KEY' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'use_v4_signature = true' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'aws_region = {region}' >> /opt/seafile/conf/seafile.conf"
-        # Add a blank line for readability
-        sudo docker exec seafile sh -c "echo '' >> /opt/seafile/conf/seafile.conf"
-    fi
-
-    # [fs_object_backend]
-    if ! sudo docker exec seafile grep -q '\[fs_object_backend\]' /opt/seafile/conf/seafile.conf; then
-        sudo docker exec seafile sh -c "echo '[fs_object_backend]' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'name = s3' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'bucket = {fs_bucket}' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'key_id = $AWS_ACCESS_KEY_ID' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'key = $AWS_SECRET_ACCESS_KEY' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'use_v4_signature = true' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'aws_region = {region}' >> /opt/seafile/conf/seafile.conf"
-        # Add a blank line for readability
-        sudo docker exec seafile sh -c "echo '' >> /opt/seafile/conf/seafile.conf"
-    fi
-
-    # [block_backend]
-    if ! sudo docker exec seafile grep -q '\[block_backend\]' /opt/seafile/conf/seafile.conf; then
-        sudo docker exec seafile sh -c "echo '[block_backend]' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'name = s3' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'bucket = {block_bucket}' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'key_id = $AWS_ACCESS_KEY_ID' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'key = $AWS_SECRET_ACCESS_KEY' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'use_v4_signature = true' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'aws_region = {region}' >> /opt/seafile/conf/seafile.conf"
-        # Add a blank line for readability
-        sudo docker exec seafile sh -c "echo '' >> /opt/seafile/conf/seafile.conf"
-    fi
-
-    # [redis]
-    if ! sudo docker exec seafile grep -q '\[redis\]' /opt/seafile/conf/seafile.conf; then
-        sudo docker exec seafile sh -c "echo '[redis]' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'redis_host = redis' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'redis_port = 6379' >> /opt/seafile/conf/seafile.conf"
-        sudo docker exec seafile sh -c "echo 'max_connections = 100' >> /opt/seafile/conf/seafile.conf"
-        # Add a blank line for readability
-        sudo docker exec seafile sh -c "echo '' >> /opt/seafile/conf/seafile.conf"
-    fi
-
-    # Configure boto for S3
-    sudo echo '[s3]' > ~/.boto
-    sudo echo 'use-sigv4 = True' >> ~/.boto
-    sudo echo 'host = s3.{region}.amazonaws.com' >> ~/.boto
-
-    # Restart services to apply NON_ROOT=true
-    sudo docker-compose down
-    sudo docker-compose up -d
-
-    # Verify Seafile is running
-    sudo docker-compose ps | grep seafile | grep Up || (echo "Seafile failed to start" && exit 1)
-    """
-
-    # Retry sending SSM command if instance isn't ready
-    max_attempts = 10
-    retry_interval = 45  # Wait 45 seconds between retries
-    for attempt in range(max_attempts):
+
+def is_setup_pending(ec2, instance_id):
+    # Check if the instance has the SetupPending=true tag
+    tags = ec2.describe_tags(
+        Filters=[
+            {"Name": "resource-id", "Values": [instance_id]},
+            {"Name": "key", "Values": ["SetupPending"]},
+            {"Name": "value", "Values": ["true"]}
+        ]
+    )['Tags']
+    return bool(tags)
+
+
+def claim_target(state, config, target, lease_seconds=LEDGER_LEASE_SECONDS):
+    # Claim the ledger target for this run. Returns the state to continue with and, when another
+    # run already holds the target, the state that joins that run instead: polling its command
+    # once it has sent one, otherwise finishing as Skipped.
+    owner = state.get('run_id') or str(uuid.uuid4())
+    state = {**state, 'run_id': owner, 'ledger_target': target}
+    acquired, record = get_ledger(config['REGION']).claim(target, owner, lease_seconds, state.get('event_id'))
+    run = record.get('run')
+    if acquired and not run:
+        return state, None
+    if acquired:
+        # A retried step of this run that had already sent its command
+        return state, {**state, **run, 'status': 'Pending', 'wait_seconds': POLL_INTERVAL}
+    if run:
+        logger.info(f"Attaching to command {run['command_id']} already running for {target} (run {record['owner']}, event {record.get('event')})")
+        return state, {**state, **run, 'status': 'Pending', 'attached_to': record['owner'], 'wait_seconds': POLL_INTERVAL}
+    logger.info(f"{target} is already being set up by run {record['owner']} (event {record.get('event')}); coalescing into it")
+    return state, {**state, 'action': 'done', 'status': 'Skipped', 'coalesced_into': record['owner']}
+
+
+def record_command(state, config, run):
+    # Record the command this run sent so events arriving while it runs attach to it
+    get_ledger(config['REGION']).record_run(state['ledger_target'], state['run_id'], run)
+    return {**state, **run}
+
+
+def release_target(state, config):
+    # Free the ledger target once the run that holds it is done; a no-op for attached runs
+    if state.get('ledger_target'):
+        get_ledger(config['REGION']).release(state['ledger_target'], state['run_id'])
+
+
+def claim_instances(state, config, instance_ids, lease_seconds):
+    # Claim setup#<instance> for each instance on behalf of a fleet run and return the ones it
+    # now holds. An instance whose own run already holds it is left to that run, and a run
+    # started for an instance from now on coalesces into the fleet run.
+    ledger = get_ledger(config['REGION'])
+    claimed = []
+    for instance_id in instance_ids:
+        acquired, record = ledger.claim(f"setup#{instance_id}", state['run_id'], lease_seconds, state.get('event_id'))
+        if acquired:
+            claimed.append(instance_id)
+        else:
+            logger.info(f"Leaving {instance_id} to run {record.get('owner')} (event {record.get('event')}), which is already setting it up")
+    return claimed
+
+
+def release_instances(state, config, instance_ids):
+    ledger = get_ledger(config['REGION'])
+    for instance_id in instance_ids:
+        ledger.release(f"setup#{instance_id}", state['run_id'])
+
+
+def start_setup(state, config, ssm, ec2, context=None):
+    # Send the setup command once and return immediately with the progress needed to resume.
+    # When the SSM agent has not registered yet the state comes back as NotReady, with a
+    # backoff delay, so the caller can wait and retry without holding an invocation open.
+    instance_id = state['instance_id']
+    attempt = state.get('attempt', 0)
+
+    if attempt == 0:
+        logger.info(f"Checking tags for instance {instance_id} in region {config['REGION']}")
+        if not is_setup_pending(ec2, instance_id):
+            logger.info(f"Instance {instance_id} does not have SetupPending=true tag. Skipping.")
+            return {**state, 'action': 'done', 'status': 'Skipped'}
+        # A fleet command already covering this instance is followed rather than repeated
+        fleet = get_ledger(config['REGION']).get(FLEET_LEDGER_TARGET).get('run')
+        if fleet and instance_id in fleet['instance_ids']:
+            logger.info(f"Attaching to fleet setup command {fleet['command_id']} already running on {instance_id}")
+            return {
+                **state,
+                'action': 'poll',
+                'status': 'Pending',
+                'command_id': fleet['command_id'],
+                'sent_at': fleet['sent_at'],
+                'deadline': fleet['deadline'],
+                'attached_to': FLEET_LEDGER_TARGET,
+                'wait_seconds': POLL_INTERVAL
+            }
+        state, joined = claim_target(state, config, f"setup#{instance_id}")
+        if joined:
+            return joined
+        logger.info(f"Starting setup for instance {instance_id}")
+        state = {**state, 'agent_deadline': int(time.time()) + AGENT_READY_TIMEOUT}
+
+    # One probe per step; run_setup or the state machine's Wait state waits between probes
+    agent_status = probe_agent(ssm, instance_id)
+    ready = agent_status == 'Online'
+    if not ready:
+        attempt, delay = attempt + 1, backoff_delay(attempt)
+    else:
+        if state.get('running_at') and 'agent_ready_seconds' not in state:
+            # Time from the instance entering the running state to its SSM agent reporting Online
+            state = {**state, 'agent_ready_seconds': round(seconds_since(state['running_at']), 1)}
+            logger.info(f"SSM agent on {instance_id} ready {state['agent_ready_seconds']} seconds after the instance started running")
         try:
-            logger.info(f"Sending SSM command to instance {instance_id} (attempt {attempt + 1}/{max_attempts})")
+            logger.info(f"Sending SSM command to instance {instance_id}")
             response = ssm.send_command(
                 InstanceIds=[instance_id],
                 DocumentName='AWS-RunShellScript',
-                Parameters={'commands': [script]},
-                TimeoutSeconds=600
+                Parameters={'commands': [build_setup_script(config)]},
+                TimeoutSeconds=COMMAND_TIMEOUT,
+                **output_config(config['COMMAND_LOG_GROUP'])
             )
-            command_id = response['Command']['CommandId']
-            break  # Exit loop if command is sent successfully
         except ssm.exceptions.InvalidInstanceId:
-            if attempt < max_attempts - 1:
-                logger.info(f"Instance {instance_id} not ready for SSM (attempt {attempt + 1}/{max_attempts}). Retrying in {retry_interval} seconds...")
-                time.sleep(retry_interval)
-            else:
-                raise Exception(f"Failed to send SSM command to {instance_id} after {max_attempts} attempts: Instance not ready")
-
-    # Wait for command execution result
-    time.sleep(10)  # Initial wait before checking status
-    result = ssm.get_command_invocation(CommandId=command_id, InstanceId=instance_id)
-
-    max_wait = 600  # 10 minutes to account for Docker pull and setup
-    waited = 10
-    while result['Status'] in ['Pending', 'InProgress'] and waited < max_wait:
-        logger.info(f"SSM command {command_id} status: {result['Status']}, waited {waited}/{max_wait} seconds")
-        time.sleep(10)
-        result = ssm.get_command_invocation(CommandId=command_id, InstanceId=instance_id)
-        waited += 10
-
-    if result['Status'] == 'Success':
+            # The agent can report Online shortly before it accepts commands
+            ready, attempt, delay = False, attempt + 1, backoff_delay(attempt)
+
+    if not ready:
+        if time.time() + delay > state['agent_deadline']:
+            release_target(state, config)
+            raise Exception(f"Failed to send SSM command to {instance_id} after {attempt} attempts: Instance not ready")
+        logger.info(f"Instance {instance_id} not ready for SSM (attempt {attempt}, ping status {agent_status}). Retrying in {delay} seconds...")
+        return {
+            **state,
+            'action': 'start',
+            'status': 'NotReady',
+            'attempt': attempt,
+            'wait_seconds': delay
+        }
+
+    state = record_command(state, config, {
+        'action': 'poll',
+        'command_id': response['Command']['CommandId'],
+        'sent_at': time.time(),
+        'deadline': int(time.time()) + COMMAND_TIMEOUT
+    })
+    return {**state, 'status': 'Pending', 'attempt': attempt + 1, 'wait_seconds': POLL_INTERVAL}
+
+
+def follow_output(state, config):
+    # Read only the output added since the previous poll, log it, and keep the phase markers and
+    # a bounded stderr tail in the state; the forward tokens carry over to the next poll
+    output, tokens = tail_output(
+        get_client('logs', config['REGION']), config['COMMAND_LOG_GROUP'],
+        state['command_id'], state['instance_id'], state.get('output_tokens')
+    )
+    for stream, lines in output.items():
+        for line in lines:
+            logger.info(f"[{state['instance_id']} {stream}] {line}")
+    stdout = '\n'.join(output['stdout'])
+    return {
+        **state,
+        'output_tokens': tokens,
+        'phases': state.get('phases', []) + parse_phase_markers(stdout),
+        'critical_path': state.get('critical_path') or critical_path_marker(stdout),
+        'stderr_tail': (state.get('stderr_tail', []) + output['stderr'])[-STDERR_TAIL_LINES:]
+    }
+
+
+def poll_setup(state, config, ssm, ec2, context=None):
+    # Check the command status once; tag the instance when it succeeded
+    instance_id = state['instance_id']
+    command_id = state['command_id']
+
+    result = get_invocation(ssm, command_id, instance_id)
+    state = {**state, 'polls': state.get('polls', 0) + 1}
+    if config['COMMAND_LOG_GROUP']:
+        state = follow_output(state, config)
+
+    status = result['Status']
+    if status in IN_PROGRESS_STATUSES:
+        if time.time() < state['deadline']:
+            logger.info(f"SSM command {command_id} status: {status}, {int(state['deadline'] - time.time())} seconds until deadline")
+            return {**state, 'status': status}
+        status = 'TimedOut'
+
+    phases = state.get('phases') or parse_phase_markers(result.get('StandardOutputContent'))
+    if phases:
+        logger.info(f"Setup phase timings for instance {instance_id}: {format_phases(phases)}")
+    critical = state.get('critical_path') or critical_path_marker(result.get('StandardOutputContent'))
+    log_critical_path(instance_id, critical)
+    release_target(state, config)
+    # The run that sent the command reports it; attached runs only wait for the outcome
+    if not state.get('attached_to'):
+        queue_ms, execution_ms = command_timings(state.get('sent_at'), result.get('ExecutionStartDateTime'), result.get('ExecutionEndDateTime'))
+        publish_command_metrics('setup', instance_id, command_id, {
+            'SetupSucceeded': (int(status == 'Success'), 'Count'),
+            'SsmQueueTime': (queue_ms, 'Milliseconds'),
+            'CommandDuration': (execution_ms, 'Milliseconds'),
+            'PollCount': (state['polls'], 'Count'),
+            'BilledWaitTime': (state.get('waited_seconds', 0) * 1000, 'Milliseconds'),
+            'AgentReadyTime': (state.get('agent_ready_seconds'), 'Seconds'),
+            'CriticalPathTime': (int(critical['duration_ms']) if critical else None, 'Milliseconds')
+        }, phases, {'Status': status})
+
+    if status == 'Success':
         # Update tag to prevent re-triggering
         logger.info(f"Tagging instance {instance_id} as setup complete")
         ec2.create_tags(
@@ -246,11 +503,279 @@ def lambda_handler(event, context):
             Tags=[{'Key': 'SetupPending', 'Value': 'false'}]
         )
         logger.info(f"Setup completed for instance {instance_id}, tag updated to SetupPending=false")
+        if config['POST_SETUP_BENCHMARK'] and not state.get('attached_to'):
+            return {**state, 'action': 'benchmark_start', 'status': 'Benchmarking', 'phases': phases, 'wait_seconds': 0}
+        return {**state, 'action': 'done', 'status': 'Success', 'phases': phases}
+
+    phase = failed_phase(phases)
+    details = '\n'.join(state.get('stderr_tail', [])) or result.get('StandardErrorContent') or 'No error details'
+    error_message = f"Command failed with status {status}{f' in phase {phase}' if phase else ''}: {details}"
+    if config['COMMAND_LOG_GROUP']:
+        error_message += f"\nFull output: CloudWatch Logs group {config['COMMAND_LOG_GROUP']}, stream {output_stream_name(command_id, instance_id, 'stderr')}"
+    logger.error(error_message)
+    return {**state, 'action': 'done', 'status': status, 'error': error_message, 'failed_phase': phase, 'phases': phases}
+
+
+def find_pending_instances(ec2):
+    # Collect every running instance still tagged SetupPending=true
+    instance_ids = []
+    paginator = ec2.get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=[
+        {"Name": "tag:SetupPending", "Values": ["true"]},
+        {"Name": "instance-state-name", "Values": ["running"]}
+    ]):
+        for reservation in page['Reservations']:
+            instance_ids.extend(instance['InstanceId'] for instance in reservation['Instances'])
+    return sorted(instance_ids)
+
+
+def tag_instances(ec2, instance_ids, key, value):
+    for i in range(0, len(instance_ids), CREATE_TAGS_BATCH_SIZE):
+        ec2.create_tags(Resources=instance_ids[i:i + CREATE_TAGS_BATCH_SIZE], Tags=[{'Key': key, 'Value': value}])
+
+
+def tag_setup_complete(ec2, instance_ids):
+    # Update tags in bulk to prevent re-triggering
+    tag_instances(ec2, instance_ids, 'SetupPending', 'false')
+
+
+def fleet_waves(count, max_concurrency):
+    # Waves SSM needs to run a command on count instances at MaxConcurrency (a number or a percentage)
+    if max_concurrency.endswith('%'):
+        concurrency = max(1, count * int(max_concurrency[:-1]) // 100)
+    else:
+        concurrency = max(1, int(max_concurrency))
+    return math.ceil(count / concurrency)
+
+
+def start_fleet_setup(state, config, ssm, ec2, context=None):
+    # Send one command to all pending instances that no per-instance run holds and return immediately
+    instance_ids = find_pending_instances(ec2)
+    if not instance_ids:
+        logger.info("No running instances with SetupPending=true tag. Skipping.")
+        return {**state, 'action': 'done', 'status': 'Skipped', 'instance_ids': []}
+
+    # SSM runs MaxConcurrency invocations at a time and does not start one that has waited longer
+    # than TimeoutSeconds, so the later waves need their share of the time as well
+    timeout = COMMAND_TIMEOUT * fleet_waves(len(instance_ids), config['FLEET_MAX_CONCURRENCY'])
+    lease_seconds = timeout + LEDGER_LEASE_SECONDS
+    state, joined = claim_target(state, config, FLEET_LEDGER_TARGET, lease_seconds)
+    if joined:
+        return joined
+    instance_ids = claim_instances(state, config, instance_ids, lease_seconds)
+    if not instance_ids:
+        logger.info("Every pending instance is already being set up by its own run. Skipping.")
+        release_target(state, config)
+        return {**state, 'action': 'done', 'status': 'Skipped', 'instance_ids': []}
+
+    logger.info(f"Starting fleet setup for {len(instance_ids)} instances ({timeout} seconds to finish): {instance_ids}")
+    try:
+        tag_instances(ec2, instance_ids, SETUP_RUN_TAG, state['run_id'])
+        response = ssm.send_command(
+            Targets=[{'Key': f"tag:{SETUP_RUN_TAG}", 'Values': [state['run_id']]}],
+            DocumentName='AWS-RunShellScript',
+            Parameters={'commands': [build_setup_script(config)]},
+            TimeoutSeconds=timeout,
+            MaxConcurrency=config['FLEET_MAX_CONCURRENCY'],
+            MaxErrors=config['FLEET_MAX_ERRORS'],
+            **output_config(config['COMMAND_LOG_GROUP'])
+        )
+    except Exception:
+        release_instances(state, config, instance_ids)
+        release_target(state, config)
+        raise
+
+    state = record_command(state, config, {
+        'action': 'fleet_poll',
+        'command_id': response['Command']['CommandId'],
+        'instance_ids': instance_ids,
+        'sent_at': time.time(),
+        'deadline': int(time.time()) + timeout
+    })
+    return {**state, 'status': 'Pending', 'wait_seconds': POLL_INTERVAL}
+
+
+def list_fleet_invocations(ssm, command_id, details=False):
+    # Gather per-instance results for a fleet command: {instance_id: invocation}
+    invocations = {}
+    paginator = ssm.get_paginator('list_command_invocations')
+    for page in paginator.paginate(CommandId=command_id, Details=details):
+        for invocation in page['CommandInvocations']:
+            invocations[invocation['InstanceId']] = invocation
+    return invocations
+
+
+def poll_fleet_setup(state, config, ssm, ec2, context=None):
+    # Check every invocation of the fleet command once; tag the successful instances in bulk
+    command_id = state['command_id']
+    statuses = {i: invocation['Status'] for i, invocation in list_fleet_invocations(ssm, command_id).items()}
+    state = {**state, 'polls': state.get('polls', 0) + 1}
+
+    in_progress = sorted(i for i, status in statuses.items() if status in IN_PROGRESS_STATUSES)
+    if (in_progress or not statuses) and time.time() < state['deadline']:
+        logger.info(f"Fleet command {command_id}: {len(in_progress)} of {len(statuses)} invocations in progress, {int(state['deadline'] - time.time())} seconds until deadline")
+        return {**state, 'status': 'InProgress'}
+
+    succeeded = sorted(i for i, status in statuses.items() if status == 'Success')
+    failed = {i: status for i, status in statuses.items() if status != 'Success'}
+    for instance_id in in_progress:
+        failed[instance_id] = 'TimedOut'
+    # Pending instances that SSM never reached (agent not registered yet) keep their tag for the next run
+    unreached = sorted(set(state['instance_ids']) - set(statuses))
+    release_instances(state, config, state['instance_ids'])
+    release_target(state, config)
+
+    # One detailed listing at the end to read each instance's phase markers
+    failed_phases = {}
+    for instance_id, invocation in list_fleet_invocations(ssm, command_id, details=True).items():
+        plugins = invocation.get('CommandPlugins', [])
+        output = ''.join(plugin.get('Output', '') for plugin in plugins)
+        phases = parse_phase_markers(output)
+        if phases:
+            logger.info(f"Setup phase timings for instance {instance_id}: {format_phases(phases)}")
+        critical = critical_path_marker(output)
+        log_critical_path(instance_id, critical)
+        if instance_id in failed:
+            failed_phases[instance_id] = failed_phase(phases)
+        if state.get('attached_to'):
+            continue
+        queue_ms, execution_ms = command_timings(
+            state.get('sent_at'),
+            plugins[0].get('ResponseStartDateTime') if plugins else None,
+            plugins[-1].get('ResponseFinishDateTime') if plugins else None
+        )
+        publish_command_metrics('setup', instance_id, command_id, {
+            'SetupSucceeded': (int(invocation['Status'] == 'Success'), 'Count'),
+            'SsmQueueTime': (queue_ms, 'Milliseconds'),
+            'CommandDuration': (execution_ms, 'Milliseconds'),
+            'PollCount': (state['polls'], 'Count'),
+            'BilledWaitTime': (state.get('waited_seconds', 0) * 1000, 'Milliseconds'),
+            'CriticalPathTime': (int(critical['duration_ms']) if critical else None, 'Milliseconds')
+        }, phases, {'Status': invocation['Status'], 'Mode': 'fleet'})
+
+    if config['COMMAND_LOG_GROUP']:
+        # Only the failed instances' output is read, from the end of each stream
+        logs = get_client('logs', config['REGION'])
+        for instance_id in sorted(failed):
+            lines = last_output_lines(logs, config['COMMAND_LOG_GROUP'], command_id, instance_id)
+            logger.error(f"Last stderr lines of {instance_id}:\n" + '\n'.join(lines))
+
+    if succeeded:
+        logger.info(f"Tagging {len(succeeded)} instances as setup complete")
+        tag_setup_complete(ec2, succeeded)
+
+    result = {
+        **state,
+        'action': 'done',
+        'succeeded': succeeded,
+        'failed': failed,
+        'failed_phases': failed_phases,
+        'unreached': unreached
+    }
+    if failed or not succeeded:
+        result['status'] = 'Failed'
+        result['error'] = f"Fleet command {command_id} failed on {len(failed)} instances: {failed} (failed phases: {failed_phases}); unreached: {unreached}"
+        if config['COMMAND_LOG_GROUP']:
+            result['error'] += f"; full output in CloudWatch Logs group {config['COMMAND_LOG_GROUP']}"
+        logger.error(result['error'])
+    else:
+        result['status'] = 'Success'
+        logger.info(f"Fleet setup completed for {succeeded}; unreached: {unreached}")
+    return result
+
+
+def hand_off(state, config):
+    # Continue a blocking run in the setup state machine before this invocation times out
+    if not config['SETUP_STATE_MACHINE_ARN']:
+        raise Exception(f"Setup ran out of invocation time in state {state}")
+    logger.info(f"Invocation budget nearly used up; handing off to {config['SETUP_STATE_MACHINE_ARN']}")
+    get_client('stepfunctions', config['REGION']).start_execution(
+        stateMachineArn=config['SETUP_STATE_MACHINE_ARN'],
+        input=json.dumps(state)
+    )
+    return {**state, 'handed_off': True}
+
+
+def release_setup(state, config, ssm, ec2, context=None):
+    # Catch handler of the setup state machine: a step kept failing after its retries, so free the
+    # leases this run holds for the next event of its instances and fail with the step's error
+    release_target(state, config)
+    if state.get('mode') == 'fleet':
+        release_instances(state, config, state.get('instance_ids', []))
+    failure = state.get('failure', {})
+    try:
+        cause = json.loads(failure.get('Cause', ''))['errorMessage']
+    except (ValueError, KeyError, TypeError):
+        cause = failure.get('Cause')
+    error = f"Setup step failed with {failure.get('Error')}: {cause}"
+    logger.error(error)
+    return {**state, 'action': 'done', 'status': 'Failed', 'error': error}
+
+
+def run_setup(state, config, ssm, ec2, context=None):
+    # Blocking mode: drive start/poll in-process, sleeping between steps
+    while state['action'] != 'done':
+        state = SETUP_STEPS[state['action']](state, config, ssm, ec2, context)
+        if state['action'] != 'done':
+            if remaining_ms(context) - state['wait_seconds'] * 1000 < BUDGET_RESERVE_MS:
+                return hand_off(state, config)
+            time.sleep(state['wait_seconds'])
+            # Time spent sleeping inside this (billed) invocation
+            state = {**state, 'waited_seconds': state.get('waited_seconds', 0) + state['wait_seconds']}
+    return state
+
+
+SETUP_STEPS = {
+    'start': start_setup,
+    'poll': poll_setup,
+    'fleet_start': start_fleet_setup,
+    'fleet_poll': poll_fleet_setup,
+    'benchmark_start': start_benchmark,
+    'benchmark_poll': poll_benchmark,
+    'benchmark_s3': collect_benchmark_s3,
+    'release': release_setup
+}
+
+
+def lambda_handler(event, context):
+    config = get_config()
+    region = config['REGION']
+    ssm = get_client('ssm', region)
+    ec2 = get_client('ec2', region)
+
+    # Resumable mode: the setup state machine invokes one step at a time and waits between
+    # steps outside of Lambda, so billed duration stays independent of provisioning time.
+    action = event.get('action')
+    if action in SETUP_STEPS:
+        return SETUP_STEPS[action](event, config, ssm, ec2, context)
+
+    # Blocking mode for direct invocations with an EC2 state-change event, or with
+    # {"mode": "fleet"} to provision every SetupPending=true instance at once
+    if event.get('mode') == 'fleet':
+        state = {'mode': 'fleet', 'action': 'fleet_start'}
+    else:
+        state = {'instance_id': event['detail']['instance-id'], 'action': 'start', 'running_at': event.get('time')}
+    state = {**state, 'event_id': event.get('id'), 'run_id': request_owner(context)}
+    state = run_setup(state, config, ssm, ec2, context)
+
+    if state.get('handed_off'):
+        return {
+            'statusCode': 202,
+            'body': json.dumps('Setup handed off to the setup state machine')
+        }
+    if state.get('coalesced_into'):
         return {
             'statusCode': 200,
-            'body': json.dumps('Setup completed and tag updated')
+            'body': json.dumps(f"Setup already in progress for event {state['coalesced_into']}")
         }
-    else:
-        error_message = f"Command failed with status {result['Status']}: {result.get('StandardErrorContent', 'No error details')}"
-        logger.error(error_message)
-        raise Exception(error_message)
\ No newline at end of file
+    if state['status'] == 'Skipped':
+        return {
+            'statusCode': 200,
+            'body': json.dumps('Instance not targeted for setup')
+        }
+    if state['status'] != 'Success':
+        raise Exception(state['error'])
+    return {
+        'statusCode': 200,
+        'body': json.dumps('Setup completed and tag updated')
+    }
@@ -5,6 +5,18 @@ locals {
     "block"  = "Seafile Block Objects"
   }
 
+  # Environment shared by the Lambda functions that send SSM commands
+  command_lambda_environment = {
+    # Complete command output of every command, read back by the functions that sent it
+    COMMAND_LOG_GROUP = aws_cloudwatch_log_group.ssm_command_output.name
+
+    # Lease per command target shared by duplicate and overlapping events
+    EVENT_LEDGER_TABLE = aws_dynamodb_table.seafile_event_ledger.name
+
+    # Remote task bundles, sent by reference instead of inline with each command
+    REMOTE_TASKS_BUCKET = aws_s3_bucket.seafile_remote_tasks.id
+  }
+
   # Map of Parameter Store paths to their variable values and descriptions
   seafile_parameters = {
     "admin_ui_login/password" = {
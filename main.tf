@@ -67,4 +67,22 @@ resource "aws_ssm_parameter" "seafile_additional_params" {
   description = each.value.description
   type        = "SecureString"
   value       = each.value.value
-}
\ No newline at end of file
+}
+# Event ledger shared by the Lambda functions: one lease per command target so duplicate or
+# overlapping events attach to the run in progress instead of sending another SSM command
+resource "aws_dynamodb_table" "seafile_event_ledger" {
+  name         = "SeafileEventLedger"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "target"
+
+  attribute {
+    name = "target"
+    type = "S"
+  }
+
+  # Expired leases are removed by DynamoDB; the functions also ignore them before that happens
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+}
@@ -0,0 +1,51 @@
+import json
+import time
+
+# CloudWatch Embedded Metric Format (EMF) output for the handlers.
+# Each call prints one EMF document to stdout; Lambda ships it to CloudWatch Logs, which
+# extracts the metrics. Per-command identifiers are attached as properties, not dimensions,
+# to keep metric cardinality bounded; they remain queryable in CloudWatch Logs Insights.
+
+NAMESPACE = 'Seafile/Operations'
+
+
+def emit(metrics, dimensions, properties=None, namespace=NAMESPACE):
+    # metrics maps name -> (value, unit); values that are None are left out
+    metrics = {name: value for name, value in metrics.items() if value[0] is not None}
+    if not metrics:
+        return
+    keys = list(dimensions)
+    dimension_sets = [keys]
+    if 'InstanceId' in keys and len(keys) > 1:
+        # Also aggregate across instances
+        dimension_sets.append([key for key in keys if key != 'InstanceId'])
+    document = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': dimension_sets,
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()]
+            }]
+        },
+        **(properties or {}),
+        **dimensions,
+        **{name: value for name, (value, _) in metrics.items()}
+    }
+    print(json.dumps(document, default=str))
+
+
+def publish_command_metrics(command, instance_id, command_id, values, phases=(), properties=None):
+    # values maps metric name -> (value, unit) for the command as a whole; phases are the
+    # parsed `::phase` markers, published as PhaseDuration with a Phase dimension
+    dimensions = {'Command': command, 'InstanceId': instance_id}
+    properties = {'CommandId': command_id, **(properties or {})}
+    emit(values, dimensions, properties)
+    for phase in phases:
+        if phase['status'] == 'skipped':
+            continue
+        emit(
+            {'PhaseDuration': (phase['duration_ms'], 'Milliseconds')},
+            {**dimensions, 'Phase': phase['name']},
+            {**properties, 'PhaseStatus': phase['status']}
+        )
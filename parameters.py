@@ -0,0 +1,50 @@
+import shlex
+
+from aws_clients import get_client
+from remote_tasks import REMOTE_BIN_DIR
+
+# Batched Parameter Store resolution for the handlers and their remote scripts.
+# Lambda code resolves parameters through get_parameters, which batches the lookups into
+# GetParameters calls. Values are read fresh on every invocation: the only Lambda-side reader
+# (UpdateConfigLambda) runs because a parameter just changed. Remote scripts use
+# fetch_parameters_snippet, which resolves all their parameters in one call through
+# provisioner.py, the same code the setup script's parameters phase uses.
+
+GET_PARAMETERS_BATCH_SIZE = 10  # GetParameters accepts at most 10 names per call
+
+IAM_CREDENTIALS = '/seafile/iam_user/credentials'
+OLD_IAM_CREDENTIALS = '/seafile/old_iam_user/credentials'
+DEPLOYED_CREDENTIALS_FINGERPRINT = '/seafile/deployed/credentials_fingerprint'
+ADMIN_UI_USERNAME = '/seafile/admin_ui_login/username'
+ADMIN_UI_PASSWORD = '/seafile/admin_ui_login/password'
+
+
+def get_parameters(names, region=None):
+    # Returns {name: value} for the names that exist; missing names are left out
+    result = {}
+    ssm = get_client('ssm', region)
+    for i in range(0, len(names), GET_PARAMETERS_BATCH_SIZE):
+        response = ssm.get_parameters(Names=names[i:i + GET_PARAMETERS_BATCH_SIZE], WithDecryption=True)
+        for parameter in response['Parameters']:
+            result[parameter['Name']] = parameter['Value']
+    return result
+
+
+def put_parameter(name, value, region=None):
+    # Store a SecureString value, overwriting any previous version
+    get_client('ssm', region).put_parameter(Name=name, Value=value, Type='SecureString', Overwrite=True)
+
+
+def fetch_parameters_snippet(region, variables):
+    # Bash lines that resolve {SHELL_VARIABLE: parameter_name} with one batched, decrypted
+    # get-parameters call and assign each value to its shell variable; the script exits when
+    # any of the parameters does not exist. The task running them must ship provisioner.py.
+    names = list(dict.fromkeys(variables.values()))
+    if len(names) > GET_PARAMETERS_BATCH_SIZE:
+        raise ValueError(f"At most {GET_PARAMETERS_BATCH_SIZE} parameters can be fetched in one call")
+    arguments = ' '.join(f"--parameter {shlex.quote(f'{variable}={name}')}" for variable, name in variables.items())
+    return '\n'.join([
+        f"SEAFILE_PARAMETERS=$(python3 {REMOTE_BIN_DIR}/provisioner.py --print-parameters --region \"{region}\" {arguments}) "
+        f"|| {{ echo \"Failed to retrieve parameters from Parameter Store\"; exit 1; }}",
+        'eval "$SEAFILE_PARAMETERS"'
+    ])
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Dependency-graph provisioner for the Seafile instance.
+# Runs the setup phases a setup script defines as bash `phase_<name>` / `check_<name>` functions,
+# starting every phase as soon as the phases it depends on have finished, so independent work
+# (package installs, the docker-compose download, Parameter Store reads, image pulls) overlaps.
+# Keeps the checkpoint semantics of the sequential runner: a phase whose completion marker
+# exists and whose check still passes is skipped. Prints the same `::phase` markers, then a
+# `::critical_path` marker; failures are collected rather than stopping at the first one, and
+# phases that depend on a failed phase are reported as blocked.
+
+PHASE_STATE_DIR = '/var/lib/seafile-setup/phases'
+PHASE_LOG_DIR = '/var/log/seafile-setup'
+
+# Built-in phase that resolves Parameter Store values in-process, so secrets reach the phases
+# through their environment and are never written to disk
+PARAMETERS_PHASE = 'parameters'
+
+_print_lock = threading.Lock()
+
+
+def emit(line, stream=None):
+    # Markers are printed as phases finish so a streamed command output shows progress
+    with _print_lock:
+        print(line, file=stream or sys.stdout, flush=True)
+
+
+def parse_steps(specs):
+    # ['name:dep1,dep2', 'name'] -> {name: [deps]}, in declaration order
+    steps = {}
+    for spec in specs:
+        name, _, deps = spec.partition(':')
+        steps[name] = [dep for dep in deps.split(',') if dep]
+    for name, deps in steps.items():
+        for dep in deps:
+            if dep not in steps:
+                raise ValueError(f'Phase {name} depends on undeclared phase {dep}')
+    order = topological_order(steps)
+    if len(order) != len(steps):
+        raise ValueError(f'Phase dependencies form a cycle: {sorted(set(steps) - set(order))}')
+    return steps
+
+
+def topological_order(steps):
+    order, done = [], set()
+    while True:
+        ready = [name for name, deps in steps.items() if name not in done and all(dep in done for dep in deps)]
+        if not ready:
+            return order
+        order.extend(ready)
+        done.update(ready)
+
+
+def critical_path(steps, durations):
+    # Longest chain of dependent phases by duration: (total_ms, [names])
+    best = {}
+    for name in topological_order(steps):
+        before = max((best[dep] for dep in steps[name]), default=(0, []))
+        best[name] = (before[0] + durations.get(name, 0), before[1] + [name])
+    return max(best.values(), default=(0, []))
+
+
+def fetch_parameters(region, variables):
+    # {VARIABLE: parameter_name} -> {VARIABLE: value} with one batched get-parameters call. The
+    # one implementation on the instance: the parameters phase uses it, and the other remote
+    # scripts through --print-parameters.
+    names = sorted(set(variables.values()))
+    output = subprocess.run(
+        ['aws', 'ssm', 'get-parameters', '--names'] + names + ['--with-decryption', '--region', region, '--output', 'json'],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout
+    response = json.loads(output)
+    if response.get('InvalidParameters'):
+        raise RuntimeError(f"Parameters not found: {response['InvalidParameters']}")
+    values = {parameter['Name']: parameter['Value'] for parameter in response['Parameters']}
+    return {variable: values[name] for variable, name in variables.items()}
+
+
+class Provisioner:
+    def __init__(self, steps, functions, region=None, parameters=None, state_dir=PHASE_STATE_DIR,
+                 log_dir=PHASE_LOG_DIR, failed_log_lines=40, jobs=None):
+        self.steps = steps
+        self.functions = functions
+        self.region = region
+        self.parameters = parameters or {}
+        self.state_dir = state_dir
+        self.log_dir = log_dir
+        self.failed_log_lines = failed_log_lines
+        self.jobs = jobs or len(steps)
+        self.secrets = {}
+        self.results = {}
+
+    def _bash(self, command, name, log=None):
+        return subprocess.run(
+            ['bash', '-ec', '. "$0"; "$1_$2"', self.functions, command, name],
+            env={**os.environ, **self.secrets}, stdout=log or subprocess.DEVNULL, stderr=subprocess.STDOUT
+        ).returncode
+
+    def _marker(self, name):
+        return os.path.join(self.state_dir, name + '.done')
+
+    def run_phase(self, name):
+        # Returns (status, duration_ms)
+        started = time.monotonic()
+        log_path = os.path.join(self.log_dir, name + '.log')
+        if name == PARAMETERS_PHASE:
+            with open(log_path, 'w') as log:
+                try:
+                    self.secrets = fetch_parameters(self.region, self.parameters)
+                    status = 'completed'
+                except (subprocess.CalledProcessError, RuntimeError, KeyError, ValueError) as e:
+                    log.write(f'Failed to retrieve parameters from Parameter Store: {e}\n')
+                    status = 'failed'
+        elif os.path.exists(self._marker(name)) and self._bash('check', name) == 0:
+            status = 'skipped'
+        else:
+            with open(log_path, 'w') as log:
+                returncode = self._bash('phase', name, log)
+            if returncode == 0:
+                open(self._marker(name), 'w').close()
+                status = 'completed'
+            else:
+                status = 'failed'
+        duration_ms = 0 if status == 'skipped' else int((time.monotonic() - started) * 1000)
+        emit(f'::phase name={name} status={status} duration_ms={duration_ms}')
+        if status == 'failed':
+            self._report_failure(name, log_path)
+        return status, duration_ms
+
+    def _report_failure(self, name, log_path):
+        try:
+            with open(log_path) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            lines = []
+        if self.failed_log_lines:
+            lines = lines[-self.failed_log_lines:]
+        emit('\n'.join([f'--- {name} failed; {log_path}'] + lines), sys.stderr)
+
+    def run(self):
+        # Returns {status: [phase names]}
+        os.makedirs(self.state_dir, exist_ok=True)
+        os.makedirs(self.log_dir, exist_ok=True)
+        started = time.monotonic()
+        pending = dict(self.steps)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while pending or running:
+                for name, deps in list(pending.items()):
+                    statuses = [self.results.get(dep, (None, 0))[0] for dep in deps]
+                    if any(status in ('failed', 'blocked') for status in statuses):
+                        del pending[name]
+                        self.results[name] = ('blocked', 0)
+                        emit(f'::phase name={name} status=blocked duration_ms=0')
+                    elif all(status in ('completed', 'skipped') for status in statuses) and len(running) < self.jobs:
+                        del pending[name]
+                        running[pool.submit(self.run_phase, name)] = name
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    self.results[running.pop(future)] = future.result()
+        self.report(int((time.monotonic() - started) * 1000))
+        outcome = {}
+        for name, (status, _) in self.results.items():
+            outcome.setdefault(status, []).append(name)
+        return outcome
+
+    def report(self, wall_ms):
+        durations = {name: duration for name, (_, duration) in self.results.items()}
+        total_ms, path = critical_path(self.steps, durations)
+        serial_ms = sum(durations.values())
+        emit(f"::critical_path duration_ms={total_ms} wall_ms={wall_ms} serial_ms={serial_ms} phases={'>'.join(path)}")
+        emit(f"Critical path {total_ms} ms ({' > '.join(path)}); wall time {wall_ms} ms for {serial_ms} ms of phase work")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run setup phases as a dependency graph')
+    parser.add_argument('--functions', help='bash file defining phase_<name> and check_<name>')
+    parser.add_argument('--step', action='append', default=[], help='name[:dep1,dep2], in declaration order')
+    parser.add_argument('--region')
+    parser.add_argument('--parameter', action='append', default=[],
+                        help='VARIABLE=/parameter/name resolved by the parameters phase')
+    parser.add_argument('--print-parameters', action='store_true',
+                        help='only resolve the parameters and print them as shell assignments')
+    parser.add_argument('--state-dir', default=PHASE_STATE_DIR)
+    parser.add_argument('--log-dir', default=PHASE_LOG_DIR)
+    parser.add_argument('--failed-log-lines', type=int, default=40, help='log lines shown per failed phase; 0 for all')
+    parser.add_argument('--jobs', type=int, help='phases run at once (default: no limit)')
+    args = parser.parse_args(argv)
+
+    parameters = dict(spec.split('=', 1) for spec in args.parameter)
+    if args.print_parameters:
+        try:
+            values = fetch_parameters(args.region, parameters)
+        except (subprocess.CalledProcessError, RuntimeError) as e:
+            sys.exit(f'Failed to retrieve parameters from Parameter Store: {e}')
+        for variable, value in values.items():
+            print(f'{variable}={shlex.quote(value)}')
+        return
+    if not args.functions or not args.step:
+        parser.error('--functions and --step are required')
+    steps = parse_steps(args.step)
+    outcome = Provisioner(steps, args.functions, args.region, parameters, args.state_dir, args.log_dir,
+                          args.failed_log_lines, args.jobs).run()
+    if outcome.get('failed'):
+        # Every failure is reported, not only the first; phases that needed them were not run
+        blocked = ', '.join(outcome.get('blocked', [])) or 'none'
+        print(f"Provisioning failed in {len(outcome['failed'])} phase(s): {', '.join(outcome['failed'])}; blocked: {blocked}",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
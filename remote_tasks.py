@@ -0,0 +1,157 @@
+import base64
+import gzip
+import hashlib
+import io
+import os
+import shlex
+import tarfile
+
+from aws_clients import get_client
+
+# Building blocks for the remote scripts the handlers run on the Seafile instance through SSM.
+
+REMOTE_BIN_DIR = '/opt/seafile/bin'
+REMOTE_TASK_DIR = '/opt/seafile/tasks'
+REMOTE_TASK_PREFIX = 'remote-tasks/'  # Key prefix of the task bundles in REMOTE_TASKS_BUCKET
+
+# Largest commands parameter a handler sends. SSM rejects oversized document parameters, so
+# commands are kept well below its limits and a task that outgrows this budget fails before
+# send_command instead of with an opaque API error.
+MAX_COMMAND_BYTES = 24 * 1024
+
+_MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# (bucket, key) of the bundles this container has uploaded
+_published = set()
+
+
+def read_module(filename):
+    with open(os.path.join(_MODULE_DIR, filename), 'rb') as f:
+        return f.read()
+
+
+def build_bundle(files):
+    # A gzipped tar of {absolute path: (content, mode)}, unpacked relative to /. Members are
+    # sorted and carry no timestamps or owners, so the same files always give the same bytes.
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w', format=tarfile.GNU_FORMAT) as tar:
+        for path, (content, mode) in sorted(files.items()):
+            data = content.encode() if isinstance(content, str) else content
+            member = tarfile.TarInfo(path.lstrip('/'))
+            member.size = len(data)
+            member.mode = int(mode, 8)
+            tar.addfile(member, io.BytesIO(data))
+    return gzip.compress(buffer.getvalue(), compresslevel=9, mtime=0)
+
+
+def check_command_size(command, name='command'):
+    size = len(command.encode())
+    if size > MAX_COMMAND_BYTES:
+        raise ValueError(f"The {name} command is {size} bytes, over the {MAX_COMMAND_BYTES} byte budget for SSM "
+                         f"command parameters; set REMOTE_TASKS_BUCKET so its files are sent by reference")
+    return command
+
+
+class RemoteTask:
+    # A remote script and the files it needs, rendered once when the handler module is imported.
+    # The script and files are packed into one deterministic bundle named by its SHA-256 digest.
+    # Per call only a short bootstrap is sent: it exports the call's variables, fetches the
+    # bundle (from S3 by digest, or decoded from the command itself when no bucket is given),
+    # verifies the digest, unpacks it over / and runs the script. Scripts read everything that
+    # changes between calls from those variables.
+    def __init__(self, name, script, files=None, modules=()):
+        self.name = name
+        self.path = f"{REMOTE_TASK_DIR}/{name}.sh"
+        contents = {self.path: (script, '700')}
+        contents.update({f"{REMOTE_BIN_DIR}/{filename}": (read_module(filename), '755') for filename in modules})
+        contents.update(files or {})
+        self.bundle = build_bundle(contents)
+        self.digest = hashlib.sha256(self.bundle).hexdigest()
+        self.key = f"{REMOTE_TASK_PREFIX}{self.digest}.tar.gz"
+
+    def publish(self, bucket, region=None):
+        # Upload the bundle once per container; its key changes whenever its content does
+        if (bucket, self.key) not in _published:
+            get_client('s3', region).put_object(Bucket=bucket, Key=self.key, Body=self.bundle)
+            _published.add((bucket, self.key))
+
+    def command(self, variables=None, region=None, bucket=None):
+        # The bash command that runs this task with {SHELL_VARIABLE: value} exported
+        lines = ['#!/bin/bash', 'set -e']
+        lines += [f"export {variable}={shlex.quote(str(value))}" for variable, value in (variables or {}).items()]
+        lines += [
+            'TOKEN=$(curl -sS -X PUT "http://169.254.169.254/latest/api/token" -H "X-aws-ec2-metadata-token-ttl-seconds: 21600") '
+            '|| { echo "Failed to retrieve IMDSv2 token"; exit 1; }',
+            'export AWS_METADATA_SERVICE_TOKEN=$TOKEN',
+            'TASK_BUNDLE=$(mktemp)'
+        ]
+        if bucket:
+            self.publish(bucket, region)
+            lines.append(f"aws s3 cp s3://{bucket}/{self.key} \"$TASK_BUNDLE\" --region {region} --only-show-errors "
+                         f"|| {{ echo \"Failed to download the {self.name} task bundle\"; exit 1; }}")
+        else:
+            lines.append(f"echo '{base64.b64encode(self.bundle).decode('ascii')}' | base64 -d > \"$TASK_BUNDLE\"")
+        lines += [
+            f"echo \"{self.digest}  $TASK_BUNDLE\" | sha256sum -c --status "
+            f"|| {{ echo \"The {self.name} task bundle does not match its digest\"; exit 1; }}",
+            'sudo tar -xzf "$TASK_BUNDLE" -C / --no-same-owner',
+            'rm -f "$TASK_BUNDLE"',
+            f"exec bash {self.path}"
+        ]
+        return check_command_size('\n'.join(lines), self.name)
+
+
+# Bash helpers that emit structured timing markers. `begin_phase <name>` and `end_phase` wrap a
+# block of commands and print `::phase name=<name> status=completed duration_ms=<ms>` to the
+# command's stdout; if the script exits while a phase is open, `status=failed` is printed instead.
+# Setup phases are run by provisioner.py on the instance, which prints the same markers.
+TIMING_HELPERS = """
+exec 3>&1
+CURRENT_PHASE=""
+now_ms() { date +%s%3N; }
+report_phase_failure() {
+    rc=$?
+    if [ $rc -ne 0 ] && [ -n "$CURRENT_PHASE" ]; then
+        echo "::phase name=$CURRENT_PHASE status=failed duration_ms=$(( $(now_ms) - PHASE_STARTED ))" >&3
+    fi
+}
+trap report_phase_failure EXIT
+begin_phase() {
+    CURRENT_PHASE=$1
+    PHASE_STARTED=$(now_ms)
+}
+end_phase() {
+    echo "::phase name=$CURRENT_PHASE status=completed duration_ms=$(( $(now_ms) - PHASE_STARTED ))" >&3
+    CURRENT_PHASE=""
+}
+"""
+
+
+def parse_markers(output, kind):
+    # Returns the key=value fields of every `::<kind>` line in the command output
+    prefix = f"::{kind} "
+    markers = []
+    for line in (output or '').splitlines():
+        if line.startswith(prefix):
+            markers.append(dict(field.split('=', 1) for field in line[len(prefix):].split() if '=' in field))
+    return markers
+
+
+def parse_phase_markers(output):
+    # Returns [{'name', 'status', 'duration_ms'}] for every `::phase` line in the command output
+    return [
+        {
+            'name': fields['name'],
+            'status': fields.get('status'),
+            'duration_ms': int(fields.get('duration_ms', 0))
+        }
+        for fields in parse_markers(output, 'phase')
+        if 'name' in fields
+    ]
+
+
+def failed_phase(phases):
+    for phase in phases:
+        if phase['status'] == 'failed':
+            return phase['name']
+    return None
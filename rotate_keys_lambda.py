@@ -1,14 +1,63 @@
 import json
-import boto3
 import os
 import logging
+import time
+
+from aws_clients import get_client
+from event_ledger import TargetBusy
+from parameters import IAM_CREDENTIALS, fetch_parameters_snippet
+from remote_tasks import TIMING_HELPERS, RemoteTask
+from ssm_commands import command_log_group, is_command_status_event, output_config, report_command, send_command_once
 
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Initialize AWS clients
-ssm_client = boto3.client('ssm')
+LEDGER_LEASE_SECONDS = 900  # Longest a rotation holds the instance against repeated events
+
+# Script to rotate IAM access keys for the seafile-service-account user. Rendered once per
+# container; the command that runs it exports REGION.
+ROTATE_KEYS_SCRIPT = f"""#!/bin/bash
+# Exit on any error
+set -e
+
+{TIMING_HELPERS}
+# Retrieve the current credentials from Parameter Store
+begin_phase fetch_credentials
+{fetch_parameters_snippet('$REGION', {'CURRENT_CREDENTIALS': IAM_CREDENTIALS})}
+CURRENT_ACCESS_KEY_ID=$(echo "$CURRENT_CREDENTIALS" | jq -r '.access_key_id')
+CURRENT_SECRET_ACCESS_KEY=$(echo "$CURRENT_CREDENTIALS" | jq -r '.secret_access_key')
+
+# Validate that credentials were retrieved
+if [ -z "$CURRENT_ACCESS_KEY_ID" ] || [ -z "$CURRENT_SECRET_ACCESS_KEY" ]; then
+    echo "Failed to extract current credentials from Parameter Store"
+    exit 1
+fi
+end_phase
+
+# Generate a new access key for the seafile-service-account user
+begin_phase create_key
+NEW_CREDENTIALS=$(aws iam create-access-key --user-name seafile-service-account --query 'AccessKey' --output json) || {{ echo "Failed to create new access key"; exit 1; }}
+
+# Extract the new access key ID and secret key
+NEW_ACCESS_KEY_ID=$(echo $NEW_CREDENTIALS | jq -r '.AccessKeyId')
+NEW_SECRET_ACCESS_KEY=$(echo $NEW_CREDENTIALS | jq -r '.SecretAccessKey')
+end_phase
+
+# Store the new credentials in Parameter Store
+begin_phase store_credentials
+NEW_CREDENTIALS_JSON=$(jq -n --arg access_key_id "$NEW_ACCESS_KEY_ID" --arg secret_access_key "$NEW_SECRET_ACCESS_KEY" '{{'access_key_id': $access_key_id, 'secret_access_key': $secret_access_key}}')
+aws ssm put-parameter --name "/seafile/iam_user/credentials" --value "$NEW_CREDENTIALS_JSON" --type SecureString --overwrite --region "$REGION" || {{ echo "Failed to store new credentials"; exit 1; }}
+
+# Store the old credentials (both access key ID and secret access key) in a temporary Parameter Store path
+OLD_CREDENTIALS_JSON=$(jq -n --arg access_key_id "$CURRENT_ACCESS_KEY_ID" --arg secret_access_key "$CURRENT_SECRET_ACCESS_KEY" '{{'access_key_id': $access_key_id, 'secret_access_key': $secret_access_key}}')
+aws ssm put-parameter --name "/seafile/old_iam_user/credentials" --value "$OLD_CREDENTIALS_JSON" --type SecureString --region "$REGION" || {{ echo "Failed to store old credentials"; exit 1; }}
+end_phase
+
+echo "Key rotation completed. New access key ID: $NEW_ACCESS_KEY_ID"
+"""
+ROTATE_KEYS_TASK = RemoteTask('rotate_keys', ROTATE_KEYS_SCRIPT, modules=['provisioner.py'])
+
 
 def lambda_handler(event, context):
     try:
@@ -23,66 +72,55 @@ def lambda_handler(event, context):
             }.items() if not v]
             raise ValueError(f"Missing required environment variables: {missing}")
 
-        logger.info(f"Rotating keys for instance ID: {instance_id}")
-
-        # Script to rotate IAM access keys for the seafile-service-account user
-        rotate_keys_script = f"""#!/bin/bash
-
-        # Exit on any error
-        set -e
-
-        # Retrieve IMDSv2 token
-        TOKEN=$(curl -X PUT "http://169.254.169.254/latest/api/token" -H "X-aws-ec2-metadata-token-ttl-seconds: 21600") || {{ echo "Failed to retrieve IMDSv2 token"; exit 1; }}
-
-        # Set the IMDSv2 token for AWS CLI commands
-        export AWS_METADATA_SERVICE_TOKEN=$TOKEN
-
-        # Retrieve the current credentials from Parameter Store
-        CURRENT_CREDENTIALS=$(aws ssm get-parameter --name "/seafile/iam_user/credentials" --with-decryption --region {region} --query Parameter.Value --output text) || {{ echo "Failed to retrieve current credentials"; exit 1; }}
-        CURRENT_ACCESS_KEY_ID=$(echo $CURRENT_CREDENTIALS | jq -r '.access_key_id')
-        CURRENT_SECRET_ACCESS_KEY=$(echo $CURRENT_CREDENTIALS | jq -r '.secret_access_key')
-
-        # Validate that credentials were retrieved
-        if [ -z "$CURRENT_ACCESS_KEY_ID" ] || [ -z "$CURRENT_SECRET_ACCESS_KEY" ]; then
-            echo "Failed to extract current credentials from Parameter Store"
-            exit 1
-        fi
-
-        # Generate a new access key for the seafile-service-account user
-        NEW_CREDENTIALS=$(aws iam create-access-key --user-name seafile-service-account --query 'AccessKey' --output json) || {{ echo "Failed to create new access key"; exit 1; }}
-
-        # Extract the new access key ID and secret key
-        NEW_ACCESS_KEY_ID=$(echo $NEW_CREDENTIALS | jq -r '.AccessKeyId')
-        NEW_SECRET_ACCESS_KEY=$(echo $NEW_CREDENTIALS | jq -r '.SecretAccessKey')
-
-        # Store the new credentials in Parameter Store
-        NEW_CREDENTIALS_JSON=$(jq -n --arg access_key_id "$NEW_ACCESS_KEY_ID" --arg secret_access_key "$NEW_SECRET_ACCESS_KEY" '{{'access_key_id': $access_key_id, 'secret_access_key': $secret_access_key}}')
-        aws ssm put-parameter --name "/seafile/iam_user/credentials" --value "$NEW_CREDENTIALS_JSON" --type SecureString --overwrite --region {region} || {{ echo "Failed to store new credentials"; exit 1; }}
-
-        # Store the old credentials (both access key ID and secret access key) in a temporary Parameter Store path
-        OLD_CREDENTIALS_JSON=$(jq -n --arg access_key_id "$CURRENT_ACCESS_KEY_ID" --arg secret_access_key "$CURRENT_SECRET_ACCESS_KEY" '{{'access_key_id': $access_key_id, 'secret_access_key': $secret_access_key}}')
-        aws ssm put-parameter --name "/seafile/old_iam_user/credentials" --value "$OLD_CREDENTIALS_JSON" --type SecureString --region {region} || {{ echo "Failed to store old credentials"; exit 1; }}
-
-        echo "Key rotation completed. New access key ID: $NEW_ACCESS_KEY_ID"
-        """
-
-        # Execute the script on the EC2 instance using SSM
-        response = ssm_client.send_command(
-            InstanceIds=[instance_id],
-            DocumentName="AWS-RunShellScript",
-            Parameters={
-                "commands": [
-                    rotate_keys_script
-                ]
+        if is_command_status_event(event):
+            reported = report_command(
+                'rotate', event, region, lambda result: ({'RotationSucceeded': (int(result['Status'] == 'Success'), 'Count')}, {})
+            )
+            if not reported:
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps('Not a pending key rotation command; nothing to report')
+                }
+            run, result = reported
+            if result['Status'] != 'Success':
+                raise Exception(f"Key rotation command {run['command_id']} finished with status {result['Status']}: "
+                                f"{result.get('StandardErrorContent', '').strip()}")
+            return {
+                'statusCode': 200,
+                'body': json.dumps('RotateKeysLambda executed successfully!')
             }
-        )
 
-        command_id = response['Command']['CommandId']
-        logger.info(f"SSM command sent successfully. Command ID: {command_id}")
+        logger.info(f"Rotating keys for instance ID: {instance_id}")
 
+        def send():
+            # Execute the script on the EC2 instance using SSM
+            response = get_client('ssm', region).send_command(
+                InstanceIds=[instance_id],
+                DocumentName="AWS-RunShellScript",
+                Parameters={
+                    "commands": [
+                        ROTATE_KEYS_TASK.command({'REGION': region}, region, os.environ.get('REMOTE_TASKS_BUCKET'))
+                    ]
+                },
+                **output_config(command_log_group())
+            )
+            logger.info(f"SSM command sent successfully. Command ID: {response['Command']['CommandId']}")
+            return {'command_id': response['Command']['CommandId'], 'sent_at': time.time()}
+
+        # A redelivered or overlapping event joins the rotation already running on the instance
+        # instead of creating yet another access key
+        try:
+            run, attached = send_command_once('rotate', instance_id, send, event, context, region, LEDGER_LEASE_SECONDS)
+        except TargetBusy as e:
+            logger.info(f"Key rotation for {instance_id} is already starting: {e}")
+            return {
+                'statusCode': 200,
+                'body': json.dumps(f"Key rotation already in progress: {e}")
+            }
+        # The command's status-change event reports the outcome
         return {
-            'statusCode': 200,
-            'body': json.dumps('RotateKeysLambda executed successfully!')
+            'statusCode': 202,
+            'body': json.dumps(f"Key rotation {'already running' if attached else 'started'}. Command ID: {run['command_id']}")
         }
 
     except Exception as e:
@@ -1,8 +1,47 @@
 # Zip the RotateKeysLambda function
 data "archive_file" "rotate_keys_lambda_zip" {
   type        = "zip"
-  source_file = "${path.module}/rotate_keys_lambda.py"
   output_path = "${path.module}/rotate_keys_lambda.zip"
+
+  source {
+    content  = file("${path.module}/rotate_keys_lambda.py")
+    filename = "rotate_keys_lambda.py"
+  }
+
+  source {
+    content  = file("${path.module}/aws_clients.py")
+    filename = "aws_clients.py"
+  }
+
+  source {
+    content  = file("${path.module}/parameters.py")
+    filename = "parameters.py"
+  }
+
+  source {
+    content  = file("${path.module}/remote_tasks.py")
+    filename = "remote_tasks.py"
+  }
+
+  source {
+    content  = file("${path.module}/provisioner.py")
+    filename = "provisioner.py"
+  }
+
+  source {
+    content  = file("${path.module}/ssm_commands.py")
+    filename = "ssm_commands.py"
+  }
+
+  source {
+    content  = file("${path.module}/metrics.py")
+    filename = "metrics.py"
+  }
+
+  source {
+    content  = file("${path.module}/event_ledger.py")
+    filename = "event_ledger.py"
+  }
 }
 
 # IAM Role for RotateKeysLambda
@@ -29,6 +68,16 @@ resource "aws_iam_role_policy" "rotate_keys_lambda_policy" {
   policy = jsonencode({
     Version = "2012-10-17"
     Statement = [
+      {
+        Effect = "Allow"
+        Action = [
+          "dynamodb:GetItem",
+          "dynamodb:PutItem",
+          "dynamodb:UpdateItem",
+          "dynamodb:DeleteItem"
+        ]
+        Resource = aws_dynamodb_table.seafile_event_ledger.arn
+      },
       {
         Effect = "Allow"
         Action = [
@@ -43,6 +92,14 @@ resource "aws_iam_role_policy" "rotate_keys_lambda_policy" {
           "ssm:GetCommandInvocation"
         ]
         Resource = "*"
+      },
+      {
+        # Remote task bundles referenced by the commands
+        Effect = "Allow"
+        Action = [
+          "s3:PutObject"
+        ]
+        Resource = "${aws_s3_bucket.seafile_remote_tasks.arn}/remote-tasks/*"
       }
     ]
   })
@@ -55,13 +112,13 @@ resource "aws_lambda_function" "rotate_keys_lambda" {
   role          = aws_iam_role.rotate_keys_lambda_execution_role.arn
   handler       = "rotate_keys_lambda.lambda_handler"
   runtime       = "python3.9"
-  timeout       = 600
+  timeout       = 60
 
   environment {
-    variables = {
+    variables = merge(local.command_lambda_environment, {
       REGION      = var.region  # Changed from AWS_REGION to REGION
       INSTANCE_ID = aws_instance.seafile_instance.id
-    }
+    })
   }
 
   depends_on = [aws_iam_role_policy.rotate_keys_lambda_policy]
@@ -86,4 +143,18 @@ resource "aws_lambda_permission" "allow_eventbridge_rotate_keys" {
   function_name = aws_lambda_function.rotate_keys_lambda.function_name
   principal     = "events.amazonaws.com"
   source_arn    = aws_cloudwatch_event_rule.rotate_keys_schedule.arn
-}
\ No newline at end of file
+}
+
+resource "aws_cloudwatch_event_target" "rotate_keys_command_status_target" {
+  rule      = aws_cloudwatch_event_rule.seafile_command_status.name
+  target_id = "RotateKeysLambda"
+  arn       = aws_lambda_function.rotate_keys_lambda.arn
+}
+
+resource "aws_lambda_permission" "allow_eventbridge_rotate_keys_command_status" {
+  statement_id  = "AllowExecutionFromEventBridgeRotateKeysCommandStatus"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.rotate_keys_lambda.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.seafile_command_status.arn
+}
@@ -16,6 +16,39 @@ resource "aws_s3_bucket_versioning" "seafile_buckets_versioning" {
   }
 }
 
+# Request metrics for the post-setup benchmark, which reads each bucket's request counts for
+# the benchmark window (CloudWatch bills request metrics, so they only exist while it is enabled)
+resource "aws_s3_bucket_metric" "seafile_buckets_requests" {
+  for_each = var.post_setup_benchmark ? aws_s3_bucket.seafile_buckets : {}
+
+  bucket = each.value.id
+  name   = "EntireBucket"
+}
+
+# Content-addressed bundles of the remote task scripts the Lambdas run on the instance through
+# SSM; each SendCommand carries only a reference to its bundle. Outside the seafile-storage-bucket-*
+# names, so the Seafile service account cannot rewrite them. A bundle is only needed while its
+# command runs, and a Lambda uploads it again whenever a new container first sends it.
+resource "aws_s3_bucket" "seafile_remote_tasks" {
+  bucket = "seafile-remote-tasks-${random_id.bucket_suffix.hex}"
+  tags   = { Name = "Seafile remote tasks" }
+}
+
+resource "aws_s3_bucket_lifecycle_configuration" "seafile_remote_tasks_expiration" {
+  bucket = aws_s3_bucket.seafile_remote_tasks.id
+
+  rule {
+    id     = "expire-task-bundles"
+    status = "Enabled"
+    filter {
+      prefix = "remote-tasks/"
+    }
+    expiration {
+      days = 30
+    }
+  }
+}
+
 # IAM Policy for Seafile Service Account S3 Access
 resource "aws_iam_policy" "seafile_service_account_s3_policy" {
   name        = "SeafileServiceAccountS3Policy"
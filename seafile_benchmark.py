@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import math
+import os
+import sys
+import time
+import uuid
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Post-setup throughput and latency benchmark for a Seafile deployment.
+# Runs on the Seafile instance after setup (or locally against benchmarks/fake_seafile.py):
+# creates a throwaway library through the web API, uploads and downloads a mix of file sizes
+# with a pool of concurrent clients, verifies every download, and deletes the library again.
+# Prints one `::benchmark` marker per operation and size class (MB/s, p50/p99 latency, errors)
+# and a `::benchmark_window` marker with the run's start and end, which SetupEC2Lambda uses to
+# read the S3 request counts of each backend bucket for the same interval.
+
+DEFAULT_MIX = '4KiB:100,256KiB:40,4MiB:10,64MiB:2'
+DEFAULT_CONCURRENCY = 8
+
+UNITS = {'B': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}
+
+
+def parse_size(text):
+    for unit in sorted(UNITS, key=len, reverse=True):
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * UNITS[unit])
+    return int(text)
+
+
+def parse_mix(text):
+    # '4KiB:100,4MiB:10' -> [('4KiB', 4096, 100), ('4MiB', 4194304, 10)]
+    mix = []
+    for item in text.split(','):
+        label, _, count = item.strip().partition(':')
+        mix.append((label, parse_size(label), int(count or 1)))
+    return mix
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of a non-empty list
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class SeafileClient:
+    # The part of the Seafile web API (api2) the benchmark needs. File links returned by the
+    # server are pointed back at the base URL, so the benchmark measures this host rather than
+    # the public address the server advertises.
+    def __init__(self, url, timeout=600):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.token = None
+
+    def _request(self, method, url, data=None, headers=None):
+        if not url.startswith('http'):
+            url = self.url + url
+        headers = dict(headers or {})
+        if self.token:
+            headers['Authorization'] = f'Token {self.token}'
+        if isinstance(data, dict):
+            data = urllib.parse.urlencode(data).encode()
+        request = urllib.request.Request(url, data=data, headers=headers, method=method)
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return response.read()
+
+    def _json(self, method, url, data=None):
+        return json.loads(self._request(method, url, data, {'Accept': 'application/json'}).decode())
+
+    def _local(self, link):
+        parsed = urllib.parse.urlsplit(link)
+        base = urllib.parse.urlsplit(self.url)
+        return urllib.parse.urlunsplit((base.scheme, base.netloc, parsed.path, parsed.query, parsed.fragment))
+
+    def login(self, username, password):
+        self.token = self._json('POST', '/api2/auth-token/', {'username': username, 'password': password})['token']
+
+    def create_library(self, name):
+        return self._json('POST', '/api2/repos/', {'name': name, 'desc': 'Temporary benchmark library'})['repo_id']
+
+    def delete_library(self, repo_id):
+        self._request('DELETE', f'/api2/repos/{repo_id}/')
+
+    def upload(self, repo_id, name, content):
+        link = self._local(self._json('GET', f'/api2/repos/{repo_id}/upload-link/?p=/'))
+        boundary = uuid.uuid4().hex
+        parts = []
+        for field, value in (('parent_dir', '/'), ('replace', '1')):
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"\r\n\r\n{value}\r\n'.encode())
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n'.encode())
+        body = b''.join(parts) + content + f'\r\n--{boundary}--\r\n'.encode()
+        self._request('POST', link + '?ret-json=1', body, {'Content-Type': 'multipart/form-data; boundary=' + boundary})
+
+    def download(self, repo_id, name):
+        link = self._json('GET', f'/api2/repos/{repo_id}/file/?p=/{urllib.parse.quote(name)}')
+        return self._request('GET', self._local(link))
+
+
+def _timed(operation, *args):
+    # (latency_ms, error)
+    started = time.monotonic()
+    try:
+        operation(*args)
+        return (time.monotonic() - started) * 1000, None
+    except Exception as e:
+        return (time.monotonic() - started) * 1000, e
+
+
+def _summary(operation, label, size, latencies, errors, seconds):
+    succeeded = [latency for latency, error in latencies if error is None]
+    total = size * len(succeeded)
+    return {
+        'op': operation,
+        'size': label,
+        'files': len(latencies),
+        'bytes': total,
+        'seconds': round(seconds, 3),
+        'mb_per_s': round(total / 1e6 / seconds, 2) if seconds and succeeded else 0,
+        'p50_ms': round(percentile(succeeded, 0.50), 1) if succeeded else None,
+        'p99_ms': round(percentile(succeeded, 0.99), 1) if succeeded else None,
+        'errors': errors
+    }
+
+
+def report_operation(report, pool, operation, call, names, label, size):
+    # Runs call(name) for every name on the pool and adds the summary to the report
+    started = time.monotonic()
+    latencies = list(pool.map(lambda name: _timed(call, name), names))
+    seconds = time.monotonic() - started
+    errors = [error for _, error in latencies if error is not None]
+    report['errors'].extend(f'{operation} {label}: {error}' for error in errors[:3])
+    report['results'].append(_summary(operation, label, size, latencies, len(errors), seconds))
+
+
+def run(client, mix, concurrency=DEFAULT_CONCURRENCY, library_name=None):
+    # Returns {'results': [summary per op and size class], 'window': {'start', 'end'}, 'errors': [...]}
+    library_name = library_name or f'benchmark-{uuid.uuid4().hex[:8]}'
+    report = {'results': [], 'errors': []}
+    started = time.time()
+    repo_id = client.create_library(library_name)
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for label, size, count in mix:
+                # Distinct random content per file, so deduplication cannot skip any block upload
+                uploaded = {}
+
+                def upload(name):
+                    content = os.urandom(size)
+                    client.upload(repo_id, name, content)
+                    uploaded[name] = content
+
+                def download(name):
+                    if client.download(repo_id, name) != uploaded[name]:
+                        raise ValueError(f'Downloaded {name} does not match the uploaded content')
+
+                names = [f'{label}-{index}.bin' for index in range(count)]
+                report_operation(report, pool, 'upload', upload, names, label, size)
+                report_operation(report, pool, 'download', download, sorted(uploaded), label, size)
+    finally:
+        report['window'] = {'start': int(started), 'end': int(time.time()) + 1}
+        client.delete_library(repo_id)
+    return report
+
+
+def markers(report):
+    lines = ['::benchmark ' + ' '.join(f'{key}={value}' for key, value in result.items())
+             for result in report['results']]
+    lines.append(f"::benchmark_window start={report['window']['start']} end={report['window']['end']}")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark Seafile uploads and downloads through the web API')
+    parser.add_argument('--url', default='http://127.0.0.1', help='Seafile base URL')
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='size:count pairs, e.g. 4KiB:100,64MiB:2')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--library-name')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON instead of markers')
+    args = parser.parse_args(argv)
+
+    # Read from the environment so the password does not show up in the process list
+    password = os.environ.get('SEAFILE_PASSWORD')
+    if not password:
+        parser.error('SEAFILE_PASSWORD is not set')
+
+    client = SeafileClient(args.url)
+    client.login(args.username, password)
+    report = run(client, parse_mix(args.mix), args.concurrency, args.library_name)
+    print(json.dumps(report, indent=2) if args.json else '\n'.join(markers(report)))
+    for error in report['errors']:
+        print(error, file=sys.stderr)
+    if report['errors']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
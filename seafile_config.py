@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+# Renders and merges seafile.conf in a single pass.
+# Runs on the Seafile instance (Amazon Linux 2 python3) against the host side of the
+# container's /opt/seafile/conf volume, and is shipped there by the setup and update
+# Lambda functions. Sections and keys it does not manage are preserved as-is.
+
+SEAFILE_CONF_PATH = '/opt/seafile-data/seafile/conf/seafile.conf'
+
+BACKEND_SECTIONS = ['commit_object_backend', 'fs_object_backend', 'block_backend']
+
+
+def parse(text):
+    # Returns [(section_name_or_None, [lines])]; the first entry holds lines before any section
+    sections = [(None, [])]
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('[') and stripped.endswith(']'):
+            sections.append((stripped[1:-1].strip(), []))
+        sections[-1][1].append(line)
+    return sections
+
+
+def _key_of(line):
+    stripped = line.strip()
+    if not stripped or stripped[0] in '#;[' or '=' not in stripped:
+        return None
+    return stripped.split('=', 1)[0].strip()
+
+
+def merge(text, settings, create_sections=True):
+    # Apply {section: {key: value}} to the INI text, replacing existing keys in place and
+    # appending missing keys (and, unless create_sections is False, missing sections).
+    # Returns the new text.
+    sections = parse(text)
+    by_name = {name: lines for name, lines in sections if name is not None}
+
+    for section, values in settings.items():
+        lines = by_name.get(section)
+        if lines is None:
+            if not create_sections:
+                continue
+            lines = [f'[{section}]']
+            sections.append((section, lines))
+            by_name[section] = lines
+
+        pending = dict(values)
+        for i, line in enumerate(lines):
+            key = _key_of(line)
+            if key in pending:
+                lines[i] = f'{key} = {pending.pop(key)}'
+
+        # Insert new keys after the last non-blank line so the section keeps its trailing blank line
+        insert_at = len(lines)
+        while insert_at > 1 and not lines[insert_at - 1].strip():
+            insert_at -= 1
+        lines[insert_at:insert_at] = [f'{key} = {value}' for key, value in pending.items()]
+
+    rendered = []
+    for name, lines in sections:
+        if name is not None and rendered and rendered[-1].strip():
+            # Keep a blank line between sections for readability
+            rendered.append('')
+        rendered.extend(lines)
+    return '\n'.join(rendered).strip('\n') + '\n'
+
+
+def write_atomic(path, content):
+    # Write to a temporary file in the same directory and rename it over the target, keeping
+    # the original owner and mode (the container runs as a non-root user)
+    directory = os.path.dirname(path)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = os.stat(directory)
+        st_mode = 0o644
+    else:
+        st_mode = st.st_mode & 0o7777
+
+    fd, tmp_path = tempfile.mkstemp(prefix='.seafile.conf.', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, st_mode)
+        if os.geteuid() == 0:
+            os.chown(tmp_path, st.st_uid, st.st_gid)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def apply(path, settings, create_sections=True):
+    # Merge settings into the file; only writes when the content changes. Returns True if written.
+    try:
+        with open(path) as f:
+            current = f.read()
+    except FileNotFoundError:
+        current = ''
+    rendered = merge(current, settings, create_sections)
+    if rendered == current:
+        return False
+    write_atomic(path, rendered)
+    return True
+
+
+def backend_settings(buckets, key_id, key, region):
+    # buckets maps each backend section name to its S3 bucket
+    return {
+        section: {
+            'name': 's3',
+            'bucket': buckets[section],
+            'key_id': key_id,
+            'key': key,
+            'use_v4_signature': 'true',
+            'aws_region': region
+        }
+        for section in BACKEND_SECTIONS
+    }
+
+
+def credential_settings(key_id, key):
+    return {section: {'key_id': key_id, 'key': key} for section in BACKEND_SECTIONS}
+
+
+def _credentials_from_env():
+    # Secrets are passed through the environment rather than argv so they do not show up in ps
+    key_id = os.environ.get('SEAFILE_S3_KEY_ID')
+    key = os.environ.get('SEAFILE_S3_KEY')
+    if not key_id or not key:
+        raise SystemExit('SEAFILE_S3_KEY_ID and SEAFILE_S3_KEY must be set')
+    return key_id, key
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render S3 backend and Redis sections of seafile.conf')
+    parser.add_argument('--conf', default=SEAFILE_CONF_PATH)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    backends = subparsers.add_parser('set-backends', help='set S3 backend and Redis sections')
+    backends.add_argument('--region', required=True)
+    backends.add_argument('--commit-bucket', required=True)
+    backends.add_argument('--fs-bucket', required=True)
+    backends.add_argument('--block-bucket', required=True)
+    backends.add_argument('--redis-host', default='redis')
+    backends.add_argument('--redis-port', default='6379')
+    backends.add_argument('--redis-max-connections', default='100')
+
+    subparsers.add_parser('set-credentials', help='replace key_id/key in every S3 backend section')
+
+    subparsers.add_parser('set', help='merge a {section: {key: value}} JSON document read from stdin')
+
+    args = parser.parse_args(argv)
+    create_sections = True
+
+    if args.command == 'set-backends':
+        key_id, key = _credentials_from_env()
+        settings = backend_settings({
+            'commit_object_backend': args.commit_bucket,
+            'fs_object_backend': args.fs_bucket,
+            'block_backend': args.block_bucket
+        }, key_id, key, args.region)
+        settings['redis'] = {
+            'redis_host': args.redis_host,
+            'redis_port': args.redis_port,
+            'max_connections': args.redis_max_connections
+        }
+    elif args.command == 'set-credentials':
+        # Only rotate keys in backend sections that are already configured
+        settings = credential_settings(*_credentials_from_env())
+        create_sections = False
+    else:
+        settings = json.load(sys.stdin)
+
+    changed = apply(args.conf, settings, create_sections)
+    print(f"{args.conf} {'updated' if changed else 'unchanged'}")
+
+
+if __name__ == '__main__':
+    main()
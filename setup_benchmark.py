@@ -0,0 +1,175 @@
+import logging
+import time
+
+from aws_clients import get_client
+from metrics import emit
+from parameters import ADMIN_UI_PASSWORD, ADMIN_UI_USERNAME, fetch_parameters_snippet
+from remote_tasks import REMOTE_BIN_DIR, RemoteTask, parse_markers
+from ssm_commands import IN_PROGRESS_STATUSES, get_invocation, output_config
+
+# Optional post-setup benchmark steps of the setup state machine: seafile_benchmark.py runs on
+# the instance, then the S3 request metrics of the backend buckets are read for the benchmark's
+# window. S3 publishes request metrics per minute and on a best-effort basis, typically within a
+# few minutes. lambda_function.py registers the steps in SETUP_STEPS.
+
+logger = logging.getLogger()
+
+BENCHMARK_TIMEOUT = 1800
+POLL_INTERVAL = 10  # Seconds between get_command_invocation checks
+S3_METRICS_FILTER = 'EntireBucket'  # aws_s3_bucket_metric covering every object in a bucket
+S3_REQUEST_METRICS = ['AllRequests', 'GetRequests', 'PutRequests']
+S3_METRICS_INTERVAL = 60
+S3_METRICS_TIMEOUT = 900  # Seconds after the benchmark window to wait for the metrics to settle
+
+# The admin account created by setup runs the benchmark against the local web server
+BENCHMARK_CREDENTIALS = {'ADMIN_EMAIL': ADMIN_UI_USERNAME, 'ADMIN_PASSWORD': ADMIN_UI_PASSWORD}
+BENCHMARK_SCRIPT = f"""#!/bin/bash
+set -e  # Exit on any error
+
+{fetch_parameters_snippet('$REGION', BENCHMARK_CREDENTIALS)}
+SEAFILE_PASSWORD="$ADMIN_PASSWORD" python3 {REMOTE_BIN_DIR}/seafile_benchmark.py --url http://127.0.0.1 \\
+    --username "$ADMIN_EMAIL" --mix "$BENCHMARK_FILE_MIX" --concurrency "$BENCHMARK_CONCURRENCY"
+"""
+BENCHMARK_TASK = RemoteTask('benchmark', BENCHMARK_SCRIPT, modules=['seafile_benchmark.py', 'provisioner.py'])
+
+
+def build_benchmark_script(config):
+    return BENCHMARK_TASK.command({
+        'REGION': config['REGION'],
+        'BENCHMARK_FILE_MIX': config['BENCHMARK_FILE_MIX'],
+        'BENCHMARK_CONCURRENCY': int(config['BENCHMARK_CONCURRENCY'])
+    }, config['REGION'], config['REMOTE_TASKS_BUCKET'])
+
+
+def finish_benchmark(state, error=None):
+    # The benchmark only measures a deployment that is already set up; its failures are
+    # reported but never fail the setup
+    if error:
+        logger.error(f"Benchmark of instance {state['instance_id']} failed: {error}")
+        state = {**state, 'benchmark_error': error}
+    return {**state, 'action': 'done', 'status': 'Success'}
+
+
+def start_benchmark(state, config, ssm, ec2, context=None):
+    instance_id = state['instance_id']
+    logger.info(f"Starting benchmark on instance {instance_id} with file mix {config['BENCHMARK_FILE_MIX']}")
+    try:
+        response = ssm.send_command(
+            InstanceIds=[instance_id],
+            DocumentName='AWS-RunShellScript',
+            Parameters={'commands': [build_benchmark_script(config)]},
+            TimeoutSeconds=BENCHMARK_TIMEOUT,
+            **output_config(config['COMMAND_LOG_GROUP'])
+        )
+    except Exception as e:
+        return finish_benchmark(state, f"Failed to send the benchmark command: {e}")
+    return {
+        **state,
+        'action': 'benchmark_poll',
+        'status': 'Benchmarking',
+        'benchmark_command_id': response['Command']['CommandId'],
+        'benchmark_deadline': int(time.time()) + BENCHMARK_TIMEOUT,
+        'wait_seconds': POLL_INTERVAL
+    }
+
+
+def parse_benchmark_results(output):
+    # The `::benchmark` markers with their numbers converted; p50/p99 are None when every
+    # request of a size class failed
+    results = []
+    for fields in parse_markers(output, 'benchmark'):
+        result = {'op': fields.get('op'), 'size': fields.get('size')}
+        for key in ('files', 'bytes', 'errors'):
+            result[key] = int(fields.get(key, 0))
+        for key in ('seconds', 'mb_per_s', 'p50_ms', 'p99_ms'):
+            result[key] = None if fields.get(key, 'None') == 'None' else float(fields[key])
+        results.append(result)
+    return results
+
+
+def poll_benchmark(state, config, ssm, ec2, context=None):
+    instance_id = state['instance_id']
+    command_id = state['benchmark_command_id']
+    result = get_invocation(ssm, command_id, instance_id)
+    if result['Status'] in IN_PROGRESS_STATUSES and time.time() < state['benchmark_deadline']:
+        return {**state, 'status': 'Benchmarking'}
+
+    output = result.get('StandardOutputContent')
+    results = parse_benchmark_results(output)
+    for entry in results:
+        logger.info(f"Benchmark {entry['op']} {entry['size']} on {instance_id}: {entry['files']} files, {entry['mb_per_s']} MB/s, "
+                    f"p50 {entry['p50_ms']} ms, p99 {entry['p99_ms']} ms, {entry['errors']} errors")
+        emit({
+            'Throughput': (entry['mb_per_s'], 'Megabytes/Second'),
+            'LatencyP50': (entry['p50_ms'], 'Milliseconds'),
+            'LatencyP99': (entry['p99_ms'], 'Milliseconds'),
+            'Errors': (entry['errors'], 'Count')
+        }, {'Command': 'benchmark', 'Operation': entry['op'], 'SizeClass': entry['size']},
+            {'InstanceId': instance_id, 'CommandId': command_id})
+    state = {**state, 'benchmark': results}
+
+    windows = parse_markers(output, 'benchmark_window')
+    if result['Status'] != 'Success' or not windows:
+        error = result.get('StandardErrorContent') or f"Benchmark command finished with status {result['Status']}"
+        return finish_benchmark(state, error.strip()[-2000:])
+    # S3 request metrics for the window appear a few minutes after it ends
+    return {
+        **state,
+        'action': 'benchmark_s3',
+        'status': 'Benchmarking',
+        'benchmark_window': {key: int(value) for key, value in windows[0].items()},
+        'wait_seconds': S3_METRICS_INTERVAL
+    }
+
+
+def s3_request_counts(cloudwatch, buckets, start, end):
+    # {bucket role: {metric: total}} from the buckets' request metrics between start and end
+    queries = {}
+    for role, bucket in buckets.items():
+        for metric in S3_REQUEST_METRICS:
+            queries[f"{role}_{metric}".lower()] = (role, metric, {
+                'Namespace': 'AWS/S3',
+                'MetricName': metric,
+                'Dimensions': [{'Name': 'BucketName', 'Value': bucket}, {'Name': 'FilterId', 'Value': S3_METRICS_FILTER}]
+            })
+    counts = {role: {} for role in buckets}
+    kwargs = {}
+    while True:
+        # Widened to whole minutes so every request falls into one of the periods
+        response = cloudwatch.get_metric_data(
+            MetricDataQueries=[
+                {'Id': query_id, 'MetricStat': {'Metric': metric, 'Period': 60, 'Stat': 'Sum'}}
+                for query_id, (_, _, metric) in queries.items()
+            ],
+            StartTime=start - start % 60,
+            EndTime=end - end % 60 + 60,
+            **kwargs
+        )
+        for data in response['MetricDataResults']:
+            role, metric, _ = queries[data['Id']]
+            counts[role][metric] = counts[role].get(metric, 0) + int(sum(data['Values']))
+        if not response.get('NextToken'):
+            return counts
+        kwargs = {'NextToken': response['NextToken']}
+
+
+def collect_benchmark_s3(state, config, ssm, ec2, context=None):
+    # Request metrics arrive late and per bucket, so the counts are read until two polls in a row
+    # agree and every bucket has reported, or S3_METRICS_TIMEOUT after the window has passed
+    window = state['benchmark_window']
+    buckets = {'commit': config['COMMIT_BUCKET'], 'fs': config['FS_BUCKET'], 'block': config['BLOCK_BUCKET']}
+    requests = s3_request_counts(get_client('cloudwatch', config['REGION']), buckets, window['start'], window['end'])
+    settled = requests == state.get('benchmark_s3_requests') and all(metrics.get('AllRequests') for metrics in requests.values())
+    state = {**state, 'benchmark_s3_requests': requests}
+    if not settled and time.time() < window['end'] + S3_METRICS_TIMEOUT:
+        return {**state, 'status': 'Benchmarking', 'wait_seconds': S3_METRICS_INTERVAL}
+
+    if not settled:
+        logger.warning(f"S3 request metrics for the benchmark of {state['instance_id']} did not settle within {S3_METRICS_TIMEOUT} seconds; "
+                       f"check that the {S3_METRICS_FILTER} metrics configuration exists on each bucket")
+    for role, metrics in requests.items():
+        logger.info(f"S3 requests during the benchmark of {state['instance_id']} in the {role} bucket: {metrics}")
+        emit({f"S3{metric}": (total, 'Count') for metric, total in metrics.items()},
+             {'Command': 'benchmark', 'Bucket': role},
+             {'InstanceId': state['instance_id'], 'CommandId': state['benchmark_command_id'], 'Settled': settled})
+    return finish_benchmark(state)
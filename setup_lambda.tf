@@ -1,8 +1,72 @@
 # Zip the SetupEC2Lambda function
 data "archive_file" "lambda_zip" {
   type        = "zip"
-  source_file = "${path.module}/lambda_function.py"
   output_path = "${path.module}/lambda.zip"
+
+  source {
+    content  = file("${path.module}/lambda_function.py")
+    filename = "lambda_function.py"
+  }
+
+  source {
+    content  = file("${path.module}/aws_clients.py")
+    filename = "aws_clients.py"
+  }
+
+  source {
+    content  = file("${path.module}/parameters.py")
+    filename = "parameters.py"
+  }
+
+  source {
+    content  = file("${path.module}/remote_tasks.py")
+    filename = "remote_tasks.py"
+  }
+
+  source {
+    content  = file("${path.module}/seafile_config.py")
+    filename = "seafile_config.py"
+  }
+
+  source {
+    content  = file("${path.module}/tuning.py")
+    filename = "tuning.py"
+  }
+
+  source {
+    content  = file("${path.module}/provisioner.py")
+    filename = "provisioner.py"
+  }
+
+  source {
+    content  = file("${path.module}/seafile_benchmark.py")
+    filename = "seafile_benchmark.py"
+  }
+
+  source {
+    content  = file("${path.module}/setup_benchmark.py")
+    filename = "setup_benchmark.py"
+  }
+
+  source {
+    content  = file("${path.module}/ssm_readiness.py")
+    filename = "ssm_readiness.py"
+  }
+
+  source {
+    content  = file("${path.module}/ssm_commands.py")
+    filename = "ssm_commands.py"
+  }
+
+  source {
+    content  = file("${path.module}/metrics.py")
+    filename = "metrics.py"
+  }
+
+  source {
+    content  = file("${path.module}/event_ledger.py")
+    filename = "event_ledger.py"
+  }
 }
 
 # Lambda Role and Policy
@@ -26,7 +90,12 @@ resource "aws_iam_role_policy" "seafile_lambda_policy" {
     Statement = [
       {
         Effect   = "Allow"
-        Action   = ["ssm:SendCommand", "ssm:GetCommandInvocation"]
+        Action   = ["dynamodb:GetItem", "dynamodb:PutItem", "dynamodb:UpdateItem", "dynamodb:DeleteItem"]
+        Resource = aws_dynamodb_table.seafile_event_ledger.arn
+      },
+      {
+        Effect   = "Allow"
+        Action   = ["ssm:SendCommand", "ssm:GetCommandInvocation", "ssm:ListCommandInvocations", "ssm:DescribeInstanceInformation"]
         Resource = [
           "*",
           "*"
@@ -39,13 +108,36 @@ resource "aws_iam_role_policy" "seafile_lambda_policy" {
       },
       {
         Effect   = "Allow"
-        Action   = ["ec2:DescribeTags", "ec2:CreateTags"]
+        Action   = ["ec2:DescribeTags", "ec2:DescribeInstances", "ec2:CreateTags"]
+        Resource = "*"
+      },
+      {
+        Effect   = "Allow"
+        Action   = ["states:StartExecution"]
+        Resource = local.setup_state_machine_arn
+      },
+      {
+        # Remote task bundles referenced by the setup and benchmark commands
+        Effect   = "Allow"
+        Action   = ["s3:PutObject"]
+        Resource = "${aws_s3_bucket.seafile_remote_tasks.arn}/remote-tasks/*"
+      },
+      {
+        # S3 request counts of the backend buckets during the post-setup benchmark
+        Effect   = "Allow"
+        Action   = ["cloudwatch:GetMetricData"]
         Resource = "*"
       }
     ]
   })
 }
 
+# Built from its name to avoid a dependency cycle between the Lambda and the state machine
+locals {
+  setup_state_machine_name = "SeafileSetupStateMachine"
+  setup_state_machine_arn  = "arn:aws:states:${var.region}:${data.aws_caller_identity.current.account_id}:stateMachine:${local.setup_state_machine_name}"
+}
+
 # Lambda Function
 resource "aws_lambda_function" "seafile_lambda" {
   filename      = data.archive_file.lambda_zip.output_path
@@ -56,21 +148,184 @@ resource "aws_lambda_function" "seafile_lambda" {
   timeout       = 600
 
   environment {
-    variables = {
+    variables = merge(local.command_lambda_environment, {
       REGION        = var.region
       EIP_PUBLIC_IP = aws_eip.seafile_eip.public_ip
       COMMIT_BUCKET = aws_s3_bucket.seafile_buckets["commit"].id
       FS_BUCKET     = aws_s3_bucket.seafile_buckets["fs"].id
       BLOCK_BUCKET  = aws_s3_bucket.seafile_buckets["block"].id
-    }
+
+      # Fleet mode rate controls for the tag-targeted setup command
+      FLEET_MAX_CONCURRENCY = "10"
+      FLEET_MAX_ERRORS      = "10%"
+
+      # Blocking invocations hand off to the state machine when their time budget runs low
+      SETUP_STATE_MACHINE_ARN = local.setup_state_machine_arn
+
+      # Optional throughput and latency benchmark once setup has succeeded
+      POST_SETUP_BENCHMARK  = tostring(var.post_setup_benchmark)
+      BENCHMARK_FILE_MIX    = var.benchmark_file_mix
+      BENCHMARK_CONCURRENCY = tostring(var.benchmark_concurrency)
+    })
   }
   depends_on = [aws_iam_role_policy.seafile_lambda_policy]
 }
 
+# Setup State Machine
+# Drives SetupEC2Lambda one step at a time (send command, then poll) and waits between
+# steps inside Step Functions instead of sleeping inside the Lambda invocation.
+resource "aws_iam_role" "seafile_setup_state_machine_role" {
+  name = "SeafileSetupStateMachineRole"
+  assume_role_policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [{
+      Effect    = "Allow"
+      Principal = { Service = "states.amazonaws.com" }
+      Action    = "sts:AssumeRole"
+    }]
+  })
+}
+
+resource "aws_iam_role_policy" "seafile_setup_state_machine_policy" {
+  name   = "SeafileSetupStateMachinePolicy"
+  role   = aws_iam_role.seafile_setup_state_machine_role.id
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect   = "Allow"
+        Action   = ["lambda:InvokeFunction"]
+        Resource = aws_lambda_function.seafile_lambda.arn
+      }
+    ]
+  })
+}
+
+resource "aws_sfn_state_machine" "seafile_setup" {
+  name     = local.setup_state_machine_name
+  role_arn = aws_iam_role.seafile_setup_state_machine_role.arn
+
+  definition = jsonencode({
+    Comment = "Resumable Seafile setup: start the SSM command, then poll it until it finishes (and optionally benchmark the result)"
+    StartAt = "SelectMode"
+    States = {
+      SelectMode = {
+        Type = "Choice"
+        Choices = [
+          {
+            # State handed off by a blocking SetupEC2Lambda invocation: resume where it stopped
+            Variable  = "$.action"
+            IsPresent = true
+            Next      = "WaitBeforeNextStep"
+          },
+          {
+            And = [
+              { Variable = "$.mode", IsPresent = true },
+              { Variable = "$.mode", StringEquals = "fleet" }
+            ]
+            Next = "PrepareFleetSetup"
+          }
+        ]
+        Default = "PrepareSetup"
+      }
+      PrepareFleetSetup = {
+        Type = "Pass"
+        Parameters = {
+          "mode"     = "fleet"
+          "action"   = "fleet_start"
+          "run_id.$" = "$$.Execution.Id"
+        }
+        Next = "SetupStep"
+      }
+      PrepareSetup = {
+        Type = "Pass"
+        Parameters = {
+          "action"        = "start"
+          "attempt"       = 0
+          "instance_id.$" = "$.detail.instance-id"
+          "running_at.$"  = "$.time"
+          "event_id.$"    = "$.id"
+          # Owner of the event ledger lease; a redelivered event starts another execution, which
+          # finds the lease and joins this one
+          "run_id.$"      = "$$.Execution.Id"
+        }
+        Next = "SetupStep"
+      }
+      SetupStep = {
+        Type     = "Task"
+        Resource = aws_lambda_function.seafile_lambda.arn
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.SdkClientException", "Lambda.TooManyRequestsException"]
+            IntervalSeconds = 2
+            MaxAttempts     = 3
+            BackoffRate     = 2
+          },
+          {
+            # Errors raised by the step itself (throttled AWS calls, timeouts); a retried step
+            # re-enters its own ledger lease and resumes the command it already sent
+            ErrorEquals     = ["States.TaskFailed"]
+            IntervalSeconds = 5
+            MaxAttempts     = 3
+            BackoffRate     = 2
+          }
+        ]
+        Catch = [{
+          ErrorEquals = ["States.ALL"]
+          ResultPath  = "$.failure"
+          Next        = "PrepareRelease"
+        }]
+        Next = "CheckStatus"
+      }
+      PrepareRelease = {
+        Type       = "Pass"
+        Result     = "release"
+        ResultPath = "$.action"
+        Next       = "ReleaseLeases"
+      }
+      # Free the run's ledger leases so the next event for its instances is not held off until
+      # they expire, then fail with the step's error
+      ReleaseLeases = {
+        Type     = "Task"
+        Resource = aws_lambda_function.seafile_lambda.arn
+        Retry = [{
+          ErrorEquals     = ["States.ALL"]
+          IntervalSeconds = 2
+          MaxAttempts     = 3
+          BackoffRate     = 2
+        }]
+        Next = "SetupFailed"
+      }
+      CheckStatus = {
+        Type = "Choice"
+        Choices = [
+          { Variable = "$.status", StringEquals = "Success", Next = "SetupSucceeded" },
+          { Variable = "$.status", StringEquals = "Skipped", Next = "SetupSucceeded" },
+          { Variable = "$.action", StringEquals = "done", Next = "SetupFailed" }
+        ]
+        Default = "WaitBeforeNextStep"
+      }
+      WaitBeforeNextStep = {
+        Type        = "Wait"
+        SecondsPath = "$.wait_seconds"
+        Next        = "SetupStep"
+      }
+      SetupSucceeded = {
+        Type = "Succeed"
+      }
+      SetupFailed = {
+        Type      = "Fail"
+        Error     = "SetupCommandFailed"
+        CausePath = "$.error"
+      }
+    }
+  })
+}
+
 # EventBridge Rule
 resource "aws_cloudwatch_event_rule" "seafile_setup" {
   name        = "SeafileSetupRule"
-  description = "Trigger Lambda when any EC2 instance starts"
+  description = "Trigger the setup state machine when any EC2 instance starts"
   event_pattern = jsonencode({
     source      = ["aws.ec2"]
     detail-type = ["EC2 Instance State-change Notification"]
@@ -80,16 +335,36 @@ resource "aws_cloudwatch_event_rule" "seafile_setup" {
   })
 }
 
-resource "aws_lambda_permission" "allow_eventbridge" {
-  statement_id  = "AllowExecutionFromEventBridge"
-  action        = "lambda:InvokeFunction"
-  function_name = aws_lambda_function.seafile_lambda.function_name
-  principal     = "events.amazonaws.com"
-  source_arn    = aws_cloudwatch_event_rule.seafile_setup.arn
+resource "aws_iam_role" "seafile_setup_events_role" {
+  name = "SeafileSetupEventsRole"
+  assume_role_policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [{
+      Effect    = "Allow"
+      Principal = { Service = "events.amazonaws.com" }
+      Action    = "sts:AssumeRole"
+    }]
+  })
+}
+
+resource "aws_iam_role_policy" "seafile_setup_events_policy" {
+  name   = "SeafileSetupEventsPolicy"
+  role   = aws_iam_role.seafile_setup_events_role.id
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect   = "Allow"
+        Action   = ["states:StartExecution"]
+        Resource = aws_sfn_state_machine.seafile_setup.arn
+      }
+    ]
+  })
 }
 
 resource "aws_cloudwatch_event_target" "seafile_lambda_target" {
   rule      = aws_cloudwatch_event_rule.seafile_setup.name
-  target_id = "SeafileLambda"
-  arn       = aws_lambda_function.seafile_lambda.arn
+  target_id = "SeafileSetupStateMachine"
+  arn       = aws_sfn_state_machine.seafile_setup.arn
+  role_arn  = aws_iam_role.seafile_setup_events_role.arn
 }
\ No newline at end of file
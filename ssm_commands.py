@@ -0,0 +1,179 @@
+import logging
+import os
+import re
+from datetime import datetime, timezone
+
+from aws_clients import get_client
+from event_ledger import get_ledger, request_owner, send_once
+from metrics import publish_command_metrics
+from remote_tasks import parse_phase_markers
+
+# Shared helpers for checking on SSM Run Command invocations.
+# Commands sent with output_config() stream their complete stdout/stderr to CloudWatch Logs;
+# tail_output() then reads only the events added since the previous poll, so long yum/docker
+# logs are available in full instead of the 24,000 characters GetCommandInvocation returns.
+
+logger = logging.getLogger()
+
+IN_PROGRESS_STATUSES = ['Pending', 'InProgress', 'Delayed']
+
+# EventBridge detail type of the events SSM sends when a command invocation changes status
+COMMAND_STATUS_EVENT = 'EC2 Command Invocation Status-change Notification'
+
+OUTPUT_PLUGIN = 'aws-runShellScript'  # Plugin name of AWS-RunShellScript in the output stream names
+OUTPUT_STREAMS = ['stdout', 'stderr']
+STDERR_TAIL_LINES = 40  # stderr lines kept for error messages
+
+
+def get_invocation(ssm, command_id, instance_id):
+    try:
+        return ssm.get_command_invocation(CommandId=command_id, InstanceId=instance_id)
+    except ssm.exceptions.InvocationDoesNotExist:
+        # The invocation can take a moment to become visible right after send_command
+        return {'Status': 'Pending'}
+
+
+def command_log_group():
+    # Log group receiving the complete command output; unset falls back to SSM's truncated copies
+    return os.environ.get('COMMAND_LOG_GROUP')
+
+
+def output_config(log_group):
+    # send_command arguments that stream the command's full output to a CloudWatch log group
+    if not log_group:
+        return {}
+    return {'CloudWatchOutputConfig': {'CloudWatchLogGroupName': log_group, 'CloudWatchOutputEnabled': True}}
+
+
+def output_stream_name(command_id, instance_id, stream):
+    return f"{command_id}/{instance_id}/{OUTPUT_PLUGIN}/{stream}"
+
+
+def read_output(logs, log_group, command_id, instance_id, stream, token=None):
+    # Returns (lines, token) for the events after token; pass the token back on the next poll.
+    # The stream does not exist until the command first writes to it.
+    lines = []
+    while True:
+        kwargs = {'logGroupName': log_group, 'logStreamName': output_stream_name(command_id, instance_id, stream), 'startFromHead': True}
+        if token:
+            kwargs['nextToken'] = token
+        try:
+            response = logs.get_log_events(**kwargs)
+        except logs.exceptions.ResourceNotFoundException:
+            return lines, token
+        token = response['nextForwardToken']
+        if not response['events']:
+            return lines, token
+        for event in response['events']:
+            lines.extend(event['message'].splitlines())
+
+
+def tail_output(logs, log_group, command_id, instance_id, tokens=None):
+    # Read the new stdout and stderr lines of one invocation.
+    # Returns ({stream: lines}, tokens) where tokens maps each stream to its forward token.
+    tokens = dict(tokens or {})
+    output = {}
+    for stream in OUTPUT_STREAMS:
+        output[stream], tokens[stream] = read_output(logs, log_group, command_id, instance_id, stream, tokens.get(stream))
+    return output, tokens
+
+
+def last_output_lines(logs, log_group, command_id, instance_id, stream='stderr', limit=STDERR_TAIL_LINES):
+    # The last lines of one output stream, read from the end without paging through the rest
+    try:
+        response = logs.get_log_events(
+            logGroupName=log_group,
+            logStreamName=output_stream_name(command_id, instance_id, stream),
+            startFromHead=False,
+            limit=limit
+        )
+    except logs.exceptions.ResourceNotFoundException:
+        return []
+    lines = [line for event in response['events'] for line in event['message'].splitlines()]
+    return lines[-limit:]
+
+
+def parse_timestamp(value):
+    # SSM returns either datetimes or ISO 8601 strings with a variable number of fraction digits
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    match = re.match(r'(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.(\d+))?', value)
+    if not match:
+        return None
+    parsed = datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+    fraction = match.group(2) or '0'
+    return parsed.replace(microsecond=int(fraction[:6].ljust(6, '0')))
+
+
+def command_timings(sent_at, started, finished):
+    # Returns (queue_ms, execution_ms): send → start on the instance, and start → finish
+    started = parse_timestamp(started)
+    finished = parse_timestamp(finished)
+    queue_ms = execution_ms = None
+    if started and sent_at:
+        queue_ms = max(0, int((started.timestamp() - sent_at) * 1000))
+    if started and finished:
+        execution_ms = int((finished - started).total_seconds() * 1000)
+    return queue_ms, execution_ms
+
+
+def is_command_status_event(event):
+    return event.get('detail-type') == COMMAND_STATUS_EVENT
+
+
+def send_command_once(command, instance_id, send, event, context, region, lease_seconds, joinable=lambda run: True):
+    # Send a handler's command to the instance at most once per ledger target, without waiting for it.
+    # send() sends the command and returns the run to record ({'command_id', 'sent_at', ...});
+    # a redelivered or overlapping event joins a joinable run already holding the target, and
+    # raises TargetBusy otherwise. The target stays held until report_command() handles the
+    # command's status-change event. Returns (run, attached).
+    run, attached = send_once(f"{command}#{instance_id}", request_owner(context), lease_seconds, send, region, event.get('id'), joinable)
+    if attached:
+        logger.info(f"Attaching to {command} command {run['command_id']} already running on {instance_id}")
+    return run, attached
+
+
+def report_command(command, event, region, metrics, on_success=None):
+    # Report a command sent by send_command_once() from its status-change event, which EventBridge
+    # delivers once the invocation has finished, so no invocation is billed while it runs.
+    # metrics(result) returns the command's metric values and properties; on_success(run) is called
+    # when the command succeeded. Events for any other command on the instance, and repeated
+    # deliveries after the target was released, return None; otherwise returns (run, result).
+    detail = event['detail']
+    command_id, instance_id, status = detail['command-id'], detail['instance-id'], detail['status']
+    target = f"{command}#{instance_id}"
+    ledger = get_ledger(region)
+    record = ledger.get(target)
+    run = record.get('run') or {}
+    if run.get('command_id') != command_id:
+        logger.info(f"Command {command_id} on {instance_id} is not the pending {command} command; ignoring its {status} event")
+        return None
+
+    result = {**get_invocation(get_client('ssm', region), command_id, instance_id), 'Status': status}
+    log_group = command_log_group()
+    if log_group:
+        output, _ = tail_output(get_client('logs', region), log_group, command_id, instance_id)
+        for stream in OUTPUT_STREAMS:
+            for line in output[stream]:
+                logger.info(f"[{instance_id} {stream}] {line}")
+        # Fall back to SSM's copies if nothing reached the log group
+        result = {
+            **result,
+            'StandardOutputContent': '\n'.join(output['stdout']) or result.get('StandardOutputContent', ''),
+            'StandardErrorContent': '\n'.join(output['stderr']) or result.get('StandardErrorContent', '')
+        }
+
+    queue_ms, execution_ms = command_timings(run['sent_at'], result.get('ExecutionStartDateTime'), result.get('ExecutionEndDateTime'))
+    values, properties = metrics(result)
+    publish_command_metrics(command, instance_id, command_id, {
+        **values,
+        'SsmQueueTime': (queue_ms, 'Milliseconds'),
+        'CommandDuration': (execution_ms, 'Milliseconds')
+    }, parse_phase_markers(result.get('StandardOutputContent')), {'Status': status, **properties})
+    if status == 'Success' and on_success:
+        on_success(run)
+    # Finished either way, so the next event for the instance starts a new run
+    ledger.release(target, record['owner'])
+    return run, result
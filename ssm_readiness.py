@@ -0,0 +1,40 @@
+import random
+from datetime import datetime, timezone
+
+# SSM agent readiness detection for freshly started instances.
+# Instead of retrying send_command on a fixed interval, the setup step probes
+# DescribeInstanceInformation for the agent's ping status once per invocation and, until it is
+# Online, retries after an exponential backoff with full jitter; blocking runs hand off to the
+# state machine rather than wait past their remaining invocation budget.
+
+BACKOFF_BASE = 2  # Seconds
+BACKOFF_CAP = 60  # Seconds
+BUDGET_RESERVE_MS = 15000  # Time kept back for handing off cleanly before the invocation ends
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    # Full-jitter exponential backoff; whole seconds so the delay can drive a Step Functions Wait state
+    return max(1, round(random.uniform(base, min(cap, base * 2 ** attempt))))
+
+
+def remaining_ms(context):
+    if context is None:
+        return float('inf')
+    return context.get_remaining_time_in_millis()
+
+
+def probe_agent(ssm, instance_id):
+    # Returns the agent's PingStatus ('Online', 'ConnectionLost', 'Inactive') or None if not registered
+    response = ssm.describe_instance_information(
+        Filters=[{'Key': 'InstanceIds', 'Values': [instance_id]}]
+    )
+    for info in response.get('InstanceInformationList', []):
+        if info['InstanceId'] == instance_id:
+            return info.get('PingStatus')
+    return None
+
+
+def seconds_since(timestamp):
+    # Seconds elapsed since an ISO 8601 timestamp such as an EventBridge event's "time"
+    started = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    return (datetime.now(timezone.utc) - started).total_seconds()
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+from seafile_config import SEAFILE_CONF_PATH, apply, merge, write_atomic
+
+# Instance-size-aware tuning profile for the Seafile stack.
+# Runs on the Seafile instance next to seafile_config.py and sizes kernel limits, container
+# memory limits and ulimits, Redis/memcached memory, the Redis connection pool and Seafile's
+# worker and indexing threads from the instance's own vCPU count and memory, so one setup
+# script (including a fleet-wide command) fits every instance type it lands on.
+
+GUNICORN_CONF_PATH = '/opt/seafile-data/seafile/conf/gunicorn.conf.py'
+SYSCTL_CONF_PATH = '/etc/sysctl.d/99-seafile.conf'
+
+OS_RESERVE_MB = 512  # Kept back for the kernel, Docker and the SSM agent, plus 5% of memory
+
+# Share of the memory left for containers given to each service; seafile gets the remainder
+MEMORY_SHARES = {'db': 0.15, 'memcached': 0.08, 'redis': 0.05, 'elasticsearch': 0.30}
+MEMORY_CAPS_MB = {'memcached': 2048, 'redis': 2048, 'elasticsearch': 63488}
+MIN_SERVICE_MEMORY_MB = 64
+# Elasticsearch needs a 256 MiB heap in a container twice that size; seafile runs seahub and the fileserver
+MIN_MEMORY_MB = {'elasticsearch': 512, 'seafile': 512}
+
+
+def _clamp(value, low, high):
+    return max(low, min(high, int(value)))
+
+
+def memory_limits(available):
+    # Container memory limits in MiB that add up to at most the available memory. Every service
+    # gets its floor first; when the shares would overshoot, the memory above the floors is
+    # scaled down so the total fits.
+    floors = {service: MIN_MEMORY_MB.get(service, MIN_SERVICE_MEMORY_MB) for service in list(MEMORY_SHARES) + ['seafile']}
+    if sum(floors.values()) > available:
+        raise ValueError(f'{int(available)} MiB left for containers after the OS reserve; '
+                         f'the Seafile stack needs at least {sum(floors.values())} MiB')
+    limits = {
+        service: _clamp(available * share, floors[service], MEMORY_CAPS_MB.get(service, available))
+        for service, share in MEMORY_SHARES.items()
+    }
+    limits['seafile'] = max(floors['seafile'], int(available - sum(limits.values())))
+    excess = sum(limits.values()) - available
+    if excess > 0:
+        above = sum(limits[service] - floors[service] for service in limits)
+        scale = 1 - excess / above
+        limits = {service: floors[service] + int((limit - floors[service]) * scale) for service, limit in limits.items()}
+    return limits
+
+
+def profile(vcpus, memory_mb):
+    # Returns the settings for an instance with this many vCPUs and MiB of memory; raises
+    # ValueError when the instance is too small for the stack
+    available = memory_mb - OS_RESERVE_MB - memory_mb * 0.05
+    limits = memory_limits(available)
+    file_max = _clamp(memory_mb * 256, 100000, 4194304)
+    worker_threads = _clamp(vcpus * 4, 10, 64)
+
+    return {
+        'vcpus': vcpus,
+        'memory_mb': memory_mb,
+        'sysctl': {
+            'fs.file-max': file_max,
+            'net.core.somaxconn': 1024 if vcpus <= 2 else 4096,
+            'net.ipv4.tcp_max_syn_backlog': 1024 if vcpus <= 2 else 4096,
+            'vm.swappiness': 10,
+            # Redis forks for background saves and warns when overcommit is disabled
+            'vm.overcommit_memory': 1
+        },
+        'nofile': _clamp(file_max // 8, 65536, 1048576),
+        'memory_limits_mb': limits,
+        # Redis and memcached keep headroom below their container limits for per-connection buffers
+        'redis_maxmemory_mb': int(limits['redis'] * 0.75),
+        'memcached_mb': int(limits['memcached'] * 0.75),
+        # Elasticsearch wants half of its memory for the JVM heap and half for the page cache
+        'elasticsearch_heap_mb': limits['elasticsearch'] // 2,
+        'redis_max_connections': _clamp(vcpus * 50, 100, 1000),
+        'fileserver_worker_threads': worker_threads,
+        'fileserver_max_indexing_threads': _clamp(vcpus // 2, 1, 8),
+        'seahub_workers': _clamp(vcpus * 2 + 1, 3, 17)
+    }
+
+
+def detect():
+    # (vcpus, memory_mb) of the machine this runs on
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return os.cpu_count(), int(line.split()[1]) // 1024
+    raise RuntimeError('MemTotal not found in /proc/meminfo')
+
+
+def sysctl_conf(settings):
+    return ''.join(f'{key} = {value}\n' for key, value in settings['sysctl'].items())
+
+
+def live_sysctl(key):
+    with open('/proc/sys/' + key.replace('.', '/')) as f:
+        return f.read().strip()
+
+
+def compose_override(settings, services):
+    # docker-compose.override.yml for the services present in docker-compose.yml; compose merges
+    # it over the base file automatically
+    limits = settings['memory_limits_mb']
+    nofile = settings['nofile']
+    memcached_mb, redis_mb, heap_mb = settings['memcached_mb'], settings['redis_maxmemory_mb'], settings['elasticsearch_heap_mb']
+    extra = {
+        'memcached': [f'    entrypoint: ["memcached", "-m", "{memcached_mb}"]'],
+        'redis': [f'    command: ["redis-server", "--maxmemory", "{redis_mb}mb", "--maxmemory-policy", "allkeys-lru"]'],
+        'elasticsearch': [
+            '    environment:',
+            f'      ES_JAVA_OPTS: "-Xms{heap_mb}m -Xmx{heap_mb}m"'
+        ]
+    }
+    lines = [f"# Generated by tuning.py for {settings['vcpus']} vCPUs / {settings['memory_mb']} MiB; do not edit", 'services:']
+    for service in sorted(limits):
+        if service not in services:
+            continue
+        lines += [
+            f'  {service}:',
+            f'    mem_limit: {limits[service]}m',
+            # Same as mem_limit: containers never swap
+            f'    memswap_limit: {limits[service]}m',
+            '    ulimits:',
+            '      nofile:',
+            f'        soft: {nofile}',
+            f'        hard: {nofile}'
+        ]
+        lines += extra.get(service, [])
+    return '\n'.join(lines) + '\n'
+
+
+def seafile_settings(settings):
+    return {
+        'fileserver': {
+            'worker_threads': str(settings['fileserver_worker_threads']),
+            'max_indexing_threads': str(settings['fileserver_max_indexing_threads'])
+        },
+        'redis': {'max_connections': str(settings['redis_max_connections'])}
+    }
+
+
+def gunicorn_conf(text, workers):
+    # Seahub's gunicorn.conf.py with its worker count set; the container generates the file
+    # on first start, so an empty (missing) file is left alone
+    if not text:
+        return text
+    line = f'workers = {workers}'
+    if re.search(r'^workers\s*=', text, re.MULTILINE):
+        return re.sub(r'^workers\s*=.*$', line, text, flags=re.MULTILINE)
+    return text.rstrip('\n') + '\n' + line + '\n'
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return ''
+
+
+def _write_if_changed(path, content, check):
+    # Returns True when the file already has this content; in check mode nothing is written
+    if _read(path) == content:
+        return True
+    if not check:
+        write_atomic(path, content)
+    return False
+
+
+def _compose(*args):
+    return subprocess.run(['docker-compose'] + list(args), check=True, capture_output=True, text=True).stdout.strip()
+
+
+def validate(settings, conf, gunicorn):
+    # Compare the running system against the profile; returns a list of mismatches
+    problems = []
+    for key, value in settings['sysctl'].items():
+        if live_sysctl(key) != str(value):
+            problems.append(f'sysctl {key} is {live_sysctl(key)}, expected {value}')
+
+    running = _compose('ps', '--status', 'running', '--services').split()
+    for service, limit in settings['memory_limits_mb'].items():
+        if service not in running:
+            continue
+        container = _compose('ps', '-q', service)
+        memory = subprocess.run(['docker', 'inspect', '--format', '{{.HostConfig.Memory}}', container],
+                                check=True, capture_output=True, text=True).stdout.strip()
+        if memory != str(limit * 1024 * 1024):
+            problems.append(f'{service} memory limit is {memory} bytes, expected {limit} MiB')
+    if 'redis' in running:
+        maxmemory = _compose('exec', '-T', 'redis', 'redis-cli', 'config', 'get', 'maxmemory').split()[-1]
+        if maxmemory != str(settings['redis_maxmemory_mb'] * 1024 * 1024):
+            problems.append(f"redis maxmemory is {maxmemory}, expected {settings['redis_maxmemory_mb']} MiB")
+
+    current = _read(conf)
+    if merge(current, seafile_settings(settings)) != current:
+        problems.append(f'{conf} does not carry the profile settings')
+    current = _read(gunicorn)
+    if gunicorn_conf(current, settings['seahub_workers']) != current:
+        problems.append(f'{gunicorn} does not carry the profile worker count')
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Size the Seafile stack for this instance')
+    parser.add_argument('--vcpus', type=int, help='override the detected vCPU count')
+    parser.add_argument('--memory-mb', type=int, help='override the detected memory size')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    subparsers.add_parser('show', help='print the profile as JSON')
+
+    get = subparsers.add_parser('get', help='print one profile value')
+    get.add_argument('key')
+
+    sysctl = subparsers.add_parser('sysctl', help='write and load the kernel limits')
+    sysctl.add_argument('--conf', default=SYSCTL_CONF_PATH)
+    sysctl.add_argument('--check', action='store_true', help='only check the file and live values')
+
+    override = subparsers.add_parser('compose-override', help='write container memory limits and ulimits')
+    override.add_argument('--output', default='docker-compose.override.yml')
+    override.add_argument('--services', required=True, help='comma-separated services in docker-compose.yml')
+    override.add_argument('--check', action='store_true', help='only check the file is up to date')
+
+    seafile = subparsers.add_parser('seafile-conf', help='set worker threads and the Redis pool size')
+    seafile.add_argument('--conf', default=SEAFILE_CONF_PATH)
+    seafile.add_argument('--gunicorn-conf', default=GUNICORN_CONF_PATH)
+    seafile.add_argument('--check', action='store_true', help='only check the files are up to date')
+
+    check = subparsers.add_parser('validate', help='check the running stack against the profile')
+    check.add_argument('--conf', default=SEAFILE_CONF_PATH)
+    check.add_argument('--gunicorn-conf', default=GUNICORN_CONF_PATH)
+
+    args = parser.parse_args(argv)
+    vcpus, memory_mb = args.vcpus, args.memory_mb
+    if not vcpus or not memory_mb:
+        detected = detect()
+        vcpus, memory_mb = vcpus or detected[0], memory_mb or detected[1]
+    try:
+        settings = profile(vcpus, memory_mb)
+    except ValueError as e:
+        sys.exit(f'Cannot size the Seafile stack for {vcpus} vCPUs / {memory_mb} MiB: {e}')
+
+    if args.command == 'show':
+        print(json.dumps(settings, indent=2))
+    elif args.command == 'get':
+        print(settings[args.key])
+    elif args.command == 'sysctl':
+        current = _write_if_changed(args.conf, sysctl_conf(settings), args.check)
+        if args.check:
+            if not current or any(live_sysctl(key) != str(value) for key, value in settings['sysctl'].items()):
+                sys.exit(1)
+        else:
+            subprocess.run(['sysctl', '-p', args.conf], check=True)
+    elif args.command == 'compose-override':
+        services = [service for service in args.services.split(',') if service]
+        current = _write_if_changed(args.output, compose_override(settings, services), args.check)
+        if args.check:
+            if not current:
+                sys.exit(1)
+        else:
+            print(f"{args.output} {'unchanged' if current else 'updated'}")
+    elif args.command == 'seafile-conf':
+        if args.check:
+            current = _read(args.conf)
+            workers = _read(args.gunicorn_conf)
+            if merge(current, seafile_settings(settings)) != current or \
+                    gunicorn_conf(workers, settings['seahub_workers']) != workers:
+                sys.exit(1)
+            return
+        changed = apply(args.conf, seafile_settings(settings))
+        workers = _read(args.gunicorn_conf)
+        if gunicorn_conf(workers, settings['seahub_workers']) != workers:
+            write_atomic(args.gunicorn_conf, gunicorn_conf(workers, settings['seahub_workers']))
+            changed = True
+        print(f"{args.conf} {'updated' if changed else 'unchanged'}")
+    else:
+        problems = validate(settings, args.conf, args.gunicorn_conf)
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        if problems:
+            sys.exit(1)
+        print(f"Stack matches the tuning profile for {settings['vcpus']} vCPUs / {settings['memory_mb']} MiB")
+
+
+if __name__ == '__main__':
+    main()
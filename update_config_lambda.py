@@ -1,104 +1,280 @@
+import hashlib
 import json
-import boto3
 import os
 import logging
+import time
+
+from aws_clients import get_client
+from event_ledger import TargetBusy
+from metrics import emit
+from parameters import (DEPLOYED_CREDENTIALS_FINGERPRINT, IAM_CREDENTIALS, OLD_IAM_CREDENTIALS, fetch_parameters_snippet,
+                        get_parameters, put_parameter)
+from remote_tasks import REMOTE_BIN_DIR, TIMING_HELPERS, RemoteTask, parse_markers
+from seafile_config import BACKEND_SECTIONS, SEAFILE_CONF_PATH, backend_settings
+from ssm_commands import command_log_group, is_command_status_event, output_config, report_command, send_command_once
 
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Initialize AWS clients
-ssm_client = boto3.client('ssm')
+SEAFILE_HEALTH_URL = 'http://127.0.0.1/api2/ping/'
+LEDGER_LEASE_SECONDS = 900  # Longest an update holds the instance against repeated events
 
-def lambda_handler(event, context):
-    try:
-        # Get the region and instance ID from environment variables with validation
-        region = os.environ.get('REGION')
-        instance_id = os.environ.get('INSTANCE_ID')
+# Shell that applies the updated seafile.conf and sets UNAVAILABLE_MS to the measured outage
+RELOAD_SCRIPTS = {
+    # Restart only the seafile container; MySQL, memcached and Redis keep running with warm caches.
+    # The outage window runs from the restart until the health check passes again; if it never
+    # does, the previous seafile.conf is restored so the old (still valid) key keeps serving.
+    'rolling': f"""
+        RELOAD_STARTED=$(now_ms)
+        sudo docker-compose restart seafile || {{ echo "Failed to restart the seafile service"; exit 1; }}
+        if ! wait_for_seafile; then
+            echo "Seafile failed its health check after restart; restoring the previous seafile.conf"
+            sudo cp -p {SEAFILE_CONF_PATH}.previous {SEAFILE_CONF_PATH}
+            sudo docker-compose restart seafile
+            exit 1
+        fi
+        UNAVAILABLE_MS=$(( $(now_ms) - RELOAD_STARTED ))
+""",
+    # Restart the Docker containers of the whole stack
+    'full': """
+        RELOAD_STARTED=$(now_ms)
+        sudo docker-compose down || { echo "Failed to stop Docker containers"; exit 1; }
+        sudo docker-compose up -d || { echo "Failed to start Docker containers"; exit 1; }
 
-        if not all([region, instance_id]):
-            missing = [k for k, v in {
-                'REGION': region,
-                'INSTANCE_ID': instance_id
-            }.items() if not v]
-            raise ValueError(f"Missing required environment variables: {missing}")
+        # Verify Seafile is running
+        sudo docker-compose ps | grep seafile | grep Up || { echo "Seafile failed to start after restart"; exit 1; }
+        wait_for_seafile || { echo "Seafile failed its health check after restart"; exit 1; }
+        UNAVAILABLE_MS=$(( $(now_ms) - RELOAD_STARTED ))
+"""
+}
 
-        logger.info(f"Updating Seafile configuration for instance ID: {instance_id}")
 
-        # Script to update seafile.conf and manage access keys
-        update_config_script = f"""#!/bin/bash
+def update_config_script(reload_mode):
+    # Script to update seafile.conf and manage access keys. The command that runs it exports
+    # REGION and BUCKETS, the space-separated names of the three backend buckets.
+    return f"""#!/bin/bash
+# Exit on any error
+set -e
 
-        # Exit on any error
-        set -e
+{TIMING_HELPERS}
 
-        # Retrieve IMDSv2 token
-        TOKEN=$(curl -X PUT "http://169.254.169.254/latest/api/token" -H "X-aws-ec2-metadata-token-ttl-seconds: 21600") || {{ echo "Failed to retrieve IMDSv2 token"; exit 1; }}
+# Poll the Seafile HTTP health check for up to 3 minutes
+wait_for_seafile() {{
+    for i in $(seq 1 360); do
+        curl -fsS --max-time 2 -o /dev/null {SEAFILE_HEALTH_URL} && return 0
+        sleep 0.5
+    done
+    return 1
+}}
 
-        # Set the IMDSv2 token for AWS CLI commands
-        export AWS_METADATA_SERVICE_TOKEN=$TOKEN
+# Retrieve the new credentials from Parameter Store
+begin_phase fetch_credentials
+{fetch_parameters_snippet('$REGION', {'NEW_CREDENTIALS': IAM_CREDENTIALS})}
+NEW_ACCESS_KEY_ID=$(echo "$NEW_CREDENTIALS" | jq -r '.access_key_id')
+NEW_SECRET_ACCESS_KEY=$(echo "$NEW_CREDENTIALS" | jq -r '.secret_access_key')
 
-        # Retrieve the new credentials from Parameter Store
-        NEW_CREDENTIALS=$(aws ssm get-parameter --name "/seafile/iam_user/credentials" --with-decryption --region {region} --query Parameter.Value --output text) || {{ echo "Failed to retrieve new credentials"; exit 1; }}
-        NEW_ACCESS_KEY_ID=$(echo $NEW_CREDENTIALS | jq -r '.access_key_id')
-        NEW_SECRET_ACCESS_KEY=$(echo $NEW_CREDENTIALS | jq -r '.secret_access_key')
+# Validate that new credentials were retrieved
+if [ -z "$NEW_ACCESS_KEY_ID" ] || [ -z "$NEW_SECRET_ACCESS_KEY" ]; then
+    echo "Failed to extract new credentials from Parameter Store"
+    exit 1
+fi
+end_phase
 
-        # Validate that new credentials were retrieved
-        if [ -z "$NEW_ACCESS_KEY_ID" ] || [ -z "$NEW_SECRET_ACCESS_KEY" ]; then
-            echo "Failed to extract new credentials from Parameter Store"
-            exit 1
+# Confirm the new key works against all three buckets before Seafile depends on it.
+# New IAM keys can take a few seconds to propagate, so retry briefly.
+begin_phase verify_new_key
+VERIFY_STARTED=$(now_ms)
+for BUCKET in $BUCKETS; do
+    for i in $(seq 1 12); do
+        if AWS_ACCESS_KEY_ID="$NEW_ACCESS_KEY_ID" AWS_SECRET_ACCESS_KEY="$NEW_SECRET_ACCESS_KEY" \\
+            aws s3api list-objects-v2 --bucket "$BUCKET" --max-keys 1 --region "$REGION" > /dev/null 2>&1; then
+            break
         fi
+        [ "$i" -eq 12 ] && {{ echo "New access key cannot access bucket $BUCKET"; exit 1; }}
+        sleep 5
+    done
+done
+VERIFY_MS=$(( $(now_ms) - VERIFY_STARTED ))
+end_phase
 
-        # Navigate to the Seafile directory
-        cd /opt/seafile
+# Navigate to the Seafile directory
+cd /opt/seafile
 
-        # Update seafile.conf with new credentials using sed
-        sudo docker exec seafile sed -i "/\[commit_object_backend\]/,/^\[/ s/key_id = .*/key_id = $NEW_ACCESS_KEY_ID/" /opt/seafile/conf/seafile.conf || {{ echo "Failed to update commit_object_backend key_id"; exit 1; }}
-        sudo docker exec seafile sed -i "/\[commit_object_backend\]/,/^\[/ s/key = .*/key = $NEW_SECRET_ACCESS_KEY/" /opt/seafile/conf/seafile.conf || {{ echo "Failed to update commit_object_backend key"; exit 1; }}
-        sudo docker exec seafile sed -i "/\[fs_object_backend\]/,/^\[/ s/key_id = .*/key_id = $NEW_ACCESS_KEY_ID/" /opt/seafile/conf/seafile.conf || {{ echo "Failed to update fs_object_backend key_id"; exit 1; }}
-        sudo docker exec seafile sed -i "/\[fs_object_backend\]/,/^\[/ s/key = .*/key = $NEW_SECRET_ACCESS_KEY/" /opt/seafile/conf/seafile.conf || {{ echo "Failed to update fs_object_backend key"; exit 1; }}
-        sudo docker exec seafile sed -i "/\[block_backend\]/,/^\[/ s/key_id = .*/key_id = $NEW_ACCESS_KEY_ID/" /opt/seafile/conf/seafile.conf || {{ echo "Failed to update block_backend key_id"; exit 1; }}
-        sudo docker exec seafile sed -i "/\[block_backend\]/,/^\[/ s/key = .*/key = $NEW_SECRET_ACCESS_KEY/" /opt/seafile/conf/seafile.conf || {{ echo "Failed to update block_backend key"; exit 1; }}
+# Update key_id/key in every S3 backend section of seafile.conf in a single atomic write,
+# keeping a copy of the previous file to roll back to
+begin_phase render_config
+sudo cp -p {SEAFILE_CONF_PATH} {SEAFILE_CONF_PATH}.previous
+export SEAFILE_S3_KEY_ID="$NEW_ACCESS_KEY_ID" SEAFILE_S3_KEY="$NEW_SECRET_ACCESS_KEY"
+CONF_RESULT=$(sudo -E python3 {REMOTE_BIN_DIR}/seafile_config.py set-credentials) || {{ echo "Failed to update seafile.conf credentials"; exit 1; }}
+echo "$CONF_RESULT"
+end_phase
 
-        # Restart the Docker containers
-        sudo docker-compose down || {{ echo "Failed to stop Docker containers"; exit 1; }}
-        sudo docker-compose up -d || {{ echo "Failed to start Docker containers"; exit 1; }}
+# Nothing to reload when seafile.conf already carried the new key
+if echo "$CONF_RESULT" | grep -q ' unchanged$'; then
+    echo "seafile.conf already uses the new access key; skipping the reload"
+    UNAVAILABLE_MS=0
+else
+    begin_phase reload
+    {RELOAD_SCRIPTS[reload_mode]}
+    end_phase
+fi
 
-        # Verify Seafile is running
-        sudo docker-compose ps | grep seafile | grep Up || {{ echo "Seafile failed to start after restart"; exit 1; }}
+# Only retire the old key once the new one is confirmed against every bucket and Seafile
+# is serving again with it
+begin_phase delete_old_key
+# Read only now: the rotation stores the old credentials after the new ones, and storing the new
+# ones is what triggers this update
+{fetch_parameters_snippet('$REGION', {'OLD_CREDENTIALS': OLD_IAM_CREDENTIALS})}
+OLD_ACCESS_KEY_ID=$(echo "$OLD_CREDENTIALS" | jq -r '.access_key_id')
 
-        # Retrieve the old access key ID from Parameter Store
-        OLD_CREDENTIALS=$(aws ssm get-parameter --name "/seafile/old_iam_user/credentials" --with-decryption --region {region} --query Parameter.Value --output text) || {{ echo "Failed to retrieve old credentials"; exit 1; }}
-        OLD_ACCESS_KEY_ID=$(echo $OLD_CREDENTIALS | jq -r '.access_key_id')
+# Validate that old access key ID was retrieved
+if [ -z "$OLD_ACCESS_KEY_ID" ]; then
+    echo "Failed to extract old access key ID from Parameter Store"
+    exit 1
+fi
+
+# Delete the old access key from the IAM user. A repeated run may find it already gone, which
+# is only fine when the new key is the user's one remaining key; otherwise the old key ID is
+# stale and the key that was just rotated out would stay active.
+if [ "$OLD_ACCESS_KEY_ID" = "$NEW_ACCESS_KEY_ID" ]; then
+    echo "Old and new access key IDs match; keeping the key"
+elif ! DELETE_ERROR=$(aws iam delete-access-key --user-name seafile-service-account --access-key-id "$OLD_ACCESS_KEY_ID" --region "$REGION" 2>&1); then
+    echo "$DELETE_ERROR" | grep -q NoSuchEntity || {{ echo "Failed to delete old access key: $DELETE_ERROR"; exit 1; }}
+    REMAINING_KEYS=$(aws iam list-access-keys --user-name seafile-service-account --query 'AccessKeyMetadata[].AccessKeyId' --output text --region "$REGION") || {{ echo "Failed to list access keys"; exit 1; }}
+    if [ "$REMAINING_KEYS" != "$NEW_ACCESS_KEY_ID" ]; then
+        echo "Old access key $OLD_ACCESS_KEY_ID does not exist, but the user has access keys $REMAINING_KEYS besides the new one"
+        exit 1
+    fi
+    echo "Old access key $OLD_ACCESS_KEY_ID was already deleted"
+fi
+end_phase
+
+echo "::rollover mode={reload_mode} verify_ms=$VERIFY_MS unavailable_ms=$UNAVAILABLE_MS"
+echo "Seafile configuration updated and old access key deleted successfully. Seafile was unavailable for $UNAVAILABLE_MS ms."
+"""
 
-        # Validate that old access key ID was retrieved
-        if [ -z "$OLD_ACCESS_KEY_ID" ]; then
-            echo "Failed to extract old access key ID from Parameter Store"
-            exit 1
-        fi
 
-        # Delete the old access key from the IAM user
-        aws iam delete-access-key --user-name seafile-service-account --access-key-id "$OLD_ACCESS_KEY_ID" --region {region} || {{ echo "Failed to delete old access key"; exit 1; }}
+# One task per reload mode, rendered once per container
+UPDATE_CONFIG_TASKS = {
+    reload_mode: RemoteTask(f"update_config_{reload_mode}", update_config_script(reload_mode), modules=['seafile_config.py', 'provisioner.py'])
+    for reload_mode in RELOAD_SCRIPTS
+}
 
-        echo "Seafile configuration updated and old access key deleted successfully."
-        """
 
-        # Execute the script on the EC2 instance using SSM
-        response = ssm_client.send_command(
-            InstanceIds=[instance_id],
-            DocumentName="AWS-RunShellScript",
-            Parameters={
-                "commands": [
-                    update_config_script
-                ]
+def config_fingerprint(credentials, instance_id, buckets, region):
+    # Hash of the seafile.conf backend settings this function deploys to the instance, so a new
+    # bucket or region counts as a change as well as a new key
+    credentials = json.loads(credentials)
+    target = {
+        'instance_id': instance_id,
+        'settings': backend_settings(dict(zip(BACKEND_SECTIONS, buckets)), credentials['access_key_id'],
+                                     credentials['secret_access_key'], region)
+    }
+    return hashlib.sha256(json.dumps(target, sort_keys=True).encode()).hexdigest()
+
+
+def lambda_handler(event, context):
+    try:
+        # Get the region, instance ID and buckets from environment variables with validation
+        region = os.environ.get('REGION')
+        instance_id = os.environ.get('INSTANCE_ID')
+        buckets = [os.environ.get(k) for k in ['COMMIT_BUCKET', 'FS_BUCKET', 'BLOCK_BUCKET']]
+        reload_mode = os.environ.get('RELOAD_MODE', 'rolling')
+
+        if not all([region, instance_id, *buckets]):
+            missing = [k for k, v in {
+                'REGION': region,
+                'INSTANCE_ID': instance_id,
+                'COMMIT_BUCKET': buckets[0],
+                'FS_BUCKET': buckets[1],
+                'BLOCK_BUCKET': buckets[2]
+            }.items() if not v]
+            raise ValueError(f"Missing required environment variables: {missing}")
+        if reload_mode not in RELOAD_SCRIPTS:
+            raise ValueError(f"Unsupported RELOAD_MODE {reload_mode}; expected one of {list(RELOAD_SCRIPTS)}")
+
+        if is_command_status_event(event):
+            def metrics(result):
+                rollover = (parse_markers(result.get('StandardOutputContent'), 'rollover') or [{}])[0]
+                return {
+                    'UpdateSucceeded': (int(result['Status'] == 'Success'), 'Count'),
+                    'UpdateSkipped': (0, 'Count'),
+                    'KeyVerifyTime': (int(rollover['verify_ms']) if rollover.get('verify_ms') else None, 'Milliseconds'),
+                    'UnavailableTime': (int(rollover['unavailable_ms']) if rollover.get('unavailable_ms') else None, 'Milliseconds')
+                }, {'ReloadMode': reload_mode}
+
+            def record_deployed(run):
+                # Record what is now deployed so repeated events for the same value are no-ops
+                put_parameter(DEPLOYED_CREDENTIALS_FINGERPRINT, run['fingerprint'], region)
+                logger.info(f"Deployed credentials fingerprint {run['fingerprint'][:12]} stored in {DEPLOYED_CREDENTIALS_FINGERPRINT}")
+
+            reported = report_command('update', event, region, metrics, on_success=record_deployed)
+            if not reported:
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps('Not a pending configuration update command; nothing to report')
+                }
+            run, result = reported
+            if result['Status'] != 'Success':
+                raise Exception(f"Configuration update command {run['command_id']} finished with status {result['Status']}: "
+                                f"{result.get('StandardErrorContent', '').strip()}")
+            return {
+                'statusCode': 200,
+                'body': json.dumps('UpdateConfigLambda executed successfully!')
+            }
+
+        # Change events also fire for re-puts of the same value and metadata-only updates, so compare
+        # what would be deployed with what was last deployed before touching the instance
+        values = get_parameters([IAM_CREDENTIALS, DEPLOYED_CREDENTIALS_FINGERPRINT], region)
+        if IAM_CREDENTIALS not in values:
+            raise ValueError(f"Parameter {IAM_CREDENTIALS} not found")
+        fingerprint = config_fingerprint(values[IAM_CREDENTIALS], instance_id, buckets, region)
+        if values.get(DEPLOYED_CREDENTIALS_FINGERPRINT) == fingerprint:
+            logger.info(f"Credentials and seafile.conf settings for {instance_id} unchanged "
+                        f"(fingerprint {fingerprint[:12]} matches {DEPLOYED_CREDENTIALS_FINGERPRINT}); nothing to do")
+            emit({'UpdateSkipped': (1, 'Count')}, {'Command': 'update', 'InstanceId': instance_id}, {'Fingerprint': fingerprint[:12]})
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'status': 'unchanged',
+                    'instance_id': instance_id,
+                    'fingerprint': fingerprint[:12],
+                    'checked': [IAM_CREDENTIALS, DEPLOYED_CREDENTIALS_FINGERPRINT]
+                })
             }
-        )
 
-        command_id = response['Command']['CommandId']
-        logger.info(f"SSM command sent successfully. Command ID: {command_id}")
+        logger.info(f"Updating Seafile configuration for instance ID: {instance_id} ({reload_mode} reload)")
+
+        def send():
+            # Execute the script on the EC2 instance using SSM
+            response = get_client('ssm', region).send_command(
+                InstanceIds=[instance_id],
+                DocumentName="AWS-RunShellScript",
+                Parameters={
+                    "commands": [
+                        UPDATE_CONFIG_TASKS[reload_mode].command(
+                            {'REGION': region, 'BUCKETS': ' '.join(buckets)}, region, os.environ.get('REMOTE_TASKS_BUCKET')
+                        )
+                    ]
+                },
+                **output_config(command_log_group())
+            )
+            logger.info(f"SSM command sent successfully. Command ID: {response['Command']['CommandId']}")
+            return {'command_id': response['Command']['CommandId'], 'sent_at': time.time(), 'fingerprint': fingerprint}
 
+        # Several change events for the same value join the update already running on the instance.
+        # An update deploying a different value cannot be joined; this event then fails so the
+        # newer value is not reported as deployed.
+        try:
+            run, attached = send_command_once('update', instance_id, send, event, context, region, LEDGER_LEASE_SECONDS,
+                                              joinable=lambda run: run.get('fingerprint') == fingerprint)
+        except TargetBusy as e:
+            raise Exception(f"Another configuration update is in progress on {instance_id}: {e}")
+        # The command's status-change event reports the outcome and records the deployed fingerprint
         return {
-            'statusCode': 200,
-            'body': json.dumps('UpdateConfigLambda executed successfully!')
+            'statusCode': 202,
+            'body': json.dumps(f"Configuration update {'already running' if attached else 'started'}. Command ID: {run['command_id']}")
         }
 
     except Exception as e:
@@ -1,8 +1,52 @@
 # Zip the UpdateConfigLambda function
 data "archive_file" "update_config_lambda_zip" {
   type        = "zip"
-  source_file = "${path.module}/update_config_lambda.py"
   output_path = "${path.module}/update_config_lambda.zip"
+
+  source {
+    content  = file("${path.module}/update_config_lambda.py")
+    filename = "update_config_lambda.py"
+  }
+
+  source {
+    content  = file("${path.module}/aws_clients.py")
+    filename = "aws_clients.py"
+  }
+
+  source {
+    content  = file("${path.module}/parameters.py")
+    filename = "parameters.py"
+  }
+
+  source {
+    content  = file("${path.module}/remote_tasks.py")
+    filename = "remote_tasks.py"
+  }
+
+  source {
+    content  = file("${path.module}/provisioner.py")
+    filename = "provisioner.py"
+  }
+
+  source {
+    content  = file("${path.module}/seafile_config.py")
+    filename = "seafile_config.py"
+  }
+
+  source {
+    content  = file("${path.module}/ssm_commands.py")
+    filename = "ssm_commands.py"
+  }
+
+  source {
+    content  = file("${path.module}/metrics.py")
+    filename = "metrics.py"
+  }
+
+  source {
+    content  = file("${path.module}/event_ledger.py")
+    filename = "event_ledger.py"
+  }
 }
 
 # IAM Role for UpdateConfigLambda
@@ -29,6 +73,16 @@ resource "aws_iam_role_policy" "update_config_lambda_policy" {
   policy = jsonencode({
     Version = "2012-10-17"
     Statement = [
+      {
+        Effect = "Allow"
+        Action = [
+          "dynamodb:GetItem",
+          "dynamodb:PutItem",
+          "dynamodb:UpdateItem",
+          "dynamodb:DeleteItem"
+        ]
+        Resource = aws_dynamodb_table.seafile_event_ledger.arn
+      },
       {
         Effect = "Allow"
         Action = [
@@ -48,6 +102,7 @@ resource "aws_iam_role_policy" "update_config_lambda_policy" {
         Effect = "Allow"
         Action = [
           "ssm:GetParameter",
+          "ssm:GetParameters",
           "ssm:PutParameter"
         ]
         Resource = "arn:aws:ssm:${var.region}:${data.aws_caller_identity.current.account_id}:parameter/seafile/*"
@@ -58,6 +113,14 @@ resource "aws_iam_role_policy" "update_config_lambda_policy" {
           "iam:DeleteAccessKey"
         ]
         Resource = "arn:aws:iam::${data.aws_caller_identity.current.account_id}:user/seafile-service-account"
+      },
+      {
+        # Remote task bundles referenced by the commands
+        Effect = "Allow"
+        Action = [
+          "s3:PutObject"
+        ]
+        Resource = "${aws_s3_bucket.seafile_remote_tasks.arn}/remote-tasks/*"
       }
     ]
   })
@@ -70,13 +133,19 @@ resource "aws_lambda_function" "update_config_lambda" {
   role          = aws_iam_role.update_config_lambda_execution_role.arn
   handler       = "update_config_lambda.lambda_handler"
   runtime       = "python3.9"
-  timeout       = 600
+  timeout       = 60
 
   environment {
-    variables = {
-      REGION      = var.region
-      INSTANCE_ID = aws_instance.seafile_instance.id
-    }
+    variables = merge(local.command_lambda_environment, {
+      REGION        = var.region
+      INSTANCE_ID   = aws_instance.seafile_instance.id
+      COMMIT_BUCKET = aws_s3_bucket.seafile_buckets["commit"].id
+      FS_BUCKET     = aws_s3_bucket.seafile_buckets["fs"].id
+      BLOCK_BUCKET  = aws_s3_bucket.seafile_buckets["block"].id
+
+      # "rolling" restarts only the seafile container behind a health check; "full" restarts the whole stack
+      RELOAD_MODE = "rolling"
+    })
   }
 
   depends_on = [aws_iam_role_policy.update_config_lambda_policy]
@@ -108,4 +177,18 @@ resource "aws_lambda_permission" "allow_eventbridge_update_config" {
   function_name = aws_lambda_function.update_config_lambda.function_name
   principal     = "events.amazonaws.com"
   source_arn    = aws_cloudwatch_event_rule.parameter_store_change.arn
-}
\ No newline at end of file
+}
+
+resource "aws_cloudwatch_event_target" "update_config_command_status_target" {
+  rule      = aws_cloudwatch_event_rule.seafile_command_status.name
+  target_id = "UpdateConfigLambda"
+  arn       = aws_lambda_function.update_config_lambda.arn
+}
+
+resource "aws_lambda_permission" "allow_eventbridge_update_config_command_status" {
+  statement_id  = "AllowExecutionFromEventBridgeUpdateConfigCommandStatus"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.update_config_lambda.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.seafile_command_status.arn
+}
@@ -62,4 +62,22 @@ variable "public_subnets" {
   description = "List of public subnet CIDR blocks"
   type        = list(string)
   default     = ["10.0.1.0/24"]
-}
\ No newline at end of file
+}
+
+variable "post_setup_benchmark" {
+  description = "Benchmark uploads, downloads and S3 requests through the Seafile web API after setup"
+  type        = bool
+  default     = false
+}
+
+variable "benchmark_file_mix" {
+  description = "File sizes and counts the post-setup benchmark uploads and downloads (size:count pairs)"
+  type        = string
+  default     = "4KiB:100,256KiB:40,4MiB:10,64MiB:2"
+}
+
+variable "benchmark_concurrency" {
+  description = "Concurrent requests the post-setup benchmark keeps in flight"
+  type        = number
+  default     = 8
+}